@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the round trip latency of core.client.Client under concurrent
+callers. A responder thread plays the role of a plugin application and
+echoes every command back with its id.
+
+Needs a local redis server, run it from the project root:
+    python -m benchmarks.bench_client --callers 1 4 16 --calls 200
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import argparse
+import threading
+
+# io_server imports
+from core.utils import subscribe, message_id
+from core.client import Client
+from core.publisher import get_publisher
+
+COMMAND_CHANNEL = 'benchmarks.commands'
+RESPONSE_CHANNEL = 'benchmarks.responses'
+
+
+def responder(msg):
+    response = {'command': msg['command'], 'params': {'error': False}}
+    response['id'] = message_id(msg)
+    get_publisher().publish(RESPONSE_CHANNEL, response)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run(client, callers, calls):
+    latencies = []
+    lock = threading.Lock()
+
+    def caller():
+        for _ in range(calls):
+            start = time.time()
+            client.call(COMMAND_CHANNEL, 'echo', timeout=5)
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--callers', type=int, nargs='+', default=[1, 4, 16],
+                        help='number of concurrent callers of every run')
+    parser.add_argument('--calls', type=int, default=200,
+                        help='calls made by every caller')
+    args = parser.parse_args()
+
+    worker = subscribe(COMMAND_CHANNEL, responder)
+    worker.subscribed.wait(5)
+    client = Client([COMMAND_CHANNEL])
+
+    print '{0:<10}{1:>12}{2:>12}{3:>12}{4:>12}'.format(
+        'callers', 'calls/s', 'p50 ms', 'p99 ms', 'max ms'
+    )
+    for callers in args.callers:
+        latencies, elapsed = run(client, callers, args.calls)
+        print '{0:<10}{1:>12.0f}{2:>12.3f}{3:>12.3f}{4:>12.3f}'.format(
+            callers, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies) * 1000
+        )
+
+    client.close()
+    worker.stop()
+
+
+if __name__ == '__main__':
+    main()
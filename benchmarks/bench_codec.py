@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the wire codecs in core.codec on representative
+receipt and card reader messages: encode and decode time and size.
+
+Run it from the project root:
+    python -m benchmarks.bench_codec --items 50 --repeat 2000
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import json
+import time
+import argparse
+
+# io_server imports
+from core import codec
+
+
+def receipt_message(items):
+    return {
+        "id": "0b4b3a3c8f7e4a53a1f0b5c1d2e3f4a5",
+        "command": "send_receipt",
+        "params": {
+            "destination": ["printer"],
+            "driver_name": "Jon Smith",
+            "cab_id": "AH0001234",
+            "items": {
+                "Item number {0}".format(i): [1.5 * i, "item"]
+                for i in range(items)
+            },
+            "promotions": {
+                "Space Center Free Ticket": "qrcode"
+            }
+        }
+    }
+
+
+def card_message():
+    return {
+        "id": "0b4b3a3c8f7e4a53a1f0b5c1d2e3f4a5",
+        "command": "card_info",
+        "params": {
+            "error": False,
+            "error_code": 0,
+            "status": "OK",
+            "content": {
+                "track0": "%B4111111111111111^SMITH/JON^2512101000000000?",
+                "track1": ";4111111111111111=25121010000000000000?"
+            }
+        }
+    }
+
+
+def measure(func, arg, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        func(arg)
+    return (time.time() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=50,
+                        help='number of items in the receipt message')
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='iterations of every measurement')
+    args = parser.parse_args()
+
+    messages = (
+        ('receipt', receipt_message(args.items)),
+        ('card', card_message())
+    )
+
+    print 'fast json backend: {0}'.format(
+        'yes' if codec.fast_json is not None else 'no'
+    )
+    print '{0:<10}{1:<10}{2:>12}{3:>12}{4:>10}'.format(
+        'message', 'codec', 'encode us', 'decode us', 'bytes'
+    )
+    for name, msg in messages:
+        # the standard library json as the baseline
+        data = json.dumps(msg)
+        encode = measure(json.dumps, msg, args.repeat)
+        decode = measure(json.loads, data, args.repeat)
+        print '{0:<10}{1:<10}{2:>12.2f}{3:>12.2f}{4:>10}'.format(
+            name, 'stdlib', encode, decode, len(data)
+        )
+
+        for codec_name in codec.available():
+            data = codec.encode(msg, codec_name)
+            assert codec.decode(data) == codec.decode(codec.encode(msg))
+
+            encode = measure(lambda m: codec.encode(m, codec_name), msg,
+                             args.repeat)
+            decode = measure(codec.decode, data, args.repeat)
+            print '{0:<10}{1:<10}{2:>12.2f}{3:>12.2f}{4:>10}'.format(
+                name, codec_name, encode, decode, len(data)
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+End to end load and latency benchmark: start the plugin applications
+with simulated devices (see benchmarks.devices) against a local redis
+server, send them a mix of commands at a fixed rate through
+core.client.Client and report the latency of every command, the
+commands per second and the CPU and memory used by every process.
+
+The results are written as json, pass the results of a previous release
+with --baseline to fail when the latency or the throughput got worse.
+
+Needs a local redis server, run it from the project root:
+    python -m benchmarks.bench_e2e --rate 20 --duration 30 \\
+        --mix send_receipt=1,read=2,device_status=2 --output e2e.json
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+
+# redis imports
+import redis
+
+# io_server imports
+from core.client import Client, Timeout
+from benchmarks import devices
+
+# command -> (application, channel, params)
+COMMANDS = {
+    'send_receipt': ('receipt_manager', 'receipt_manager.commands', {
+        'destination': ['printer'],
+        'driver_name': 'Jon Smith',
+        'cab_id': 'AH0001234',
+        'items': {
+            'Top up to phone: 713-345-6745': [10.0, 'item'],
+            'T-Shirt on amazon': [3.00, 'barcode'],
+            'Phone charge': [2.00, 'item'],
+            'Trip Fare': [15.00, 'item']
+        },
+        'promotions': {
+            'Space Center Free Ticket': 'qrcode'
+        }
+    }),
+    'read': ('card_reader', 'card_reader.commands', {'timeout': 30}),
+    'device_status': ('device_charger', 'device_charger.commands', {}),
+}
+
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def parse_mix(mix):
+    """
+    Parse "command=weight,..." into a list of (command, weight)
+    """
+    result = []
+    for item in mix.split(','):
+        command, _, weight = item.partition('=')
+        command = command.strip()
+        if command not in COMMANDS:
+            raise ValueError('Unknown command: {0}'.format(command))
+        result.append((command, float(weight or 1)))
+    return result
+
+
+def cpu_seconds(pid):
+    with open('/proc/{0}/stat'.format(pid)) as f:
+        # the process name may contain spaces, skip it
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def rss_kb(pid):
+    with open('/proc/{0}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class ProcessMonitor(threading.Thread):
+    """
+    Sample the CPU time and the resident memory of some processes
+    """
+
+    def __init__(self, processes, interval=0.5):
+        super(ProcessMonitor, self).__init__(name='process-monitor')
+        self.daemon = True
+        self.processes = processes
+        self.interval = interval
+        self.rss_max = dict.fromkeys(processes, 0)
+        self._start = None
+        self._stopped = threading.Event()
+
+    def begin(self):
+        self._start = time.time(), self._cpu()
+        self.start()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def finish(self):
+        self._stopped.set()
+        self.join()
+        self._sample()
+
+        started, cpu = self._start
+        elapsed = time.time() - started
+        result = {}
+        for name, seconds in self._cpu().iteritems():
+            used = seconds - cpu.get(name, 0)
+            result[name] = {
+                'cpu_seconds': round(used, 3),
+                'cpu_percent': round(100 * used / elapsed, 2),
+                'rss_max_kb': self.rss_max[name],
+            }
+        return result
+
+    def _cpu(self):
+        result = {}
+        for name, pid in self.processes.iteritems():
+            try:
+                result[name] = cpu_seconds(pid)
+            except IOError:
+                pass
+        return result
+
+    def _sample(self):
+        for name, pid in self.processes.iteritems():
+            try:
+                self.rss_max[name] = max(self.rss_max[name], rss_kb(pid))
+            except IOError:
+                pass
+
+
+def start_applications(applications, options):
+    """
+    Start the simulated applications, one process per application or one
+    process for all of them, return a dict: process name -> Popen
+    """
+    groups = [applications] if options.runtime else [[a] for a in applications]
+    forwarded = [
+        '--transport', options.transport,
+        '--printer-speed', str(options.printer_speed),
+        '--transfer-latency', str(options.transfer_latency),
+        '--header', options.header,
+        '--footer', options.footer,
+        '--swipe', str(options.swipe),
+        '--charger-latency', str(options.charger_latency),
+    ] + (['--buffered'] if options.buffered else []) + \
+        (['--untracked'] if not options.track_state else [])
+
+    processes = {}
+    for group in groups:
+        name = 'runtime' if options.runtime else group[0]
+        command = [sys.executable, '-m', 'benchmarks.devices'] + group
+        processes[name] = subprocess.Popen(command + forwarded,
+                                           cwd=devices.ROOT)
+    return processes
+
+
+def wait_ready(channels, transport, processes, timeout=30.0):
+    """
+    Wait until every command channel has a reader
+    """
+    client = redis.StrictRedis()
+    deadline = time.time() + timeout
+    pending = set(channels)
+    while pending and time.time() < deadline:
+        for name, process in processes.iteritems():
+            if process.poll() is not None:
+                raise RuntimeError('Process: {0} exited with code: {1}'.format(
+                    name, process.returncode
+                ))
+
+        for channel in list(pending):
+            if transport == 'stream':
+                try:
+                    groups = client.xinfo_groups(channel)
+                except redis.ResponseError:
+                    groups = []
+                ready = any(group['consumers'] for group in groups)
+            else:
+                ready = client.pubsub_numsub(channel)[0][1] > 0
+            if ready:
+                pending.discard(channel)
+        time.sleep(0.1)
+
+    if pending:
+        raise RuntimeError('No reader for: {0}'.format(', '.join(pending)))
+
+
+def drive(client, mix, rate, duration, warmup, timeout, seed):
+    """
+    Send commands picked from "mix" at "rate" commands per second during
+    "warmup" + "duration" seconds, only the commands sent after the
+    warmup are measured. Return the samples of every command and the
+    measured time.
+    """
+    chooser = random.Random(seed)
+    total = sum(weight for _, weight in mix)
+    samples = {command: [] for command, _ in mix}
+    lock = threading.Lock()
+
+    def pick():
+        value = chooser.uniform(0, total)
+        for command, weight in mix:
+            value -= weight
+            if value <= 0:
+                return command
+        return mix[-1][0]
+
+    def done(command, sent, measured):
+        def callback(call):
+            if not measured:
+                return
+
+            latency = time.time() - sent
+            if isinstance(call.error, Timeout):
+                outcome = 'timeout'
+            elif call.error is not None or \
+                    call.response.get('params', {}).get('error'):
+                outcome = 'error'
+            else:
+                outcome = 'ok'
+
+            with lock:
+                samples[command].append((latency, outcome))
+        return callback
+
+    start = time.time()
+    measure_start = start + warmup
+    end = measure_start + duration
+    interval = 1.0 / rate
+    sent = 0
+
+    while True:
+        target = start + sent * interval
+        if target >= end:
+            break
+
+        delay = target - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        command = pick()
+        _, channel, params = COMMANDS[command]
+        now = time.time()
+        client.call_async(channel, command, params, timeout,
+                          callback=done(command, now, now >= measure_start))
+        sent += 1
+
+    # wait for the commands still in flight
+    deadline = time.time() + timeout + 1
+    while client.in_flight() and time.time() < deadline:
+        time.sleep(0.05)
+
+    return samples, time.time() - measure_start
+
+
+def summarize(samples, elapsed):
+    result = {}
+    everything = []
+    for command, values in sorted(samples.iteritems()):
+        latencies = [latency for latency, outcome in values if outcome == 'ok']
+        everything.extend(latencies)
+        result[command] = {
+            'count': len(values),
+            'errors': sum(1 for _, outcome in values if outcome == 'error'),
+            'timeouts': sum(1 for _, outcome in values if outcome == 'timeout'),
+            'per_second': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(max(latencies or [0]) * 1000, 3),
+        }
+
+    result['total'] = {
+        'count': sum(r['count'] for r in result.values()),
+        'errors': sum(r['errors'] for r in result.values()),
+        'timeouts': sum(r['timeouts'] for r in result.values()),
+        'per_second': round(len(everything) / elapsed, 2),
+        'p50_ms': round(percentile(everything, 50) * 1000, 3),
+        'p99_ms': round(percentile(everything, 99) * 1000, 3),
+        'max_ms': round(max(everything or [0]) * 1000, 3),
+    }
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=devices.ROOT,
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the regressions of "results" against "baseline": p99 latency
+    or throughput more than "tolerance" (a fraction) worse.
+    """
+    regressions = []
+    for command, current in results['commands'].iteritems():
+        previous = baseline.get('commands', {}).get(command)
+        if not previous:
+            continue
+
+        if previous['p99_ms'] and \
+                current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append('{0}: p99 {1} ms -> {2} ms'.format(
+                command, previous['p99_ms'], current['p99_ms']
+            ))
+
+        if previous['per_second'] and \
+                current['per_second'] < previous['per_second'] * (1 - tolerance):
+            regressions.append('{0}: {1} -> {2} commands/s'.format(
+                command, previous['per_second'], current['per_second']
+            ))
+    return regressions
+
+
+def report(results):
+    print '{0:<16}{1:>8}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}{7:>10}'.format(
+        'command', 'count', 'errors', 'timeouts', 'cmd/s',
+        'p50 ms', 'p99 ms', 'max ms'
+    )
+    commands = results['commands']
+    for command in sorted(commands, key=lambda c: (c == 'total', c)):
+        r = commands[command]
+        print '{0:<16}{1:>8}{2:>8}{3:>10}{4:>10.2f}{5:>10.3f}{6:>10.3f}' \
+              '{7:>10.3f}'.format(command, r['count'], r['errors'],
+                                  r['timeouts'], r['per_second'],
+                                  r['p50_ms'], r['p99_ms'], r['max_ms'])
+
+    print
+    print '{0:<16}{1:>10}{2:>10}{3:>12}'.format(
+        'process', 'cpu %', 'cpu s', 'rss max kb'
+    )
+    for name, r in sorted(results['processes'].iteritems()):
+        print '{0:<16}{1:>10.2f}{2:>10.3f}{3:>12}'.format(
+            name, r['cpu_percent'], r['cpu_seconds'], r['rss_max_kb']
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--mix', default='send_receipt=1,read=2,device_status=2',
+                        help='commands to send and their weights')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='commands per second, for all the commands')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3,
+                        help='seconds sending commands before measuring')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for every response')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the command picker')
+    parser.add_argument('--runtime', action='store_true',
+                        help='host all the applications in one process')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--baseline',
+                        help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed regression against the baseline')
+    devices.add_arguments(parser)
+    options = parser.parse_args()
+
+    mix = parse_mix(options.mix)
+    applications = sorted(set(COMMANDS[command][0] for command, _ in mix))
+    channels = sorted(set(COMMANDS[command][1] for command, _ in mix))
+
+    processes = start_applications(applications, options)
+    try:
+        wait_ready(channels, options.transport, processes)
+        client = Client(channels, transport=options.transport)
+
+        pids = {name: p.pid for name, p in processes.iteritems()}
+        pids['driver'] = os.getpid()
+        monitor = ProcessMonitor(pids)
+        monitor.begin()
+
+        samples, elapsed = drive(client, mix, options.rate, options.duration,
+                                 options.warmup, options.timeout, options.seed)
+        usage = monitor.finish()
+        client.close()
+    finally:
+        for process in processes.itervalues():
+            if process.poll() is None:
+                process.terminate()
+        for process in processes.itervalues():
+            process.wait()
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'options': vars(options),
+        'elapsed': round(elapsed, 3),
+        'commands': summarize(samples, elapsed),
+        'processes': usage,
+    }
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            print
+            print 'Regressions against: {0}'.format(options.baseline)
+            for regression in regressions:
+                print '    {0}'.format(regression)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Send a tall image to a simulated printer with a receive buffer that
+drains at the printer speed, with and without flow control, and report
+the transfers that timed out, the throughput and whether the printer
+received the data intact, corrupt or the writes failed.
+
+Like a USB bulk transfer, a write waits until the data fits in the
+receive buffer and times out if it does not fit in time. The bytes the
+printer took before the timeout are not reported, so the piece can not
+be sent again without duplicating them: the job fails and must be sent
+again whole. The flow control avoids the timeouts by never getting more
+than the receive buffer ahead of the printer.
+
+Run it from the project root:
+    python -m benchmarks.bench_flow --speed 20000 --height 1024
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import argparse
+
+# io_server imports
+from core.escpos import raster
+from core.escpos.escpos import Escpos
+from core.escpos.exceptions import WriteTimeoutError
+from benchmarks.devices import LOGO
+
+
+class BufferPrinter(Escpos):
+    """
+    Printer with a "receive_buffer" bytes buffer printing "speed" bytes
+    per second, writes time out after "timeout" seconds
+    """
+
+    def __init__(self, speed, receive_buffer, timeout, throughput=None):
+        self.speed = float(speed)
+        self.timeout = timeout
+        self.device = True
+        self.data = []
+        self.timeouts = 0
+        self._level = 0.0
+        self._drained_at = time.time()
+        self._set_buffered(False, receive_buffer)
+        self._set_flow_control(receive_buffer, throughput)
+
+    def _simulate_drain(self):
+        now = time.time()
+        self._level = max(0.0, self._level - (now - self._drained_at) * self.speed)
+        self._drained_at = now
+
+    def _write(self, msg):
+        self._simulate_drain()
+        wait = (self._level + len(msg) - self.receive_buffer) / self.speed
+        if wait > self.timeout:
+            # the printer takes what fits until the timeout
+            time.sleep(self.timeout)
+            self._simulate_drain()
+            taken = int(self.receive_buffer - self._level)
+            self.data.append(msg[:taken])
+            self._level += taken
+            self.timeouts += 1
+            return 0
+
+        if wait > 0:
+            time.sleep(wait)
+            self._simulate_drain()
+        self.data.append(msg)
+        self._level += len(msg)
+        return len(msg)
+
+    def __del__(self):
+        self.device = None
+
+
+def payload(height):
+    im = raster.load(LOGO, 512)
+    im = im.resize((512, height))
+    return ''.join(raster.command(band) for band in raster.bands(im))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--speed', type=float, default=20000,
+                        help='printer speed in bytes per second')
+    parser.add_argument('--receive-buffer', type=int, default=4096,
+                        help='printer receive buffer in bytes')
+    parser.add_argument('--timeout', type=float, default=0.1,
+                        help='seconds until a write times out')
+    parser.add_argument('--height', type=int, default=1024,
+                        help='height of the image sent')
+    args = parser.parse_args()
+
+    data = payload(args.height)
+    print 'payload: {0} bytes'.format(len(data))
+    print '{0:<16}{1:>12}{2:>12}{3:>12}{4:>10}'.format(
+        'flow control', 'timeouts', 'seconds', 'bytes/s', 'data'
+    )
+    for name, throughput in (('none', None), ('throughput', args.speed)):
+        printer = BufferPrinter(args.speed, args.receive_buffer, args.timeout,
+                                throughput)
+        start = time.time()
+        try:
+            printer._raw(data)
+            result = 'intact' if ''.join(printer.data) == data else 'corrupt'
+        except WriteTimeoutError:
+            result = 'failed'
+        elapsed = time.time() - start
+        print '{0:<16}{1:>12}{2:>12.3f}{3:>12.0f}{4:>10}'.format(
+            name, printer.timeouts, elapsed, len(data) / elapsed, result
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the commands of the receipt in a receipt journal, as the receipt
+manager does for every receipt printed, and report the time to append
+one, to find the latest receipt of a cab and to read it back for a
+reprint, and the bytes stored per receipt.
+
+The latest receipts are found in constant time, the lookups should not
+get slower with the receipts kept.
+
+Run it from the project root:
+    python -m benchmarks.bench_journal --receipts 10000
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+# io_server imports
+from core.journal import Journal
+from benchmarks import devices
+from benchmarks.bench_e2e import COMMANDS
+from benchmarks.bench_pipeline import NullPrinter
+
+
+def receipt_commands(options):
+    app = devices.create_application('receipt_manager', options)
+    app.setup()
+    params = COMMANDS['send_receipt'][2]
+    printer = NullPrinter(True)
+    commands = printer.template(app.template, app.receipt_fields(
+        params['driver_name'], params['cab_id'], params['items'],
+        params['promotions']
+    ))
+    app.teardown()
+    return commands
+
+
+def measure(function, count):
+    """
+    Return the microseconds per call of function(i)
+    """
+    start = time.time()
+    for i in xrange(count):
+        function(i)
+    return (time.time() - start) * 1e6 / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--receipts', type=int, default=10000,
+                        help='receipts appended to the journal')
+    parser.add_argument('--cabs', type=int, default=100,
+                        help='cabs the receipts are printed for')
+    parser.add_argument('--segment-size', type=int, default=4 * 1024 * 1024,
+                        help='bytes per journal segment')
+    devices.add_arguments(parser)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    sys.path.insert(0, devices.PLUGINS)
+
+    commands = receipt_commands(options)
+    directory = tempfile.mkdtemp()
+    try:
+        journal = Journal(directory, ('cab_id',), options.segment_size,
+                          segments=sys.maxint)
+        cabs = ['AH{0:07d}'.format(i) for i in range(options.cabs)]
+
+        append = measure(
+            lambda i: journal.append(commands, cab_id=cabs[i % len(cabs)]),
+            options.receipts
+        )
+        latest = measure(lambda i: journal.latest(cab_id=cabs[i % len(cabs)]),
+                         options.receipts)
+        records = journal.latest(options.receipts)
+        read = measure(lambda i: journal.read(records[i]), len(records))
+        journal.close()
+
+        start = time.time()
+        journal = Journal(directory, ('cab_id',), options.segment_size,
+                          segments=sys.maxint)
+        opened = time.time() - start
+        journal.close()
+
+        stored = sum(record.size for record in records) / float(len(records))
+    finally:
+        shutil.rmtree(directory)
+
+    print 'receipts: {0}, {1} bytes, {2:.0f} bytes stored ({3:.1f}%)'.format(
+        len(records), len(commands), stored, 100.0 * stored / len(commands)
+    )
+    print '{0:<16}{1:>12}'.format('operation', 'us')
+    for name, elapsed in (('append', append), ('latest of cab', latest),
+                          ('read', read)):
+        print '{0:<16}{1:>12.1f}'.format(name, elapsed)
+    print 'journal opened in {0:.3f} seconds'.format(opened)
+
+
+if __name__ == '__main__':
+    main()
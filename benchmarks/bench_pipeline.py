@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Print a tall image, converted band by band, and the receipt through a
+simulated printer writing the commands in the thread generating them and
+from a writer thread (pipelined), and report the seconds per job and the
+time to the first byte the printer takes.
+
+The seconds needed to only generate the commands, writing them nowhere,
+and to only write them are reported too: the pipelined job should take
+about the slower of both instead of their sum.
+
+Run it from the project root:
+    python -m benchmarks.bench_pipeline --printer-speed 200000 --pipeline 4
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import sys
+import copy
+import time
+import logging
+import argparse
+
+# io_server imports
+from core.escpos import raster
+from core.escpos.escpos import Escpos
+from benchmarks import devices
+from benchmarks.bench_e2e import COMMANDS
+
+
+class NullPrinter(Escpos):
+    """
+    Printer that discards what it receives and costs nothing
+    """
+
+    def __init__(self, buffered, receive_buffer=4096):
+        self.device = True
+        self.written = 0
+        self._set_buffered(buffered, receive_buffer)
+
+    def _write(self, msg):
+        self.written += len(msg)
+
+    def __del__(self):
+        self.device = None
+
+
+def image_job(height):
+    im = raster.load(devices.LOGO, 512)
+    im = im.resize((512, height))
+
+    def job(printer):
+        printer.dither = raster.FLOYD_STEINBERG
+        printer._convert_image(im)
+        printer.close()
+    return job
+
+
+def receipt_job(options):
+    app = devices.create_application('receipt_manager', options)
+    app.setup()
+    params = COMMANDS['send_receipt'][2]
+    args = (params['driver_name'], params['cab_id'], params['items'],
+            params['promotions'])
+
+    def job(printer):
+        app.open_printer = lambda: printer
+        if not app.print_receipt(*args):
+            raise RuntimeError('The receipt could not be printed')
+    return job
+
+
+def measure(job, create, jobs):
+    """
+    Return the seconds per job, the seconds to the first byte and the
+    bytes written per job
+    """
+    elapsed = first_byte = 0.0
+    written = 0
+    for _ in range(jobs):
+        printer = create()
+        start = time.time()
+        job(printer)
+        elapsed += time.time() - start
+        first_byte += printer.first_byte
+        written += printer.written
+    return elapsed / jobs, first_byte / jobs, written / jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=5,
+                        help='jobs printed by every variant')
+    parser.add_argument('--height', type=int, default=2048,
+                        help='height of the image printed')
+    devices.add_arguments(parser)
+    options = parser.parse_args()
+    if not options.pipeline:
+        options.pipeline = 4
+    options.buffered = True
+
+    logging.basicConfig(level=logging.CRITICAL)
+    sys.path.insert(0, devices.PLUGINS)
+
+    def simulated(pipeline):
+        return lambda: devices.SimulatedPrinter(
+            options.printer_speed, options.transfer_latency, options.buffered,
+            pipeline=pipeline
+        )
+
+    # the time needed to write the commands, already generated
+    def writing(written):
+        data = '\0' * written
+
+        def job(printer):
+            printer._raw(data)
+            printer.close()
+        return job
+
+    workloads = [
+        ('image', image_job(options.height)),
+        ('receipt', receipt_job(copy.copy(options))),
+    ]
+
+    print '{0:<10}{1:<12}{2:>12}{3:>16}'.format(
+        'job', 'variant', 'ms/job', 'first byte ms'
+    )
+    for name, job in workloads:
+        generate, _, written = measure(
+            job, lambda: NullPrinter(options.buffered), options.jobs
+        )
+        write, _, _ = measure(writing(written), simulated(0), options.jobs)
+        print '{0:<10}{1:<12}{2:>12.1f}{3:>16}'.format(
+            name, 'generate', generate * 1000, '-'
+        )
+        print '{0:<10}{1:<12}{2:>12.1f}{3:>16}'.format(
+            name, 'write', write * 1000, '-'
+        )
+        for variant, pipeline in (('serial', 0), ('pipelined', options.pipeline)):
+            elapsed, first_byte, _ = measure(job, simulated(pipeline),
+                                             options.jobs)
+            print '{0:<10}{1:<12}{2:>12.1f}{3:>16.1f}'.format(
+                name, variant, elapsed * 1000, first_byte * 1000
+            )
+
+
+if __name__ == '__main__':
+    main()
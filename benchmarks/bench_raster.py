@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the raster conversion of core.escpos.raster with the historical
+per pixel implementation of Escpos._convert_image: conversion time of
+every dithering mode and whether the "pattern" mode output is byte for
+byte identical to the historical one, with numpy and with the PIL only
+fallback.
+
+Report the bytes saved by raster.compact() feeding the blank rows and
+trimming the blank margins of every image, centered.
+
+Then convert a tall image in bands of several heights and report the
+time until the first band can be sent, the total time and the biggest
+band, which bounds the memory used by the conversion.
+
+Run it from the project root:
+    python -m benchmarks.bench_raster --width 512 --repeat 20 --tall 4096
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import random
+import argparse
+
+# PIL imports
+from PIL import Image
+
+# qrcode imports
+import qrcode
+
+# io_server imports
+from core.escpos import raster
+from core.escpos.constants import S_RASTER_N, TXT_ALIGN_CT
+from benchmarks.devices import LOGO
+
+
+def legacy_convert(im):
+    """
+    Historical Escpos._convert_image and Escpos._print_image, returns the
+    "GS v 0" command they saved with "path_buffer". When printing they
+    sent the 4 bytes header twice, the second copy was printed as dots.
+    """
+    pix_line = ""
+    switch = 0
+    img_size = [0, 0]
+
+    border = 32 - im.size[0] % 32 if im.size[0] % 32 else 0
+    im_left = "0" * (border / 2)
+    im_right = "0" * (border - border / 2)
+
+    for y in range(im.size[1]):
+        img_size[1] += 1
+        pix_line += im_left
+        img_size[0] += len(im_left)
+        for x in range(im.size[0]):
+            img_size[0] += 1
+            RGB = im.getpixel((x, y))
+            im_color = (RGB[0] + RGB[1] + RGB[2])
+            im_pattern = "1X0"
+            pattern_len = len(im_pattern)
+            switch = (switch - 1) * (-1)
+            for x in range(pattern_len):
+                if im_color <= (255 * 3 / pattern_len * (x + 1)):
+                    if im_pattern[x] == "X":
+                        pix_line += "%d" % switch
+                    else:
+                        pix_line += im_pattern[x]
+                    break
+        pix_line += im_right
+        img_size[0] += len(im_right)
+
+    buffer = "%02X%02X%02X%02X" % (
+        ((img_size[0] / img_size[1]) / 8), 0, img_size[1], 0
+    )
+    header = S_RASTER_N + buffer.decode('hex')
+
+    buffer = ""
+    i = 0
+    while i < len(pix_line):
+        buffer += "%02X" % int(pix_line[i:i + 8], 2)
+        i += 8
+    return header + buffer.decode('hex')
+
+
+def images(width):
+    logo = Image.open(LOGO).convert('RGB')
+    height = min(255, logo.size[1] * width / logo.size[0])
+
+    # random gray levels exercise the three ranges of the pattern
+    noise = Image.new('RGB', (width - 3, 100))
+    noise.putdata([
+        (random.randint(0, 255),) * 3 for _ in range((width - 3) * 100)
+    ])
+
+    return [
+        ('logo', logo),
+        ('logo {0}'.format(width), logo.resize((width, height))),
+        ('noise {0}'.format(width - 3), noise),
+    ]
+
+
+def qr_image():
+    # the same QR code the printer prints for a promotion
+    qr_code = qrcode.QRCode(version=4, box_size=4, border=1)
+    qr_code.add_data('Space Center Free Ticket')
+    qr_code.make(fit=True)
+    return qr_code.make_image()._img.convert('RGB')
+
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.time() - start) / repeat
+
+
+def banded(im, mode, height):
+    """
+    Return the seconds until the first band is converted, the seconds
+    needed to convert all of them and the bytes of the biggest band
+    """
+    start = time.time()
+    first = None
+    biggest = 0
+    for band in raster.bands(im, mode, height=height):
+        if first is None:
+            first = time.time() - start
+        biggest = max(biggest, len(raster.command(band)))
+    return first, time.time() - start, biggest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--width', type=int, default=512,
+                        help='width of the resized logo')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='conversions of every image and mode')
+    parser.add_argument('--tall', type=int, default=4096,
+                        help='height of the image converted in bands')
+    args = parser.parse_args()
+    random.seed(0)
+
+    numpy = raster.numpy
+    engines = [('numpy', numpy)] if numpy is not None else []
+    engines.append(('pil', None))
+
+    print '{0:<16}{1:<18}{2:<8}{3:>12}{4:>10}{5:>10}'.format(
+        'image', 'mode', 'engine', 'ms', 'speedup', 'identical'
+    )
+    for name, im in images(args.width):
+        expected, legacy = timed(lambda: legacy_convert(im),
+                                 max(1, args.repeat / 10))
+        print '{0:<16}{1:<18}{2:<8}{3:>12.3f}{4:>10}{5:>10}'.format(
+            name, 'legacy 1X0', '-', legacy * 1000, '1.0x', '-'
+        )
+
+        for engine, module in engines:
+            raster.numpy = module
+            for mode in raster.MODES:
+                result, elapsed = timed(
+                    lambda: raster.command(raster.rasterize(im, mode)),
+                    args.repeat
+                )
+                identical = '-'
+                if mode == raster.PATTERN:
+                    identical = 'yes' if result == expected else 'NO'
+                print '{0:<16}{1:<18}{2:<8}{3:>12.3f}{4:>9.1f}x{5:>10}'.format(
+                    name, mode, engine, elapsed * 1000, legacy / elapsed,
+                    identical
+                )
+        raster.numpy = numpy
+
+    print
+    print '{0:<16}{1:>12}{2:>12}{3:>12}'.format(
+        'image', 'bytes', 'compact', 'saved'
+    )
+    for name, im in images(args.width) + [('qr', qr_image())]:
+        full = compact = 0
+        for band in raster.bands(im):
+            full += len(raster.command(band))
+            compact += len(raster.compact(band, TXT_ALIGN_CT))
+        print '{0:<16}{1:>12}{2:>12}{3:>11.1f}%'.format(
+            name, full, compact, 100.0 * (full - compact) / full
+        )
+
+    tall = images(args.width)[-1][1].resize((args.width, args.tall))
+    print
+    print '{0:<16}{1:<18}{2:>12}{3:>12}{4:>14}'.format(
+        'tall {0}'.format(args.tall), 'band height', 'first ms',
+        'total ms', 'biggest band'
+    )
+    for height in (32, raster.BAND_HEIGHT, args.tall):
+        first, total, biggest = banded(tall, raster.PATTERN, height)
+        print '{0:<16}{1:<18}{2:>12.3f}{3:>12.3f}{4:>14}'.format(
+            '', height, first * 1000, total * 1000, biggest
+        )
+
+
+if __name__ == '__main__':
+    main()
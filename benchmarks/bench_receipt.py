@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Print the receipt of the end to end benchmark through a simulated printer
+and report, per receipt, the transfers sent to the printer, the bytes and
+the wall time. The receipt is printed with the historical imperative
+layout: unbuffered, buffered and buffered sending only the text modes
+that change, and with the receipt manager template, printing the logos
+as images or stored in the printer NV memory (the first receipt stores
+them), one receipt per job or all of them in a single batch job.
+
+Then compare the time needed to generate the receipt commands, without
+sending them, with the imperative layout and with the template.
+
+Run it from the project root:
+    python -m benchmarks.bench_receipt --receipts 20 --transfer-latency 0.0005
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import sys
+import copy
+import time
+import datetime
+import logging
+import argparse
+
+# io_server imports
+from core.utils import lr_justify
+from core.escpos.escpos import Escpos
+from benchmarks import devices
+from benchmarks.bench_e2e import COMMANDS
+
+
+class NullPrinter(Escpos):
+    """
+    Printer that keeps what it receives and costs nothing
+    """
+
+    def __init__(self):
+        self.data = ''
+        self.device = True
+
+    def _write(self, msg):
+        self.data += msg
+
+    def __del__(self):
+        self.device = None
+
+
+def legacy_receipt(printer, header, footer, driver_name, cab_id, items,
+                   promotions, cache=None):
+    """
+    Historical ReceiptManagerApp.print_receipt layout, built imperatively
+    on every receipt
+    """
+    # print header if we have one
+    if header:
+        printer.set(align='center')
+        printer.image(header, cache=cache)
+        printer.line(initial_break=False)
+
+    # print date and time
+    now = datetime.datetime.now()
+    date = datetime.datetime.strftime(now, '%m/%d/%Y')
+    time = datetime.datetime.strftime(now, '%I:%M %p')
+
+    printer.set(align='left')
+    printer.text('DATE: {0} {1}\n'.format(date, time))
+
+    # print driver name and cab id
+    printer.set(align='left')
+    printer.text('DRIVER NAME: {0}\n'.format(driver_name))
+    printer.text('CAB ID: {0}\n'.format(cab_id))
+    printer.line()
+
+    # print items
+    extras = {}
+    subtotal = 0.0
+    for name, (price, itype) in items.iteritems():
+        price = float(price)
+        left = '{0}:'.format(name)
+        right = '{0:.2f}'.format(price)
+        to_print = lr_justify(left, right, 32)
+        if itype in ('barcode', 'qrcode'):
+            printer.set(align='left', type='u2')
+            printer.text(to_print)
+            extras[name] = itype
+        else:
+            printer.set(align='left', type='normal')
+            printer.text(to_print)
+        printer.text('\n')
+        subtotal += price
+    tax = 0.0825 * subtotal
+
+    # print subtotals, taxes and totals
+    printer.text('\n')
+    printer.set(align='left', type='b')
+    printer.text('SUBTOTAL:\t{0:.2f}\n'.format(subtotal))
+    printer.text('TAXES:\t{0:.2f}\n'.format(tax))
+
+    total = subtotal + tax
+    printer.line(initial_break=False)
+    printer.set(align='left', type='b')
+    printer.text('TOTAL:\t{0:.2f}\n'.format(total))
+
+    # print promotions and extras
+    for title, codes in (('PROMOTIONS:', promotions), ('EXTRAS', extras)):
+        if not codes:
+            continue
+
+        printer.text('\n')
+        printer.set(align='left', type='bu2')
+        printer.text('{0}\n\n'.format(title))
+
+        printer.set(align='left', type='bu')
+        for name, ctype in codes.iteritems():
+            if ctype == 'barcode':
+                printer.text('{0}\n'.format(name))
+                printer.barcode(name, 'UPC-A', 128, 2, 'OFF', 'B')
+            elif ctype == 'qrcode':
+                printer.text('{0}\n'.format(name))
+                printer.qr(name, True, qr_escpos_size=4)
+        printer.line()
+
+    # print footer if we have one
+    if footer:
+        printer.line(initial_break=True)
+        printer.set(align='center')
+        printer.image(footer, cache=cache)
+
+    printer.cut()
+
+
+def run(options, receipts, layout='template'):
+    app = devices.create_application('receipt_manager', options)
+    app.setup()
+    params = COMMANDS['send_receipt'][2]
+    args = (params['driver_name'], params['cab_id'], params['items'],
+            params['promotions'])
+
+    start = time.time()
+    if layout == 'batch':
+        if app.print_receipts([params] * receipts) is None:
+            raise RuntimeError('The receipts could not be printed')
+        elapsed = time.time() - start
+        app.teardown()
+        return (app.printer.transfers / float(receipts),
+                app.printer.written / receipts, elapsed / receipts)
+
+    transfers = written = 0
+    for _ in range(receipts):
+        if layout == 'template':
+            if not app.print_receipt(*args):
+                raise RuntimeError('The receipt could not be printed')
+        else:
+            printer = app.open_printer()
+            legacy_receipt(printer, app.header, app.footer, *args,
+                           cache=app.raster_cache)
+            printer.close()
+        transfers += app.printer.transfers
+        written += app.printer.written
+
+    elapsed = time.time() - start
+    app.teardown()
+    return (transfers / float(receipts), written / receipts,
+            elapsed / receipts)
+
+
+def render(options, receipts):
+    """
+    Return the seconds needed to generate the commands of a receipt with
+    the historical layout and with the receipt template
+    """
+    app = devices.create_application('receipt_manager', options)
+    app.setup()
+    params = COMMANDS['send_receipt'][2]
+    args = (params['driver_name'], params['cab_id'], params['items'],
+            params['promotions'])
+
+    start = time.time()
+    for _ in range(receipts):
+        legacy_receipt(NullPrinter(), app.header, app.footer, *args,
+                       cache=app.raster_cache)
+    legacy = (time.time() - start) / receipts
+
+    app.open_printer = NullPrinter
+    start = time.time()
+    for _ in range(receipts):
+        app.print_receipt(*args)
+    template = (time.time() - start) / receipts
+
+    app.teardown()
+    return legacy, template
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--receipts', type=int, default=20,
+                        help='receipts printed by every variant')
+    devices.add_arguments(parser)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    sys.path.insert(0, devices.PLUGINS)
+
+    variants = [
+        ('unbuffered', 'imperative', {'buffered': False,
+                                      'track_state': False}),
+        ('buffered', 'imperative', {'buffered': True, 'track_state': False}),
+        ('buffered+state', 'imperative', {'buffered': True,
+                                          'track_state': True}),
+        ('template', 'template', {'buffered': True, 'track_state': True}),
+        ('template+nv', 'template', {'buffered': True, 'track_state': True,
+                                     'nv_graphics': True}),
+        ('template batch', 'batch', {'buffered': True, 'track_state': True}),
+    ]
+
+    print '{0:<16}{1:>16}{2:>16}{3:>16}'.format(
+        'variant', 'transfers', 'bytes', 'ms/receipt'
+    )
+    for name, layout, overrides in variants:
+        variant = copy.copy(options)
+        vars(variant).update(overrides)
+        transfers, written, elapsed = run(variant, options.receipts, layout)
+        print '{0:<16}{1:>16.1f}{2:>16}{3:>16.3f}'.format(
+            name, transfers, written, elapsed * 1000
+        )
+
+    legacy, template = render(options, options.receipts * 50)
+    print
+    print '{0:<16}{1:>16}'.format('layout', 'ms/receipt')
+    print '{0:<16}{1:>16.3f}'.format('imperative', legacy * 1000)
+    print '{0:<16}{1:>16.3f}'.format('template', template * 1000)
+
+
+if __name__ == '__main__':
+    main()
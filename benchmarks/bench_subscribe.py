@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the polling and the blocking subscriber modes of core.utils.subscribe
+by measuring the CPU used by an idle subscriber and the latency between
+publishing a command and the handler receiving it.
+
+Needs a local redis server, run it from the project root:
+    python -m benchmarks.bench_subscribe --idle 10 --messages 1000
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import os
+import json
+import time
+import argparse
+import threading
+
+# redis imports
+import redis
+
+# io_server imports
+from core.utils import subscribe
+
+CHANNEL = 'benchmarks.subscribe'
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run(blocking, idle, messages):
+    latencies = []
+    done = threading.Event()
+
+    def handler(msg):
+        latencies.append(time.time() - msg['sent'])
+        if len(latencies) == messages:
+            done.set()
+
+    worker = subscribe(CHANNEL, handler, blocking=blocking)
+    time.sleep(0.5)
+
+    # idle cpu usage
+    start_cpu, start = cpu_time(), time.time()
+    time.sleep(idle)
+    idle_cpu = 100.0 * (cpu_time() - start_cpu) / (time.time() - start)
+
+    # command to handler latency, one message at a time so the
+    # measurement does not include the time spent in the queue
+    publisher = redis.StrictRedis()
+    for i in range(messages):
+        count = len(latencies)
+        publisher.publish(CHANNEL, json.dumps({'sent': time.time()}))
+        while len(latencies) == count and not done.is_set():
+            time.sleep(0.0005)
+    done.wait(5)
+    worker.stop()
+
+    return idle_cpu, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--idle', type=float, default=10,
+                        help='seconds to measure the idle cpu usage')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='number of messages used to measure latency')
+    args = parser.parse_args()
+
+    print '{0:<10}{1:>12}{2:>12}{3:>12}{4:>12}'.format(
+        'mode', 'idle cpu %', 'p50 ms', 'p99 ms', 'max ms'
+    )
+    for name, blocking in (('polling', False), ('blocking', True)):
+        idle_cpu, latencies = run(blocking, args.idle, args.messages)
+        print '{0:<10}{1:>12.2f}{2:>12.3f}{3:>12.3f}{4:>12.3f}'.format(
+            name, idle_cpu, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies) * 1000
+        )
+
+
+if __name__ == '__main__':
+    main()
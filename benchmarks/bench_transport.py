@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of the pubsub and the stream transports of
+core.utils.subscribe: publish a burst of commands and measure how long
+it takes until the handler has received all of them.
+
+Needs a local redis server, run it from the project root:
+    python -m benchmarks.bench_transport --messages 10000
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import json
+import time
+import argparse
+import threading
+
+# redis imports
+import redis
+
+# io_server imports
+from core.utils import subscribe
+
+CHANNEL = 'benchmarks.transport'
+
+
+def run(transport, messages, batch):
+    client = redis.StrictRedis()
+    client.delete(CHANNEL)
+
+    received = [0]
+    done = threading.Event()
+
+    def handler(msg):
+        received[0] += 1
+        if received[0] == messages:
+            done.set()
+
+    worker = subscribe(CHANNEL, handler, transport=transport,
+                       maxlen=messages)
+    time.sleep(0.5)
+
+    data = json.dumps({'command': 'read', 'params': {'timeout': 30}})
+    start = time.time()
+    for i in range(0, messages, batch):
+        pipeline = client.pipeline(transaction=False)
+        for _ in range(min(batch, messages - i)):
+            if transport == 'stream':
+                pipeline.xadd(CHANNEL, {'data': data}, maxlen=messages,
+                              approximate=True)
+            else:
+                pipeline.publish(CHANNEL, data)
+        pipeline.execute()
+
+    done.wait(60)
+    elapsed = time.time() - start
+    worker.stop()
+    client.delete(CHANNEL)
+
+    return received[0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=10000,
+                        help='number of messages to publish')
+    parser.add_argument('--batch', type=int, default=100,
+                        help='messages sent in every pipeline')
+    args = parser.parse_args()
+
+    print '{0:<10}{1:>12}{2:>12}{3:>12}'.format(
+        'transport', 'received', 'seconds', 'msg/s'
+    )
+    for transport in ('pubsub', 'stream'):
+        received, elapsed = run(transport, args.messages, args.batch)
+        print '{0:<10}{1:>12}{2:>12.3f}{3:>12.0f}'.format(
+            transport, received, elapsed, received / elapsed
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated devices for the end to end benchmarks: the plugin applications
+run unmodified against a local redis server, only the objects talking to
+the hardware are replaced.
+
+Serve the simulated applications, one process hosting all of them:
+    python -m benchmarks.devices receipt_manager card_reader device_charger
+"""
+__author__ = 'jmrbcu'
+
+# python imports
+import os
+import sys
+import time
+import Queue
+import logging
+import argparse
+
+# io_server imports
+from core.escpos.escpos import Escpos
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGINS = os.path.join(ROOT, 'plugins')
+LOGO = os.path.join(PLUGINS, 'receipt_manager', 'res', 'logo.jpg')
+
+APPLICATIONS = ('receipt_manager', 'card_reader', 'device_charger')
+
+logger = logging.getLogger(__file__)
+
+
+class SimulatedPrinter(Escpos):
+    """
+    ESC/POS printer that discards what it receives, every transfer costs
+    a fixed USB latency plus the time needed to send the bytes at "speed"
+    bytes per second.
+    """
+
+    def __init__(self, speed=20000, transfer_latency=0.0005, buffered=False,
+                 receive_buffer=4096, track_state=True, pipeline=0):
+        self.speed = float(speed)
+        self.transfer_latency = transfer_latency
+        self.track_state = track_state
+        self.written = 0
+        self.device = True
+        self._set_buffered(buffered, receive_buffer)
+        self._set_pipelined(pipeline)
+
+    def _write(self, msg):
+        self.written += len(msg)
+        time.sleep(self.transfer_latency + len(msg) / self.speed)
+
+    def __del__(self):
+        self.device = None
+
+
+class SimulatedReader(object):
+    """
+    Magnetic stripe reader where a card is swiped "swipe" seconds after
+    every read request
+    """
+
+    TRACKS = ['%B4111111111111111^DOE/JOHN^2512101?', ';4111111111111111=2512101?']
+
+    def __init__(self, swipe=0.05):
+        self.swipe = swipe
+
+    def read(self, timeout=20):
+        time.sleep(min(self.swipe, timeout))
+        return list(SimulatedReader.TRACKS)
+
+    def close(self):
+        pass
+
+
+class SimulatedCharger(object):
+    """
+    Serial port of the "USB Switchable Charger", it answers every status
+    request with a status line "latency" seconds later.
+    """
+
+    def __init__(self, latency=0.01, timeout=0.5):
+        self.latency = latency
+        self.timeout = timeout
+        self.charging = False
+        self._lines = Queue.Queue()
+
+    def write(self, data):
+        if data == 'E':
+            self.charging = True
+        elif data == 'D':
+            self.charging = False
+        elif data == 'S':
+            time.sleep(self.latency)
+            self._lines.put('status:{0}\n'.format(
+                'charging' if self.charging else 'idle'
+            ))
+
+    def readline(self):
+        try:
+            return self._lines.get(timeout=self.timeout)
+        except Queue.Empty:
+            return ''
+
+    def close(self):
+        pass
+
+
+def create_application(name, options):
+    """
+    Create the plugin application "name" using simulated devices, the
+    plugins directory must be in sys.path.
+    """
+    if name == 'receipt_manager':
+        from receipt_manager.receipt_manager_app import ReceiptManagerApp
+
+        class App(ReceiptManagerApp):
+            def open_printer(self):
+                # the last printer is kept to read its counters
+                self.printer = SimulatedPrinter(
+                    options.printer_speed, options.transfer_latency,
+                    options.buffered, track_state=options.track_state,
+                    pipeline=options.pipeline
+                )
+                return self.printer
+
+        return App(name, '0', '0', header=options.header,
+                   footer=options.footer, transport=options.transport,
+                   nv_graphics=options.nv_graphics, status_interval=0,
+                   compact_images=options.compact_images)
+
+    if name == 'card_reader':
+        from card_reader.card_reader_app import CardReaderApp
+
+        class App(CardReaderApp):
+            def setup(self):
+                self.reader = SimulatedReader(options.swipe)
+                return True
+
+        return App(name, options.transport)
+
+    if name == 'device_charger':
+        from device_charger.device_charger import DeviceCharger
+
+        class App(DeviceCharger):
+            def setup(self):
+                self.charger = SimulatedCharger(options.charger_latency)
+                self.charger_watcher = self.start_watcher(self.charger)
+                return True
+
+        return App(name, options.transport)
+
+    raise ValueError('Unknown application: {0}'.format(name))
+
+
+def add_arguments(parser):
+    """
+    Add the options of the simulated devices to an argument parser
+    """
+    parser.add_argument('--transport', default='pubsub',
+                        choices=('pubsub', 'stream'),
+                        help='transport used by the applications')
+    parser.add_argument('--printer-speed', type=float, default=20000,
+                        help='printer throughput in bytes per second')
+    parser.add_argument('--transfer-latency', type=float, default=0.0005,
+                        help='cost in seconds of every write to the printer')
+    parser.add_argument('--buffered', action='store_true',
+                        help='send the printer commands in bulk')
+    parser.add_argument('--untracked', action='store_false',
+                        dest='track_state',
+                        help='send every text mode even if it is not needed')
+    parser.add_argument('--pipeline', type=int, default=0,
+                        help='pieces queued for the printer writer thread')
+    parser.add_argument('--nv-graphics', action='store_true',
+                        help='print the logos stored in the printer memory')
+    parser.add_argument('--compact-images', action='store_true',
+                        help='feed the blank rows of the images')
+    parser.add_argument('--header', default=LOGO,
+                        help='receipt header image')
+    parser.add_argument('--footer', default=LOGO,
+                        help='receipt footer image')
+    parser.add_argument('--swipe', type=float, default=0.05,
+                        help='seconds until a card is swiped')
+    parser.add_argument('--charger-latency', type=float, default=0.01,
+                        help='seconds until the charger answers a status')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('applications', nargs='+', choices=APPLICATIONS,
+                        help='applications to serve')
+    add_arguments(parser)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, PLUGINS)
+
+    apps = [create_application(name, options) for name in options.applications]
+    if len(apps) > 1:
+        from application_runner.runtime import Runtime
+        Runtime(apps).run()
+    else:
+        apps[0].run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import uuid
+import heapq
+import logging
+import threading
+
+# io_server imports
+from core.utils import subscribe, message_id
+from core.publisher import get_publisher
+
+logger = logging.getLogger(__file__)
+
+
+class Timeout(Exception):
+    pass
+
+
+def response_channel(channel):
+    """
+    Return the response channel of a command channel,
+    E.g.: "card_reader.commands" -> "card_reader.responses"
+    """
+    return '{0}.responses'.format(channel.rsplit('.', 1)[0])
+
+
+class Call(object):
+    """
+    A command sent by the client that is waiting for its response
+    """
+
+    def __init__(self, msg_id, deadline, callback=None):
+        self.id = msg_id
+        self.deadline = deadline
+        self.callback = callback
+        self.response = None
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """
+        Wait for the response and return it, raise Timeout if it did
+        not arrive before the deadline.
+        """
+        remaining = self.deadline - time.time()
+        if remaining > 0:
+            self._done.wait(remaining)
+
+        if not self._done.is_set() or self.error is not None:
+            raise self.error or Timeout('No response for: {0}'.format(self.id))
+        return self.response
+
+    def _finish(self, response=None, error=None):
+        if self._done.is_set():
+            return
+
+        self.response, self.error = response, error
+        self._done.set()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                logger.error(e)
+
+
+class Client(object):
+    """
+    Send commands to the plugin applications and get their responses.
+    Every command is tagged with a unique "id" that the applications
+    echo back, so concurrent callers get their own response even if
+    every response is broadcasted in the same channel.
+
+    "channels" are the command channels the client is going to use,
+    E.g.: ["receipt_manager.commands", "card_reader.commands"], their
+    response channels are read by a single background thread.
+
+    Usage:
+        client = Client(['card_reader.commands'])
+
+        # wait for the response
+        response = client.call('card_reader.commands', 'read',
+                               {'timeout': 30}, timeout=35)
+
+        # or get it later, or in a callback
+        call = client.call_async('card_reader.commands', 'read',
+                                 {'timeout': 30}, timeout=35)
+        response = call.result()
+    """
+
+    def __init__(self, channels, host='localhost', port=6379, db=0,
+                 password=None, transport='pubsub'):
+        self.channels = set(channels)
+        self.transport = transport
+        self.publisher = get_publisher(host, port, db, password)
+
+        # in-flight calls by id and their deadlines
+        self._calls = {}
+        self._deadlines = []
+        self._lock = threading.Condition()
+        self._closed = False
+
+        handlers = {
+            response_channel(channel): self._on_response
+            for channel in self.channels
+        }
+        self._listener = subscribe(list(handlers), handlers, host, port, db,
+                                   password)
+        self._listener.subscribed.wait(5)
+
+        self._reaper = threading.Thread(target=self._expire,
+                                        name='client-reaper')
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def call(self, channel, command, params=None, timeout=10.0):
+        """
+        Send "command" to "channel" and return its response, raise
+        Timeout if it does not arrive in "timeout" seconds.
+        """
+        return self.call_async(channel, command, params, timeout).result()
+
+    def call_async(self, channel, command, params=None, timeout=10.0,
+                   callback=None):
+        """
+        Send "command" to "channel" without waiting and return a Call,
+        callback(call) is called when the response arrives or the call
+        times out.
+        """
+        if channel not in self.channels:
+            raise ValueError('Unknown channel: {0}'.format(channel))
+
+        msg_id = uuid.uuid4().hex
+        call = Call(msg_id, time.time() + timeout, callback)
+        msg = {'id': msg_id, 'command': command, 'params': params or {}}
+
+        with self._lock:
+            self._calls[msg_id] = call
+            heapq.heappush(self._deadlines, (call.deadline, msg_id))
+            self._lock.notify()
+
+        if self.transport == 'stream':
+            sent = self.publisher.add(channel, msg)
+        else:
+            sent = self.publisher.publish(channel, msg)
+
+        if not sent:
+            with self._lock:
+                self._calls.pop(msg_id, None)
+            call._finish(error=IOError('Could not send: {0}'.format(msg_id)))
+        return call
+
+    def in_flight(self):
+        """
+        Number of calls waiting for a response
+        """
+        with self._lock:
+            return len(self._calls)
+
+    def close(self):
+        self._listener.stop()
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._reaper.join()
+
+    def _on_response(self, msg):
+        msg_id = message_id(msg)
+        with self._lock:
+            call = self._calls.pop(msg_id, None)
+
+        if call is not None:
+            call._finish(response=msg)
+
+    def _expire(self):
+        while True:
+            expired = []
+            with self._lock:
+                while not self._deadlines and not self._closed:
+                    self._lock.wait()
+
+                if self._closed:
+                    return
+
+                deadline, msg_id = self._deadlines[0]
+                now = time.time()
+                if deadline > now:
+                    self._lock.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self._deadlines)
+                call = self._calls.pop(msg_id, None)
+                if call is not None:
+                    expired.append(call)
+
+            for call in expired:
+                call._finish(error=Timeout('No response for: {0}'.format(
+                    call.id
+                )))
@@ -0,0 +1,113 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import json
+import logging
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__file__)
+
+# Wire format:
+#   Plain json messages are sent as they are, so old clients keep working.
+#   Any other codec is sent as: TAG + codec id (1 byte) + payload. TAG is
+#   0xc1, a byte that msgpack never uses and can not start a json text.
+TAG = '\xc1'
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+if fast_json is not None:
+    def _json_dumps(msg):
+        return fast_json.dumps(msg, ensure_ascii=True)
+
+    def _json_loads(data):
+        try:
+            return fast_json.loads(data)
+        except ValueError:
+            # fall back to the standard library on the corner cases
+            # the fast backend rejects, E.g.: big integers
+            return json.loads(data)
+else:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+
+def _msgpack_dumps(msg):
+    if msgpack is None:
+        raise ValueError('msgpack codec is not installed')
+    return msgpack.packb(msg, use_bin_type=False)
+
+
+def _msgpack_loads(data):
+    if msgpack is None:
+        raise ValueError('msgpack codec is not installed')
+    return msgpack.unpackb(data, raw=False)
+
+
+# codec name -> (wire id, dumps, loads)
+_codecs = {
+    JSON: (None, _json_dumps, _json_loads),
+    MSGPACK: ('\x01', _msgpack_dumps, _msgpack_loads),
+}
+_ids = {cid: name for name, (cid, _, _) in _codecs.iteritems() if cid}
+
+# codec used to send the messages of every channel, json by default
+_channels = {}
+
+
+def available():
+    """
+    Return the names of the codecs that can be used in this process
+    """
+    return [JSON] + ([MSGPACK] if msgpack is not None else [])
+
+
+def set_channel_codec(channel, codec):
+    """
+    Send the messages published in "channel" using "codec", receivers
+    detect the codec of every message so only the senders need to know.
+    """
+    if codec not in _codecs:
+        raise ValueError('Unknown codec: {0}'.format(codec))
+    _channels[channel] = codec
+
+
+def channel_codec(channel):
+    return _channels.get(channel, JSON)
+
+
+def encode(msg, codec=JSON):
+    cid, dumps, _ = _codecs[codec]
+    data = dumps(msg)
+    return data if cid is None else TAG + cid + data
+
+
+def decode(data):
+    return decode_message(data)[0]
+
+
+def decode_message(data):
+    """
+    Decode a message encoded by any codec, return the message and the
+    name of the codec it was encoded with.
+    """
+    if data[:1] != TAG:
+        return _json_loads(data), JSON
+
+    try:
+        codec = _ids[data[1:2]]
+    except KeyError:
+        raise ValueError('Unknown codec id: {0!r}'.format(data[1:2]))
+
+    _, _, loads = _codecs[codec]
+    return loads(data[2:]), codec
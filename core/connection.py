@@ -0,0 +1,131 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__file__)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host='localhost', port=6379, db=0):
+    """
+    Return the process wide circuit breaker of the given redis server,
+    it is shared by the subscribers and the publisher, so any plugin can
+    check if redis is reachable: get_breaker().state
+    """
+    key = (host, port, db)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker('{0}:{1}/{2}'.format(host, port, db))
+            _breakers[key] = breaker
+        return breaker
+
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: the n-th delay is a random
+    value between 0 and min(cap, base * factor ** n), so many processes
+    reconnecting at the same time do not hit redis in lockstep.
+    """
+
+    def __init__(self, base=0.1, cap=5.0, factor=2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts = min(self.attempts + 1, 64)
+        return random.uniform(0, delay)
+
+    def wait(self):
+        time.sleep(self.next())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitBreaker(object):
+    """
+    Track the health of a connection:
+        closed: everything works.
+        open: "threshold" consecutive failures happened, callers should
+            not even try until "reset_timeout" seconds have passed.
+        half_open: the reset timeout expired, the next call is a trial,
+            it closes the breaker if it works or opens it again if not.
+
+    Listeners added with add_listener(func) are called with the old and
+    the new state every time it changes.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, threshold=3, reset_timeout=5.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = CircuitBreaker.CLOSED
+        self._opened = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current()
+
+    def allow(self):
+        """
+        Return True if the connection should be used
+        """
+        return self.state != CircuitBreaker.OPEN
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            old = self._current()
+            self._state = CircuitBreaker.CLOSED
+        self._notify(old, CircuitBreaker.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            old = self._current()
+            new = old
+            if old == CircuitBreaker.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                new, self._opened = CircuitBreaker.OPEN, time.time()
+            self._state = new
+        self._notify(old, new)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _current(self):
+        if self._state == CircuitBreaker.OPEN and \
+                time.time() - self._opened >= self.reset_timeout:
+            self._state = CircuitBreaker.HALF_OPEN
+        return self._state
+
+    def _notify(self, old, new):
+        if old == new:
+            return
+
+        logger.info('Connection to redis {0}: {1} -> {2}'.format(
+            self.name, old, new
+        ))
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception as e:
+                logger.error(e)
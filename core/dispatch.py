@@ -0,0 +1,168 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import Queue
+import logging
+import threading
+
+logger = logging.getLogger(__file__)
+
+
+def command_key(msg):
+    """
+    Ordering key that keeps the order of the messages carrying the
+    same command, E.g.: all the "send_receipt" commands in sequence.
+    """
+    try:
+        return msg.get('command')
+    except AttributeError:
+        return None
+
+
+class Dispatcher(object):
+    """
+    Run message handlers in a pool of worker threads instead of the
+    thread reading from redis, so a slow handler does not stall the
+    messages queued behind it.
+
+    When a "key" function is given, every message is routed to the
+    worker selected by key(msg), so messages with the same key (the same
+    device, the same command, etc) are handled one at a time and in the
+    order they arrived. Without a key all the workers share one queue
+    and there are no ordering guarantees.
+
+    Every queue holds at most "max_queue" messages, when a queue is full
+    the "overflow" policy decides what happens:
+        block: the caller waits until there is room for the message,
+            this applies backpressure to the redis reader.
+        drop_new: the new message is discarded.
+        drop_oldest: the oldest queued message is discarded to make
+            room for the new one.
+
+    Dropped messages are counted and passed to "on_drop" if given.
+    """
+
+    BLOCK = 'block'
+    DROP_NEW = 'drop_new'
+    DROP_OLDEST = 'drop_oldest'
+
+    def __init__(self, workers=4, key=None, max_queue=100,
+                 overflow=BLOCK, on_drop=None, name='dispatcher'):
+        if overflow not in (self.BLOCK, self.DROP_NEW, self.DROP_OLDEST):
+            raise ValueError('Invalid overflow policy: {0}'.format(overflow))
+
+        self.key = key
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self.name = name
+        self.dropped = 0
+
+        if key is None:
+            queue = Queue.Queue(max_queue)
+            self._queues = [queue] * workers
+        else:
+            self._queues = [Queue.Queue(max_queue) for _ in range(workers)]
+
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, args=(self._queues[i],),
+                name='{0}-{1}'.format(name, i)
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def dispatch(self, handler, msg, *args, **kwargs):
+        """
+        Queue handler(msg, *args, **kwargs) for execution, return False
+        if the message was dropped because the queue was full.
+        """
+        queue = self._select(msg)
+        job = (handler, msg, args, kwargs)
+
+        if self.overflow == Dispatcher.BLOCK:
+            queue.put(job)
+            return True
+
+        try:
+            queue.put_nowait(job)
+            return True
+        except Queue.Full:
+            pass
+
+        if self.overflow == Dispatcher.DROP_NEW:
+            self._drop(msg)
+            return False
+
+        # drop the oldest message and retry, another thread may fill
+        # the queue again in between, in that case we drop the new one
+        try:
+            _, oldest, _, _ = queue.get_nowait()
+            queue.task_done()
+            self._drop(oldest)
+        except Queue.Empty:
+            pass
+
+        try:
+            queue.put_nowait(job)
+            return True
+        except Queue.Full:
+            self._drop(msg)
+            return False
+
+    def depth(self):
+        """
+        Number of messages waiting to be handled
+        """
+        return sum(queue.qsize() for queue in self.queues())
+
+    def depths(self):
+        """
+        Number of messages waiting in every queue
+        """
+        return [queue.qsize() for queue in self.queues()]
+
+    def queues(self):
+        return self._queues[:1] if self.key is None else self._queues
+
+    def stop(self):
+        for queue in self._queues:
+            queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+    def _select(self, msg):
+        if self.key is None:
+            return self._queues[0]
+        return self._queues[hash(self.key(msg)) % len(self._queues)]
+
+    def _drop(self, msg):
+        with self._lock:
+            self.dropped += 1
+        logger.warning('{0}: queue full, dropping message: {1}'.format(
+            self.name, msg
+        ))
+
+        if self.on_drop is not None:
+            try:
+                self.on_drop(msg)
+            except Exception as e:
+                logger.error(e)
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    return
+
+                handler, msg, args, kwargs = job
+                handler(msg, *args, **kwargs)
+            except Exception as e:
+                logger.error(e)
+            finally:
+                queue.task_done()
@@ -1 +1 @@
-__all__ = ["constants","escpos","exceptions","printer"]
+__all__ = ["cache","constants","escpos","exceptions","graphics","printer","raster","status","template"]
@@ -0,0 +1,157 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+
+# escpos imports
+import raster
+
+logger = logging.getLogger(__file__)
+
+# change it when the cached commands are not valid anymore
+VERSION = 2
+
+
+def compile_image(path, width=None, mode=raster.PATTERN, compact=False,
+                  align=None):
+    """
+    Return the "GS v 0" commands printing the image in "path", resized
+    to "width" dots if given, one command per band. If "compact" is True
+    the blank parts are not sent, see raster.compact().
+    """
+    im = raster.load(path, width)
+    data = []
+    saved = 0
+    for band in raster.bands(im, mode):
+        command = raster.command(band)
+        if compact:
+            compacted = raster.compact(band, align)
+            saved += len(command) - len(compacted)
+            command = compacted
+        data.append(command)
+
+    data = ''.join(data)
+    if compact:
+        logger.info('Image {0}: {1} bytes, {2} bytes saved'.format(
+            path, len(data), saved
+        ))
+    return data
+
+
+class RasterCache(object):
+    """
+    Cache of the printer commands of the images printed in every receipt,
+    E.g.: the header and footer logos.
+
+    The entries are keyed by the image path, its modification time, the
+    target width, the dithering mode and the compaction, so editing the image or the
+    settings never prints a stale raster. The most recently used "size"
+    entries are kept in memory, if "directory" is given every entry is
+    also saved there and survives process restarts.
+
+    Usage:
+        cache = RasterCache('/var/cache/io_server')
+        cache.warm(['header.jpg', 'footer.jpg'])
+        printer.image('header.jpg', cache=cache)
+    """
+
+    def __init__(self, directory=None, size=16):
+        self.directory = directory
+        self.size = size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    logger.error('Raster cache disabled in disk: {0}'.format(e))
+                    self.directory = None
+
+    def get(self, path, width=None, mode=raster.PATTERN, compact=False,
+            align=None):
+        """
+        Return the "GS v 0" commands printing the image in "path", see
+        compile_image()
+        """
+        key = self._key(path, width, mode, compact, align)
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self.hits += 1
+                self._entries[key] = data
+                return data
+
+        data = self._load(key)
+        if data is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            data = compile_image(path, width, mode, compact, align)
+            self._save(key, data)
+
+        with self._lock:
+            self._entries[key] = data
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return data
+
+    def warm(self, paths, width=None, mode=raster.PATTERN, compact=False,
+             align=None):
+        """
+        Load the images in "paths" so the first receipt does not pay for
+        converting them, errors are logged and ignored.
+        """
+        for path in paths:
+            try:
+                self.get(path, width, mode, compact, align)
+            except Exception as e:
+                logger.error('Could not cache image: {0}, {1}'.format(path, e))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _key(self, path, width, mode, compact, align):
+        path = os.path.abspath(path)
+        key = VERSION, path, os.path.getmtime(path), width or None, mode
+        if compact:
+            key += (align,)
+        return key
+
+    def _filename(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, name + '.raster')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _save(self, key, data):
+        if self.directory is None:
+            return
+
+        # write and rename so readers never see a partial file
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self._filename(key))
+        except (IOError, OSError) as e:
+            logger.error('Could not save raster: {0}'.format(e))
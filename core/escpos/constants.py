@@ -11,6 +11,12 @@ CTL_VT     = '\x1b\x64\x04'      # Vertical tab
 HW_INIT    = '\x1b\x40'          # Clear data in buffer and reset modes
 HW_SELECT  = '\x1b\x3d\x01'      # Printer select
 HW_RESET   = '\x1b\x3f\x0a\x00'  # Reset printer hardware
+# Real-time status, the printer answers one byte
+RT_STATUS_PRINTER = '\x10\x04\x01' # Printer status
+RT_STATUS_OFFLINE = '\x10\x04\x02' # Offline cause status
+RT_STATUS_ERROR   = '\x10\x04\x03' # Error cause status
+RT_STATUS_PAPER   = '\x10\x04\x04' # Roll paper sensor status
+RT_OFFLINE        = 0x08              # Printer status: offline
 # Cash Drawer
 CD_KICK_2  = '\x1b\x70\x00'      # Sends a pulse to pin 2 [] 
 CD_KICK_5  = '\x1b\x70\x01'      # Sends a pulse to pin 5 [] 
@@ -74,6 +80,12 @@ S_RASTER_N      = '\x1d\x76\x30\x00' # Set raster image normal size
 S_RASTER_2W     = '\x1d\x76\x30\x01' # Set raster image double width
 S_RASTER_2H     = '\x1d\x76\x30\x02' # Set raster image double height
 S_RASTER_Q      = '\x1d\x76\x30\x03' # Set raster image quadruple
+# NV graphics
+NV_GRAPHICS     = '\x1d\x28\x4c' # Graphics data, up to 64K of parameters
+NV_GRAPHICS_BIG = '\x1d\x38\x4c' # Graphics data, up to 4G of parameters
+NV_STORE        = '\x30\x43\x30' # Define NV graphics in raster format
+NV_PRINT        = '\x30\x45'      # Print NV graphics
+NV_DELETE       = '\x30\x42'      # Delete NV graphics
 # Printing Density
 PD_N50          = '\x1d\x7c\x00' # Printing Density -50%
 PD_N37          = '\x1d\x7c\x01' # Printing Density -37.5%
@@ -12,123 +12,364 @@ except ImportError:
     from PIL import Image
 
 import qrcode
+import sys
 import time
+import Queue
+import struct
+import threading
 
 from constants import *
 from exceptions import *
+from raster import PATTERN, BAND_HEIGHT, bands, compact, resize, command as raster_command
 
 class Escpos:
     """ ESC/POS Printer object """
-    device    = None
-
-
-    def _check_image_size(self, size):
-        """ Check and fix the size of the image to 32 bits """
-        if size % 32 == 0:
-            return (0, 0)
+    device     = None
+    dither     = PATTERN
+    # rows of the image bands converted and sent at a time
+    band_height = BAND_HEIGHT
+    # feed the blank rows of the images and trim their blank margins
+    # instead of sending them, image_saved counts the bytes not sent. The
+    # feeds assume a vertical motion unit of one dot, the images come out
+    # distorted on the printers where it is not, so it is off by default
+    compact_images = False
+    image_saved = 0
+    # text is sent in the encoding of the selected char code table
+    encoding   = 'cp437'
+    transfers  = 0
+    chunk_size = 4096
+    _buffer    = None
+    # flow control, see _send(): with a throughput (bytes per second) the
+    # writes never get more than receive_buffer bytes ahead of the printer
+    receive_buffer = 4096
+    throughput = None
+    _backlog   = 0.0
+    _paced_at  = 0.0
+    # asynchronous transmit, see _set_pipelined(): the pieces are written
+    # by a writer thread while the next commands are generated
+    pipeline   = 0
+    _queue     = None
+    _writer    = None
+    _writer_error = None
+    # seconds from the first command of the last job to the start of the
+    # first write the printer took
+    first_byte = None
+    _job_started = None
+    # send only the text modes the printer is not already in, _state has
+    # the last command sent for every mode, None if it is not known
+    track_state = True
+    _state     = None
+    _defaults  = {
+        'size': TXT_NORMAL, 'bold': TXT_BOLD_OFF, 'underline': TXT_UNDERL_OFF,
+        'font': TXT_FONT_A, 'align': TXT_ALIGN_LT, 'density': None
+    }
+
+
+    def _reset_state(self, known=False):
+        """ Forget the printer state or set it to the power on defaults """
+        if known:
+            self._state = dict(self._defaults)
         else:
-            image_border = 32 - (size % 32)
-            if (image_border % 2) == 0:
-                return (image_border / 2, image_border / 2)
+            self._state = dict.fromkeys(self._defaults)
+
+
+    def _change(self, mode, command):
+        """ Send the command of a text mode if the printer is not in it """
+        """ Return True if the command was sent """
+        if self._state is None:
+            self._reset_state()
+        if self.track_state and self._state[mode] == command:
+            return False
+        self._raw(command)
+        self._state[mode] = command
+        return True
+
+
+    def _set_buffered(self, buffered, chunk_size=4096):
+        """ Buffer the commands and send them in chunk_size pieces """
+        self._buffer = bytearray() if buffered else None
+        self.chunk_size = chunk_size
+
+
+    def _set_flow_control(self, receive_buffer, throughput=None):
+        """ Pace the writes at throughput bytes per second, see _send() """
+        self.receive_buffer = receive_buffer
+        self.throughput = throughput or None
+
+
+    def _set_pipelined(self, pipeline):
+        """ Write the commands from a writer thread, see _send() """
+        """ pipeline is the number of pieces queued at most, 0 writes
+            them in the calling thread """
+        self.pipeline = pipeline or 0
+
+
+    def _write(self, msg):
+        """ Send data to the printer, implemented by every printer """
+        """ Return the bytes written, 0 when the printer did not take
+            them in time, None when all of them were written """
+        raise NotImplementedError()
+
+
+    def _read(self, size):
+        """ Read data from the printer, implemented by the printers that
+            can answer """
+        raise NotImplementedError()
+
+
+    def _send(self, msg):
+        """ Send data to the printer counting the transfers """
+        """ The data is written in chunk_size pieces, paced at the printer
+            throughput once its receive buffer is full. The rest of a
+            piece partially written is sent again. A write that times out
+            raises WriteTimeoutError: the printer may have taken part of
+            it, so sending it again could duplicate commands, the whole
+            job must be sent again """
+        """ When pipelined the pieces are queued and written by the writer
+            thread, the caller waits only when the queue is full, so the
+            job takes the time of the slower of generating and writing
+            the commands instead of the sum of both """
+        size = self.chunk_size
+        for i in range(0, len(msg), size):
+            if self.pipeline:
+                self._enqueue(msg[i:i + size])
             else:
-                return (image_border / 2, (image_border / 2) + 1)
-
-
-    def _print_image(self, line, size, path_buffer = None):
-        """ Print formatted image """
-        i = 0
-        cont = 0
-        buffer = ""
-        buffer_file_output = ""
-
-        buffer = "%02X%02X%02X%02X" % (((size[0]/size[1])/8), 0, size[1], 0)
-        if path_buffer is None:
-            self._raw(S_RASTER_N)
-            self._raw(buffer.decode('hex'))
-        else:
-            buffer_file_output = S_RASTER_N + buffer.decode('hex')
-            buffer = ""
-
-        while i < len(line):
-            hex_string = int(line[i:i+8],2)
-            buffer += "%02X" % hex_string
-            i += 8
-            """ Modification: buffer is not sent line by line anymore
-            but afterwards as a whole which results in much faster
-            printing once the image buffer is created """
+                self._send_piece(msg[i:i + size])
+
+
+    def _send_piece(self, piece):
+        """ Write a piece until the printer takes all of it """
+        """ The printer status is never asked here: in the middle of
+            the commands the request could be taken as their data """
+        while piece:
+            self._pace(len(piece))
+            started = time.time()
+            written = self._write(piece)
+            if written is None:
+                written = len(piece)
+            if not written:
+                raise WriteTimeoutError("%d bytes not sent" % len(piece))
+            if self.first_byte is None and self._job_started is not None:
+                self.first_byte = started - self._job_started
+            self.transfers += 1
+            self._backlog += written
+            piece = piece[written:]
+
+
+    def _enqueue(self, piece):
+        """ Queue a piece for the writer thread, started on demand """
+        if self._writer_error is not None:
+            self._drain()
+        if self._writer is None:
+            self._queue = Queue.Queue(self.pipeline)
+            self._writer = threading.Thread(target=self._write_queue, args=(self._queue,), name='escpos-writer')
+            self._writer.daemon = True
+            self._writer.start()
+        self._queue.put(piece)
+
+
+    def _write_queue(self, queue):
+        """ Writer thread, write the queued pieces until None is queued """
+        """ After an error the pieces are discarded until the error is
+            raised in the thread generating them, see _drain() """
+        while True:
+            piece = queue.get()
+            try:
+                if piece is None:
+                    return
+                if self._writer_error is None:
+                    self._send_piece(piece)
+            except Exception:
+                self._writer_error = sys.exc_info()
+            finally:
+                queue.task_done()
+
+
+    def _drain(self):
+        """ Wait until the queued pieces are written """
+        """ Raise the error the writer thread got, if any """
+        if self._queue is not None:
+            self._queue.join()
+        error, self._writer_error = self._writer_error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+
+    def _stop_writer(self):
+        """ End the writer thread, the queued pieces are written first """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = self._queue = None
+
+
+    def _pace(self, size):
+        """ Wait until the printer has room for size bytes, assuming it
+            processes throughput bytes per second """
+        if not self.throughput:
+            return
+        now = time.time()
+        self._backlog = max(0.0, self._backlog - (now - self._paced_at) * self.throughput)
+        self._paced_at = now
+        excess = self._backlog + size - self.receive_buffer
+        if excess > 0:
+            time.sleep(excess / self.throughput)
+            self._backlog -= excess
+            self._paced_at = time.time()
+
+
+    def status(self, request=RT_STATUS_PRINTER):
+        """ Return the real-time status byte, see RT_STATUS_*, 0 if the
+            printer can not answer """
+        """ The request is processed even when the receive buffer is
+            full, but in the middle of an image it is taken as image data,
+            ask it only between jobs, see status.StatusMonitor """
+        if self._writer is not threading.current_thread():
+            self._drain()
+        try:
+            self._write(request)
+            answer = self._read(1)
+        except NotImplementedError:
+            return 0
+        return ord(answer[0]) if answer else 0
+
+
+    def _raw(self, msg):
+        """ Print any command sent in raw format """
+        if isinstance(msg, unicode):
+            msg = msg.encode(self.encoding, 'replace')
+        if self._job_started is None:
+            self._job_started = time.time()
+            self.first_byte = None
+        if self._buffer is None:
+            self._send(msg)
+            return
+
+        self._buffer += msg
+        if len(self._buffer) >= self.chunk_size:
+            self.flush(partial=True)
+
+
+    def flush(self, partial=False):
+        """ Send the buffered commands """
+        """ The commands are sent in chunk_size pieces, if partial is True
+            the last piece is kept if it is smaller than chunk_size """
+        """ When pipelined a full flush waits until the printer took them """
+        if self._buffer:
+            size = self.chunk_size
+            end = len(self._buffer) / size * size if partial else len(self._buffer)
+            for i in range(0, end, size):
+                self._send(str(self._buffer[i:min(i + size, end)]))
+            del self._buffer[:end]
+        if not partial:
+            self._drain()
+
+
+    def _align(self):
+        """ Return the current justification, None if it is not known """
+        return self._state and self._state['align']
+
+
+    def _raster_command(self, raster):
+        """ Return the commands printing a raster.Raster """
+        """ With compact_images the blank rows are fed and the blank
+            margins trimmed, see raster.compact() """
+        data = raster_command(raster)
+        if not self.compact_images:
+            return data
+        compacted = compact(raster, self._align())
+        self.image_saved += len(data) - len(compacted)
+        return compacted
+
+
+    def _convert_image(self, im, path_buffer = None, mode = None):
+        """ Parse image and prepare it to a printable format """
+        """ mode is the dithering mode, see raster.rasterize(), the
+            printer "dither" attribute is used by default """
+        """ The image is converted and sent in bands of band_height rows,
+            the printer prints a band while the next one is converted """
+        """ If path_buffer is defined the commands are saved for the use
+            with function buffer() instead of being printed """
+        if im.size[0] > 512:
+            print  ("WARNING: Image is wider than 512 and could be truncated at print time ")
 
+        rasters = bands(im, mode or self.dither, height=self.band_height)
         if path_buffer is None:
-            self._raw(buffer.decode("hex"))
+            for raster in rasters:
+                self._raw(self._raster_command(raster))
         else:
-            fb = open(path_buffer, 'w')
-            buffer_file_output += buffer.decode("hex")
-            fb.write(buffer_file_output)
+            fb = open(path_buffer, 'wb')
+            for raster in rasters:
+                fb.write(raster_command(raster))
             fb.close()
             print ("INFO: Image converted to file with buffer content.")
 
-        buffer = ""
-
 
-    def _convert_image(self, im, path_buffer = None):
-        """ Parse image and prepare it to a printable format """
-        pixels   = []
-        pix_line = ""
-        im_left  = ""
-        im_right = ""
-        switch   = 0
-        img_size = [ 0, 0 ]
-
-
-        if im.size[0] > 512:
-            print  ("WARNING: Image is wider than 512 and could be truncated at print time ")
-        if im.size[1] > 255:
-            raise ImageSizeError()
-
-        im_border = self._check_image_size(im.size[0])
-        for i in range(im_border[0]):
-            im_left += "0"
-        for i in range(im_border[1]):
-            im_right += "0"
-
-        for y in range(im.size[1]):
-            img_size[1] += 1
-            pix_line += im_left
-            img_size[0] += im_border[0]
-            for x in range(im.size[0]):
-                img_size[0] += 1
-                RGB = im.getpixel((x, y))
-                im_color = (RGB[0] + RGB[1] + RGB[2])
-                im_pattern = "1X0"
-                pattern_len = len(im_pattern)
-                switch = (switch - 1 ) * (-1)
-                for x in range(pattern_len):
-                    if im_color <= (255 * 3 / pattern_len * (x+1)):
-                        if im_pattern[x] == "X":
-                            pix_line += "%d" % switch
-                        else:
-                            pix_line += im_pattern[x]
-                        break
-                    elif im_color > (255 * 3 / pattern_len * pattern_len) and im_color <= (255 * 3):
-                        pix_line += im_pattern[-1]
-                        break 
-            pix_line += im_right
-            img_size[0] += im_border[1]
-
-        self._print_image(pix_line, img_size, path_buffer)
-
-
-    def image(self,path_img,path_buffer=None):
+    def image(self,path_img,path_buffer=None,mode=None,width=None,cache=None,compact=None):
         """ Open image file """
         """ If path_buffer (output file name) is defined, no image is printed
             but a file for the use with function buffer() is generated """
+        """ width resizes the image keeping its aspect ratio, the command
+            printing it is taken from cache (a cache.RasterCache) if given """
+        """ compact overrides compact_images for this image """
+        if compact is None:
+            compact = self.compact_images
+        if cache is not None and path_buffer is None:
+            self._raw(cache.get(path_img, width, mode or self.dither,
+                                compact, self._align()))
+            return
+
         if path_buffer is not None:
             print "INFO: Opening image file."
         im_open = Image.open(path_img)
         im = im_open.convert("RGB")
+        if width:
+            im = resize(im, width)
         # Convert the RGB image in printable image
         if path_buffer is not None:
             print "INFO: Image conversion to file with buffer content started..."
-        self._convert_image(im,path_buffer)
+        saved, self.compact_images = self.compact_images, compact
+        try:
+            self._convert_image(im,path_buffer,mode)
+        finally:
+            self.compact_images = saved
+
+
+    def _nv_graphics(self, params):
+        """ Send a graphics data command with its parameters """
+        if len(params) <= 0xffff:
+            self._raw(NV_GRAPHICS + struct.pack('<H', len(params)) + params)
+        else:
+            self._raw(NV_GRAPHICS_BIG + struct.pack('<I', len(params)) + params)
+
+
+    def _nv_key(self, key):
+        """ Check an NV graphics key code """
+        if len(key) != 2 or not all(32 <= ord(c) <= 126 for c in key):
+            raise NvKeyError()
+        return str(key)
+
+
+    def nv_store(self, key, raster):
+        """ Store a raster.Raster in the printer NV memory as "key" """
+        """ The NV memory survives power cycles but it can be rewritten a
+            limited number of times, store an image only when it changes.
+            The printer is busy for a while after storing an image """
+        self._nv_graphics(
+            NV_STORE + self._nv_key(key) + '\x01' +
+            struct.pack('<HH', raster.width * 8, raster.height) + '\x31' +
+            raster.data
+        )
+
+
+    def nv_image(self, key):
+        """ Print the image stored in the printer NV memory as "key" """
+        self._nv_graphics(NV_PRINT + self._nv_key(key) + '\x01\x01')
+
+
+    def nv_delete(self, key):
+        """ Delete the image stored in the printer NV memory as "key" """
+        self._nv_graphics(NV_DELETE + self._nv_key(key))
 
 
     def buffer(self,path_buffer=None):
@@ -142,6 +383,8 @@ class Escpos:
             fb = open(path_buffer)
             buffer = fb.read()
             self._raw(buffer)
+            # the file may change any mode
+            self._reset_state()
 
 
     def qr(self,text,use_escpos=False,qr_escpos_size=4,qr_escpos_error_correction=3):
@@ -221,7 +464,7 @@ class Escpos:
     def barcode(self, code, bc, width, height, pos, font):
         """ Print Barcode """
         # Align Bar Code()
-        self._raw(TXT_ALIGN_CT)
+        self._change('align', TXT_ALIGN_CT)
         # Height
         if height >=2 or height <=6:
             self._raw(BARCODE_HEIGHT)
@@ -289,68 +532,52 @@ class Escpos:
 
     def set(self, align='left', font='a', type='normal', width=1, height=1, density=9):
         """ Set text properties """
+        """ With track_state only the properties that are different from
+            the current printer state are sent """
         # Width
         if height == 2 and width == 2:
-            self._raw(TXT_NORMAL)
-            self._raw(TXT_4SQUARE)
+            size = TXT_4SQUARE
         elif height == 2 and width != 2:
-            self._raw(TXT_NORMAL)
-            self._raw(TXT_2HEIGHT)
+            size = TXT_2HEIGHT
         elif width == 2 and height != 2:
-            self._raw(TXT_NORMAL)
-            self._raw(TXT_2WIDTH)
+            size = TXT_2WIDTH
         else: # DEFAULT SIZE: NORMAL
-            self._raw(TXT_NORMAL)
+            size = TXT_NORMAL
+        if self._change('size', size):
+            # ESC ! also turns bold and underline off and selects font A
+            self._state.update(bold=TXT_BOLD_OFF, underline=TXT_UNDERL_OFF,
+                               font=TXT_FONT_A)
         # Type
         if type.upper() == "B":
-            self._raw(TXT_BOLD_ON)
-            self._raw(TXT_UNDERL_OFF)
+            bold, underline = TXT_BOLD_ON, TXT_UNDERL_OFF
         elif type.upper() == "U":
-            self._raw(TXT_BOLD_OFF)
-            self._raw(TXT_UNDERL_ON)
+            bold, underline = TXT_BOLD_OFF, TXT_UNDERL_ON
         elif type.upper() == "U2":
-            self._raw(TXT_BOLD_OFF)
-            self._raw(TXT_UNDERL2_ON)
+            bold, underline = TXT_BOLD_OFF, TXT_UNDERL2_ON
         elif type.upper() == "BU":
-            self._raw(TXT_BOLD_ON)
-            self._raw(TXT_UNDERL_ON)
+            bold, underline = TXT_BOLD_ON, TXT_UNDERL_ON
         elif type.upper() == "BU2":
-            self._raw(TXT_BOLD_ON)
-            self._raw(TXT_UNDERL2_ON)
-        elif type.upper == "NORMAL":
-            self._raw(TXT_BOLD_OFF)
-            self._raw(TXT_UNDERL_OFF)
+            bold, underline = TXT_BOLD_ON, TXT_UNDERL2_ON
+        else: # DEFAULT TYPE: NORMAL
+            bold, underline = TXT_BOLD_OFF, TXT_UNDERL_OFF
+        self._change('bold', bold)
+        self._change('underline', underline)
         # Font
         if font.upper() == "B":
-            self._raw(TXT_FONT_B)
+            self._change('font', TXT_FONT_B)
         else:  # DEFAULT FONT: A
-            self._raw(TXT_FONT_A)
+            self._change('font', TXT_FONT_A)
         # Align
         if align.upper() == "CENTER":
-            self._raw(TXT_ALIGN_CT)
+            self._change('align', TXT_ALIGN_CT)
         elif align.upper() == "RIGHT":
-            self._raw(TXT_ALIGN_RT)
+            self._change('align', TXT_ALIGN_RT)
         elif align.upper() == "LEFT":
-            self._raw(TXT_ALIGN_LT)
+            self._change('align', TXT_ALIGN_LT)
         # Density
-        if density == 0:
-            self._raw(PD_N50)
-        elif density == 1:
-            self._raw(PD_N37)
-        elif density == 2:
-            self._raw(PD_N25)
-        elif density == 3:
-            self._raw(PD_N12)
-        elif density == 4:
-            self._raw(PD_0)
-        elif density == 5:
-            self._raw(PD_P12)
-        elif density == 6:
-            self._raw(PD_P25)
-        elif density == 7:
-            self._raw(PD_P37)
-        elif density == 8:
-            self._raw(PD_P50)
+        densities = (PD_N50, PD_N37, PD_N25, PD_N12, PD_0, PD_P12, PD_P25, PD_P37, PD_P50)
+        if density in range(len(densities)):
+            self._change('density', densities[density])
         else:# DEFAULT: DOES NOTHING
             pass
 
@@ -364,6 +591,7 @@ class Escpos:
             self._raw(PAPER_PART_CUT)
         else: # DEFAULT MODE: FULL CUT
             self._raw(PAPER_FULL_CUT)
+        self.flush()
 
 
     def cashdraw(self, pin):
@@ -380,10 +608,12 @@ class Escpos:
         """ Hardware operations """
         if hw.upper() == "INIT":
             self._raw(HW_INIT)
+            self._reset_state(known=True)
         elif hw.upper() == "SELECT":
             self._raw(HW_SELECT)
         elif hw.upper() == "RESET":
             self._raw(HW_RESET)
+            self._reset_state()
         else: # DEFAULT: DOES NOTHING
             pass
 
@@ -407,6 +637,55 @@ class Escpos:
         elif ctl.upper() == "VT":
             self._raw(CTL_VT)
 
+    def template(self, template, fields):
+        """ Print a compiled template.Template with the given fields """
+        """ Buffered printers get the commands as they are rendered, so
+            the first pieces are sent while the rest is rendered. Return
+            the commands printed """
+        if self._buffer is None:
+            data = template.render(fields)
+            self._raw(data)
+        else:
+            pieces = []
+            def write(piece):
+                pieces.append(piece)
+                self._raw(piece)
+            template.stream(fields, write)
+            data = ''.join(pieces)
+        # the template slots may change any mode
+        self._reset_state()
+        return data
+
+
+    def batch(self, template, documents):
+        """ Print a compiled template.Template once per fields dict in
+            documents, back to back in the same job """
+        """ Every document is rendered before sending it, the ones that
+            can not be rendered are skipped. Return a list with the
+            commands of the documents sent and the exception of the
+            skipped ones. Nothing is flushed in between, finish() sends
+            the rest """
+        results = []
+        for fields in documents:
+            try:
+                data = template.render(fields)
+            except Exception as e:
+                results.append(e)
+                continue
+            self._raw(data)
+            results.append(data)
+        # the template slots may change any mode
+        self._reset_state()
+        return results
+
+
+    def raw(self, data):
+        """ Print commands generated before, E.g.: by Template.render() """
+        self._raw(data)
+        # the commands may change any mode
+        self._reset_state()
+
+
     def line(self, length=32, initial_break=True):
         self.set(align='CENTER')
         if initial_break:
@@ -415,6 +694,45 @@ class Escpos:
         self.text('\n')
         self.set(align='LEFT')
 
-    def close(self):
-        self.hw('RESET')
+    def finish(self):
+        """ End a print job, the printer stays open """
+        try:
+            self.hw('RESET')
+            self.flush()
+        finally:
+            self._job_started = None
+
+
+    def discard(self):
+        """ Drop the commands of a failed job not sent yet """
+        """ The buffer is emptied and the pieces queued for the writer
+            thread are dropped, the piece being written is waited for """
+        if self._buffer is not None:
+            del self._buffer[:]
+        if self._queue is not None:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                self._queue.task_done()
+            self._queue.join()
+        self._writer_error = None
+        self._job_started = None
+
+
+    def close(self, failed=False):
+        """ End the job and the printer """
+        """ If failed is True, E.g.: the job raised, or finishing it fails
+            the commands not sent are discarded instead of sent """
+        try:
+            if not failed:
+                self.finish()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if failed:
+                self.discard()
+            self._stop_writer()
         self.__del__()
@@ -24,6 +24,9 @@ class Error(Exception):
 # 60 = Invalid pin to send Cash Drawer pulse
 # 70 = Invalid number of tab positions
 # 80 = Invalid char code
+# 90 = Invalid NV graphics key code
+# 100 = Printer not found
+# 110 = The printer does not take the data
 
 
 class BarcodeTypeError(Error):
@@ -100,3 +103,33 @@ class CharCodeError(Error):
 
     def __str__(self):
         return "Valid char code must be set"
+
+
+class NvKeyError(Error):
+    def __init__(self, msg=""):
+        Error.__init__(self, msg)
+        self.msg = msg
+        self.resultcode = 90
+
+    def __str__(self):
+        return "NV graphics key codes are 2 chars in the range 32 to 126"
+
+
+class DeviceNotFoundError(Error):
+    def __init__(self, msg=""):
+        Error.__init__(self, msg)
+        self.msg = msg
+        self.resultcode = 100
+
+    def __str__(self):
+        return "Printer not found: %s" % self.msg
+
+
+class WriteTimeoutError(Error):
+    def __init__(self, msg=""):
+        Error.__init__(self, msg)
+        self.msg = msg
+        self.resultcode = 110
+
+    def __str__(self):
+        return "The printer does not take the data: %s" % self.msg
@@ -0,0 +1,137 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import os
+import json
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+
+# escpos imports
+import raster
+
+logger = logging.getLogger(__file__)
+
+
+class NvGraphics(object):
+    """
+    Images stored in the printer NV memory and printed by key code, every
+    print sends a few bytes instead of the whole raster. E.g.: the header
+    and footer logos of the receipts.
+
+    The printer NV memory survives power cycles but it can be rewritten a
+    limited number of times, so the content hash of the image stored with
+    every key is tracked and an image is uploaded again only when its
+    raster changes: the image file was edited or the width or dithering
+    mode changed. If "path" is given the hashes are saved there and
+    survive process restarts, delete the file after replacing the printer.
+
+    Usage:
+        graphics = NvGraphics('/var/cache/io_server/nv_graphics.json')
+        key = graphics.add('header.jpg')
+        stored = graphics.upload(printer)
+        printer.nv_image(key)
+        printer.close()
+        graphics.commit(stored)
+    """
+
+    # key codes are assigned in order, the same image gets the same key
+    KEYS = ['G{0}'.format(i) for i in range(10)]
+
+    def __init__(self, path=None, width=None, mode=raster.PATTERN):
+        self.path = path
+        self.width = width
+        self.mode = mode
+        self.uploads = 0
+        self._images = []
+        self._hashes = {}
+        self._stored = self._load()
+        self._lock = threading.Lock()
+
+    def add(self, image):
+        """
+        Register the image file "image" and return its key code
+        """
+        image = os.path.abspath(image)
+        if image not in self._images:
+            if len(self._images) == len(NvGraphics.KEYS):
+                raise ValueError('Too many NV graphics: {0}'.format(image))
+            self._images.append(image)
+        return NvGraphics.KEYS[self._images.index(image)]
+
+    def upload(self, printer):
+        """
+        Store in the printer the images that are not there yet or changed,
+        return the hashes of the images stored by key. They are known to
+        be in the printer only after commit(), once the job was sent.
+        """
+        stored = {}
+        with self._lock:
+            for key, image in zip(NvGraphics.KEYS, self._images):
+                im, digest = self._hash(image)
+                if self._stored.get(key) == digest:
+                    continue
+
+                logger.info('Storing NV graphics {0}: {1}'.format(key, image))
+                printer.nv_store(key, im or raster.rasterize(
+                    raster.load(image, self.width), self.mode
+                ))
+                stored[key] = digest
+        return stored
+
+    def commit(self, stored):
+        """
+        Remember the images stored by upload() once the printer took them,
+        the ones not committed, E.g.: the job failed, are uploaded again
+        """
+        if not stored:
+            return
+
+        with self._lock:
+            self._stored.update(stored)
+            self.uploads += len(stored)
+            self._save()
+
+    def _hash(self, image):
+        # the raster is converted again only when the file changes
+        key = os.path.getmtime(image), self.width, self.mode
+        cached = self._hashes.get(image)
+        if cached is not None and cached[0] == key:
+            return None, cached[1]
+
+        im = raster.rasterize(raster.load(image, self.width), self.mode)
+        digest = hashlib.sha1(
+            '{0}x{1}:'.format(im.width, im.height) + im.data
+        ).hexdigest()
+        self._hashes[image] = key, digest
+        return im, digest
+
+    def _load(self):
+        if self.path is None:
+            return {}
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.error('Could not load NV graphics: {0}'.format(e))
+        except ValueError as e:
+            logger.error('Invalid NV graphics file: {0}'.format(e))
+        return {}
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        # write and rename so readers never see a partial file
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._stored, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.error('Could not save NV graphics: {0}'.format(e))
@@ -10,6 +10,9 @@ import usb.core
 import usb.util
 import serial
 import socket
+import select
+import errno
+import threading
 
 from escpos import *
 from constants import *
@@ -18,44 +21,96 @@ from exceptions import *
 class Usb(Escpos):
     """ Define USB printer """
 
-    def __init__(self, idVendor, idProduct, interface=0, in_ep=0x82, out_ep=0x01):
+    def __init__(self, idVendor, idProduct, interface=0, in_ep=0x82, out_ep=0x01, buffered=False, receive_buffer=4096, throughput=None, timeout=5000, pipeline=0):
         """
-        @param idVendor  : Vendor ID
-        @param idProduct : Product ID
-        @param interface : USB device interface
-        @param in_ep     : Input end point
-        @param out_ep    : Output end point
+        @param idVendor       : Vendor ID
+        @param idProduct      : Product ID
+        @param interface      : USB device interface
+        @param in_ep          : Input end point
+        @param out_ep         : Output end point
+        @param buffered       : Send the commands in bulk, see Escpos.flush()
+        @param receive_buffer : Printer receive buffer size
+        @param throughput     : Printer bytes per second, see Escpos._send()
+        @param timeout        : Transfers timeout in milliseconds
+        @param pipeline       : Pieces queued for the writer thread, see Escpos._send()
         """
         self.idVendor  = idVendor
         self.idProduct = idProduct
         self.interface = interface
         self.in_ep     = in_ep
         self.out_ep    = out_ep
+        self.timeout   = timeout
         self.open()
+        self._set_buffered(buffered, self._chunk_size(receive_buffer))
+        self._set_flow_control(receive_buffer, throughput)
+        self._set_pipelined(pipeline)
 
 
     def open(self):
         """ Search device on USB tree and set is as escpos device """
+        """ The device is configured only if it is not, configuring or
+            resetting it again interrupts the printer for nothing """
         self.device = usb.core.find(idVendor=self.idVendor, idProduct=self.idProduct)
         if self.device is None:
-            print "Cable isn't plugged in"
+            raise DeviceNotFoundError("%04x:%04x" % (self.idVendor, self.idProduct))
 
-        if self.device.is_kernel_driver_active(0):
+        if self.device.is_kernel_driver_active(self.interface):
             try:
-                self.device.detach_kernel_driver(0)
+                self.device.detach_kernel_driver(self.interface)
             except usb.core.USBError as e:
                 print "Could not detatch kernel driver: %s" % str(e)
 
         try:
-            self.device.set_configuration()
-            self.device.reset()
+            try:
+                self.device.get_active_configuration()
+            except usb.core.USBError:
+                self.device.set_configuration()
+            usb.util.claim_interface(self.device, self.interface)
         except usb.core.USBError as e:
             print "Could not set configuration: %s" % str(e)
 
 
-    def _raw(self, msg):
-        """ Print any command sent in raw format """
-        self.device.write(self.out_ep, msg, self.interface)
+    def _chunk_size(self, receive_buffer):
+        """ Largest multiple of the end point packet size fitting in the
+            printer receive buffer """
+        packet = 64
+        try:
+            config = self.device.get_active_configuration()
+            endpoint = usb.util.find_descriptor(
+                config[(self.interface, 0)],
+                custom_match=lambda e: e.bEndpointAddress == self.out_ep
+            )
+            if endpoint is not None:
+                packet = endpoint.wMaxPacketSize
+        except (usb.core.USBError, KeyError, AttributeError):
+            pass
+        return max(packet, receive_buffer / packet * packet)
+
+
+    def _timed_out(self, error):
+        """ True if a USBError is a transfer timeout """
+        return error.errno == errno.ETIMEDOUT or error.backend_error_code == -7
+
+
+    def _write(self, msg):
+        """ Send data to the printer, return the bytes written """
+        try:
+            return self.device.write(self.out_ep, msg, self.timeout)
+        except usb.core.USBError as e:
+            if self._timed_out(e):
+                return 0
+            raise
+
+
+    def _read(self, size, timeout=500):
+        """ Read data from the printer, '' if it does not answer in
+            timeout milliseconds """
+        try:
+            return self.device.read(self.in_ep, size, timeout).tostring()
+        except usb.core.USBError as e:
+            if self._timed_out(e):
+                return ''
+            raise
 
 
     def __del__(self):
@@ -66,21 +121,178 @@ class Usb(Escpos):
 
 
 
+class UsbSession(object):
+    """ Long lived connection to a USB printer """
+    """ The device is found, configured and claimed once and kept between
+        print jobs: open() checks it with a control transfer and returns
+        the printer, close() on the printer ends the job and keeps the
+        device. After a USBError, E.g.: the printer was unplugged, the
+        device is found again by the next open(). The device is never
+        reset unless reset() is called. Only one job is printed at a time,
+        status() asks the real-time status between jobs.
+
+        Usage:
+            session = UsbSession(0x04b8, 0x0202, buffered=True)
+            printer = session.open()
+            try:
+                printer.text("Hello World\n")
+            except Exception:
+                printer.close(failed=True)
+                raise
+            printer.close()
+    """
+
+    def __init__(self, idVendor, idProduct, interface=0, in_ep=0x82, out_ep=0x01, buffered=False, receive_buffer=4096, throughput=None, timeout=5000, pipeline=0):
+        """ The parameters are the ones of Usb """
+        self.args = (idVendor, idProduct, interface, in_ep, out_ep, buffered, receive_buffer, throughput, timeout, pipeline)
+        self.printer = None
+        self.connects = 0
+        # held from open() until the job ends
+        self.lock = threading.Lock()
+
+
+    def open(self):
+        """ Return the printer ready for a new job """
+        self.lock.acquire()
+        try:
+            return self._connect()
+        except:
+            self.lock.release()
+            raise
+
+
+    def status(self, requests):
+        """ Return the answers to the real-time status requests, see
+            Escpos.status(), None if a job is being printed """
+        """ The requests after one not answered are not sent and
+            answered 0, each one waits for the read timeout """
+        if not self.lock.acquire(False):
+            return None
+        try:
+            printer = self._connect()
+            answers = []
+            for request in requests:
+                answers.append(printer.status(request))
+                if not answers[-1]:
+                    break
+            return answers + [0] * (len(requests) - len(answers))
+        finally:
+            self.lock.release()
+
+
+    def _connect(self):
+        """ Return the printer, found again if it is not valid """
+        if self.printer is not None and not self._valid():
+            self.close()
+        if self.printer is None:
+            self.printer = _SessionUsb(self, *self.args)
+            self.connects += 1
+        return self.printer
+
+
+    def _valid(self):
+        """ Check the device is still there with a GET_STATUS request """
+        if self.printer.failed:
+            return False
+        try:
+            self.printer.device.ctrl_transfer(0x80, 0x00, 0, 0, 2)
+            return True
+        except usb.core.USBError:
+            return False
+
+
+    def reset(self):
+        """ Reset the device, it is found again by the next open() """
+        if self.printer is not None:
+            try:
+                self.printer.device.reset()
+            except usb.core.USBError as e:
+                print "Could not reset device: %s" % str(e)
+            self.close()
+
+
+    def close(self):
+        """ Release the device """
+        if self.printer is not None:
+            try:
+                usb.util.release_interface(self.printer.device, self.printer.interface)
+            except usb.core.USBError:
+                pass
+            self.printer.release()
+            self.printer = None
+
+
+
+class _SessionUsb(Usb):
+    """ USB printer of a UsbSession, close() ends the job only """
+    """ A read error does not make the session reconnect: only the
+        status is read and a printer that can not answer it may print """
+
+    def __init__(self, session, *args):
+        self.session = session
+        self.failed = False
+        Usb.__init__(self, *args)
+
+
+    def _write(self, msg):
+        """ Send data to the printer, the session reconnects after an error """
+        try:
+            return Usb._write(self, msg)
+        except usb.core.USBError:
+            self.failed = True
+            raise
+
+
+    def close(self, failed=False):
+        """ End the job, the printer stays open for the next one """
+        """ If failed is True, E.g.: the job raised, or finishing it fails
+            the commands not sent are discarded instead of sent """
+        try:
+            if not failed:
+                self.finish()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if failed:
+                self.discard()
+            self.session.lock.release()
+
+
+    def release(self):
+        """ End the writer thread and release USB interface """
+        self._stop_writer()
+        Usb.__del__(self)
+
+
+    def __del__(self):
+        """ The session releases the device """
+        pass
+
+
+
 class Serial(Escpos):
     """ Define Serial printer """
 
-    def __init__(self, devfile="/dev/ttyS0", baudrate=9600, bytesize=8, timeout=1):
+    def __init__(self, devfile="/dev/ttyS0", baudrate=9600, bytesize=8, timeout=1, buffered=False, receive_buffer=4096, throughput=None, pipeline=0):
         """
-        @param devfile  : Device file under dev filesystem
-        @param baudrate : Baud rate for serial transmission
-        @param bytesize : Serial buffer size
-        @param timeout  : Read/Write timeout
+        @param devfile        : Device file under dev filesystem
+        @param baudrate       : Baud rate for serial transmission
+        @param bytesize       : Serial buffer size
+        @param timeout        : Read/Write timeout
+        @param buffered       : Send the commands in bulk, see Escpos.flush()
+        @param receive_buffer : Printer receive buffer size
+        @param throughput     : Printer bytes per second, see Escpos._send()
+        @param pipeline       : Pieces queued for the writer thread, see Escpos._send()
         """
         self.devfile  = devfile
         self.baudrate = baudrate
         self.bytesize = bytesize
         self.timeout  = timeout
         self.open()
+        self._set_buffered(buffered, receive_buffer)
+        self._set_flow_control(receive_buffer, throughput)
+        self._set_pipelined(pipeline)
 
 
     def open(self):
@@ -93,9 +305,14 @@ class Serial(Escpos):
             print "Unable to open serial printer on: %s" % self.devfile
 
 
-    def _raw(self, msg):
-        """ Print any command sent in raw format """
-        self.device.write(msg)
+    def _write(self, msg):
+        """ Send data to the printer """
+        return self.device.write(msg)
+
+
+    def _read(self, size):
+        """ Read data from the printer """
+        return self.device.read(size)
 
 
     def __del__(self):
@@ -108,14 +325,21 @@ class Serial(Escpos):
 class Network(Escpos):
     """ Define Network printer """
 
-    def __init__(self,host,port=9100):
+    def __init__(self,host,port=9100,buffered=False,receive_buffer=4096,throughput=None,pipeline=0):
         """
-        @param host : Printer's hostname or IP address
-        @param port : Port to write to
+        @param host           : Printer's hostname or IP address
+        @param port           : Port to write to
+        @param buffered       : Send the commands in bulk, see Escpos.flush()
+        @param receive_buffer : Printer receive buffer size
+        @param throughput     : Printer bytes per second, see Escpos._send()
+        @param pipeline       : Pieces queued for the writer thread, see Escpos._send()
         """
         self.host = host
         self.port = port
         self.open()
+        self._set_buffered(buffered, receive_buffer)
+        self._set_flow_control(receive_buffer, throughput)
+        self._set_pipelined(pipeline)
 
 
     def open(self):
@@ -127,9 +351,16 @@ class Network(Escpos):
             print "Could not open socket for %s" % self.host
 
 
-    def _raw(self, msg):
-        """ Print any command sent in raw format """
-        self.device.send(msg)
+    def _write(self, msg):
+        """ Send data to the printer """
+        self.device.sendall(msg)
+
+
+    def _read(self, size, timeout=1):
+        """ Read data from the printer, '' if it does not answer """
+        if select.select([self.device], [], [], timeout)[0]:
+            return self.device.recv(size)
+        return ''
 
 
     def __del__(self):
@@ -141,12 +372,19 @@ class Network(Escpos):
 class File(Escpos):
     """ Define Generic file printer """
 
-    def __init__(self, devfile="/dev/usb/lp0"):
+    def __init__(self, devfile="/dev/usb/lp0", buffered=False, receive_buffer=4096, throughput=None, pipeline=0):
         """
-        @param devfile : Device file under dev filesystem
+        @param devfile        : Device file under dev filesystem
+        @param buffered       : Send the commands in bulk, see Escpos.flush()
+        @param receive_buffer : Printer receive buffer size
+        @param throughput     : Printer bytes per second, see Escpos._send()
+        @param pipeline       : Pieces queued for the writer thread, see Escpos._send()
         """
         self.devfile = devfile
         self.open()
+        self._set_buffered(buffered, receive_buffer)
+        self._set_flow_control(receive_buffer, throughput)
+        self._set_pipelined(pipeline)
 
 
     def open(self):
@@ -157,9 +395,9 @@ class File(Escpos):
             print "Could not open the specified file %s" % self.devfile
 
 
-    def _raw(self, msg):
-        """ Print any command sent in raw format """
-        self.device.write(msg);
+    def _write(self, msg):
+        """ Send data to the printer """
+        self.device.write(msg)
 
 
     def __del__(self):
@@ -0,0 +1,264 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import itertools
+import collections
+
+# PIL imports
+try:
+    import Image
+    import ImageChops
+    import ImageMath
+except ImportError:
+    from PIL import Image, ImageChops, ImageMath
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# escpos imports
+from constants import S_RASTER_N, TXT_ALIGN_LT, TXT_ALIGN_CT, TXT_ALIGN_RT
+
+# dithering modes
+PATTERN = 'pattern'
+THRESHOLD = 'threshold'
+ORDERED = 'ordered'
+FLOYD_STEINBERG = 'floyd-steinberg'
+MODES = (PATTERN, THRESHOLD, ORDERED, FLOYD_STEINBERG)
+
+# 4x4 bayer matrix used by the ordered dithering
+BAYER = (
+    (0, 8, 2, 10),
+    (12, 4, 14, 6),
+    (3, 11, 1, 9),
+    (15, 7, 13, 5),
+)
+
+# rows of every "GS v 0" band, big images are converted and sent one band
+# at a time so the printer starts printing while the rest is converted
+BAND_HEIGHT = 128
+
+# "ESC J" feeds the paper n dots, with the power on vertical motion unit
+FEED = '\x1b\x4a'
+# bytes of a "GS v 0" header
+HEADER_SIZE = 8
+
+# "width" is the number of bytes of every row, "data" the packed rows,
+# the most significant bit of every byte is the leftmost dot, 1 = black
+Raster = collections.namedtuple('Raster', 'width height data')
+
+
+def padding(width):
+    """
+    Return the white dots added to the left and to the right of a row so
+    its width is a multiple of 32 dots and the image stays centered
+    """
+    border = -width % 32
+    return border / 2, border - border / 2
+
+
+def rasterize(im, mode=PATTERN, threshold=128, top=0):
+    """
+    Convert a PIL image into a Raster, the whole image is processed at
+    once with numpy when it is available or with PIL bulk operations.
+    When "im" is a band of a bigger image "top" is the row where the band
+    starts, the dithering patterns continue from that row.
+
+    Modes:
+        pattern: the historical "1X0" pattern, dark pixels are black,
+            light ones white and the ones in the middle alternate.
+        threshold: pixels darker than "threshold" (0-255) are black.
+        ordered: 4x4 bayer ordered dithering.
+        floyd-steinberg: error diffusion dithering.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown dithering mode: {0}'.format(mode))
+
+    if numpy is not None:
+        return _rasterize_numpy(im, mode, threshold, top)
+    return _rasterize_pil(im, mode, threshold, top)
+
+
+def bands(im, mode=PATTERN, threshold=128, height=BAND_HEIGHT):
+    """
+    Generate the Rasters of the "height" rows bands of an image, every
+    band is converted when it is requested, so the memory used does not
+    depend on the image height and there is no height limit. The images
+    not taller than "height" are a single band. The floyd-steinberg error
+    diffusion starts again in every band.
+    """
+    width, total = im.size
+    for top in xrange(0, total, height):
+        band = im.crop((0, top, width, min(top + height, total)))
+        yield rasterize(band, mode, threshold, top)
+
+
+def load(path, width=None):
+    """
+    Open an image file in RGB mode, resized to "width" dots if given
+    """
+    im = Image.open(path).convert('RGB')
+    if width:
+        im = resize(im, width)
+    return im
+
+
+def resize(im, width):
+    """
+    Resize an image to "width" dots keeping its aspect ratio
+    """
+    height = max(1, int(round(im.size[1] * float(width) / im.size[0])))
+    return im.resize((width, height), Image.ANTIALIAS)
+
+
+def command(raster):
+    """
+    Return the "GS v 0" command printing a raster
+    """
+    return S_RASTER_N + chr(raster.width % 256) + chr(raster.width / 256) + \
+        chr(raster.height % 256) + chr(raster.height / 256) + raster.data
+
+
+def compact(raster, align=None):
+    """
+    Return the commands printing a Raster without sending its blank parts:
+    the runs of blank rows are sent as paper feeds, splitting the image in
+    blocks when a run costs more than a feed and a new block header, and
+    the blank margins of every block are trimmed keeping the image in the
+    same place for the "align" justification (TXT_ALIGN_LT, TXT_ALIGN_CT
+    or TXT_ALIGN_RT), the margins are kept when it is not known.
+    """
+    width = raster.width
+    rows = [
+        raster.data[i:i + width] for i in xrange(0, len(raster.data), width)
+    ]
+    blank = '\x00' * width
+    runs = [
+        (empty, list(group))
+        for empty, group in itertools.groupby(rows, lambda row: row == blank)
+    ]
+
+    output = []
+    block = []
+    for i, (empty, group) in enumerate(runs):
+        # a blank run inside the image costs a new block header too
+        cost = _feed_size(len(group))
+        if 0 < i < len(runs) - 1:
+            cost += HEADER_SIZE
+        if empty and (len(runs) == 1 or len(group) * width > cost):
+            if block:
+                output.append(_block(block, align))
+                block = []
+            output.append(_feed(len(group)))
+        else:
+            block.extend(group)
+    if block:
+        output.append(_block(block, align))
+    return ''.join(output)
+
+
+def _feed_size(dots):
+    return (len(FEED) + 1) * ((dots + 254) / 255)
+
+
+def _feed(dots):
+    feeds = []
+    while dots > 0:
+        feeds.append(FEED + chr(min(dots, 255)))
+        dots -= 255
+    return ''.join(feeds)
+
+
+def _block(rows, align):
+    # blank bytes at both sides of every row
+    left = min(len(row) - len(row.lstrip('\x00')) for row in rows)
+    right = min(len(row) - len(row.rstrip('\x00')) for row in rows)
+    if align == TXT_ALIGN_LT:
+        left = 0
+    elif align == TXT_ALIGN_RT:
+        right = 0
+    elif align == TXT_ALIGN_CT:
+        left = right = min(left, right)
+    else:
+        left = right = 0
+
+    width = len(rows[0]) - left - right
+    data = ''.join(row[left:left + width] for row in rows)
+    return command(Raster(width, len(rows), data))
+
+
+def _pattern_thresholds(width, height, top):
+    # the historical pattern alternates the dots in the middle range
+    # following the pixel index in the whole image, not in the row
+    index = numpy.arange(width * height) + top * width
+    return index.reshape(height, width) % 2 == 0
+
+
+def _rasterize_numpy(im, mode, threshold, top):
+    width, height = im.size
+
+    if mode == PATTERN:
+        rgb = numpy.asarray(im.convert('RGB'), dtype=numpy.uint16)
+        color = rgb.sum(axis=2)
+        dots = (color <= 255) | \
+               ((color <= 510) & _pattern_thresholds(width, height, top))
+    elif mode == FLOYD_STEINBERG:
+        dots = numpy.asarray(_floyd_steinberg(im), dtype=bool)
+    else:
+        gray = numpy.asarray(im.convert('L'), dtype=numpy.int16)
+        if mode == THRESHOLD:
+            dots = gray < threshold
+        else:
+            bayer = (numpy.array(BAYER) * 16 + 8)
+            tiles = numpy.tile(bayer, (height / 4 + 2, width / 4 + 1))
+            dots = gray < tiles[top % 4:top % 4 + height, :width]
+
+    left, right = padding(width)
+    dots = numpy.pad(dots, ((0, 0), (left, right)), 'constant')
+    data = numpy.packbits(dots, axis=1)
+    return Raster(data.shape[1], height, data.tostring())
+
+
+def _rasterize_pil(im, mode, threshold, top):
+    width, height = im.size
+
+    if mode == PATTERN:
+        r, g, b = [
+            channel.convert('I') for channel in im.convert('RGB').split()
+        ]
+        checker = Image.new('I', (width, height))
+        start = top * width
+        checker.putdata([
+            (i + 1) % 2 for i in xrange(start, start + width * height)
+        ])
+        dots = ImageMath.eval(
+            'min(max(256 - (r + g + b), 0), 1) | '
+            '(min(max(511 - (r + g + b), 0), 1) & checker)',
+            r=r, g=g, b=b, checker=checker
+        )
+        dots = dots.convert('L').point(lambda v: 255 if v else 0, '1')
+    elif mode == FLOYD_STEINBERG:
+        dots = _floyd_steinberg(im)
+    else:
+        gray = im.convert('L')
+        if mode == THRESHOLD:
+            dots = gray.point(lambda v: 255 if v < threshold else 0, '1')
+        else:
+            tiles = Image.new('L', (width, height))
+            tiles.putdata([
+                BAYER[y % 4][x % 4] * 16 + 8
+                for y in xrange(top, top + height) for x in xrange(width)
+            ])
+            dots = ImageChops.subtract(tiles, gray)
+            dots = dots.point(lambda v: 255 if v else 0, '1')
+
+    left, right = padding(width)
+    padded = Image.new('1', (left + width + right, height), 0)
+    padded.paste(dots, (left, 0))
+    return Raster(padded.size[0] / 8, height, padded.tobytes())
+
+
+def _floyd_steinberg(im):
+    # PIL dithers to white dots, dither the negative to get black dots
+    return ImageChops.invert(im.convert('L')).convert('1')
@@ -0,0 +1,136 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import logging
+import threading
+import collections
+
+# escpos imports
+from constants import RT_STATUS_PRINTER, RT_STATUS_OFFLINE, RT_STATUS_PAPER, \
+    RT_OFFLINE
+from exceptions import DeviceNotFoundError
+
+logger = logging.getLogger(__file__)
+
+# real-time status bits, see also RT_OFFLINE
+OFFLINE_COVER_OPEN = 0x04
+OFFLINE_PAPER_END = 0x20
+OFFLINE_ERROR = 0x40
+PAPER_NEAR_END = 0x0c
+PAPER_END = 0x60
+
+# the status bytes have the bits 1 and 4 set and the bits 0 and 7 clear
+VALID_MASK = 0x93
+VALID_BITS = 0x12
+
+# "connected" is False when the printer was not found, the other fields
+# are None when the printer does not answer the real-time status
+PrinterStatus = collections.namedtuple(
+    'PrinterStatus',
+    'connected online cover_open paper_near_end paper_out error'
+)
+
+UNKNOWN = PrinterStatus(True, None, None, None, None, None)
+DISCONNECTED = PrinterStatus(False, False, None, None, None, None)
+
+
+def parse(printer, offline, paper):
+    """
+    Return the PrinterStatus of the answers to the printer status, offline
+    cause status and roll paper sensor status requests
+    """
+    if not all(answer & VALID_MASK == VALID_BITS
+               for answer in (printer, offline, paper)):
+        return UNKNOWN
+
+    return PrinterStatus(
+        connected=True,
+        online=not printer & RT_OFFLINE,
+        cover_open=bool(offline & OFFLINE_COVER_OPEN),
+        paper_near_end=bool(paper & PAPER_NEAR_END),
+        paper_out=bool(paper & PAPER_END or offline & OFFLINE_PAPER_END),
+        error=bool(offline & OFFLINE_ERROR)
+    )
+
+
+class StatusMonitor(threading.Thread):
+    """
+    Thread polling the real-time status of the printer of a
+    printer.UsbSession every "interval" seconds between print jobs, the
+    last status is kept in "status" so the jobs that can not be printed
+    are rejected before sending them. callback(status) is called from the
+    thread every time the status changes.
+
+    Only a printer that is not found is DISCONNECTED. A printer that does
+    not answer, E.g.: it does not support the requests or the IN end point
+    is wrong, is UNKNOWN and the receipts are not rejected, it is asked
+    less often, the interval is doubled up to "max_interval" seconds.
+
+    Usage:
+        monitor = StatusMonitor(session, 1.0, on_status)
+        monitor.start()
+        if monitor.status.paper_out:
+            ...
+        monitor.stop()
+    """
+
+    REQUESTS = (RT_STATUS_PRINTER, RT_STATUS_OFFLINE, RT_STATUS_PAPER)
+
+    def __init__(self, session, interval=1.0, callback=None, max_interval=30.0):
+        super(StatusMonitor, self).__init__()
+        self.daemon = True
+        self.session = session
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.callback = callback
+        self.status = UNKNOWN
+        self._delay = interval
+        self._wake = threading.Event()
+        self._stop = False
+
+    def run(self):
+        while not self._stop:
+            self.poll()
+            self._wake.wait(self._delay)
+            self._wake.clear()
+
+    def poll(self):
+        """
+        Ask the printer status, it is not asked while a job is printed
+        """
+        try:
+            answers = self.session.status(StatusMonitor.REQUESTS)
+            if answers is None:
+                return
+            status = parse(*answers)
+        except DeviceNotFoundError as e:
+            logger.debug('Printer not found: {0}'.format(e))
+            status = DISCONNECTED
+        except Exception as e:
+            logger.debug('Printer status not available: {0}'.format(e))
+            status = UNKNOWN
+
+        if status == UNKNOWN:
+            self._delay = min(self._delay * 2, self.max_interval)
+        else:
+            self._delay = self.interval
+
+        if status != self.status:
+            logger.info('Printer status: {0}'.format(status))
+            self.status = status
+            if self.callback is not None:
+                try:
+                    self.callback(status)
+                except Exception as e:
+                    logger.error('Printer status callback: {0}'.format(e))
+
+    def wake(self):
+        """
+        Poll the status now, E.g.: after a job failed
+        """
+        self._wake.set()
+
+    def stop(self):
+        self._stop = True
+        self._wake.set()
+        self.join()
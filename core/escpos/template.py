@@ -0,0 +1,156 @@
+__author__ = 'jmrbcu'
+
+# escpos imports
+from escpos import Escpos
+
+
+class _Field(object):
+    """
+    Text formatted with the fields of the document
+    """
+
+    def __init__(self, fmt, encoding):
+        self.fmt = unicode(fmt)
+        self.encoding = encoding
+
+    def render(self, fields, output):
+        text = self.fmt.format(**fields)
+        output.append(text.encode(self.encoding, 'replace'))
+
+
+class _Command(object):
+    """
+    Commands generated by func(printer, fields) on a scratch printer in
+    the text modes of the template at that point, E.g.: a barcode of a field
+    """
+
+    def __init__(self, func, encoding, state):
+        self.func = func
+        self.encoding = encoding
+        self.state = state
+
+    def render(self, fields, output):
+        printer = _Scratch()
+        printer.encoding = self.encoding
+        if self.state is not None:
+            printer._state = dict(self.state)
+        self.func(printer, fields)
+        output.append(printer.data)
+
+
+class _Section(object):
+    """
+    A template printed for every element of the list in fields[name],
+    the elements are the fields of the template. "templates" is a
+    Template or a dict of them and key(element) selects the one used.
+    """
+
+    def __init__(self, name, templates, key=None):
+        self.name = name
+        self.templates = templates
+        self.key = key
+
+    def render(self, fields, output):
+        for element in fields.get(self.name) or ():
+            template = self.templates
+            if self.key is not None:
+                template = self.templates.get(self.key(element))
+                if template is None:
+                    continue
+            template._render(element, output)
+
+
+class _Stream(object):
+    """
+    Output calling write(commands) with every rendered piece
+    """
+
+    def __init__(self, write):
+        self.append = write
+
+
+class _Scratch(Escpos):
+
+    def __init__(self):
+        self.data = ''
+        self.device = True
+
+    def _write(self, msg):
+        self.data += msg
+
+    def __del__(self):
+        self.device = None
+
+
+class Template(Escpos):
+    """
+    A document layout compiled into printer commands once and printed
+    many times. The layout is declared calling the Escpos methods as if
+    it were a printer, they are recorded as static commands, the parts
+    that change from one document to the next are slots:
+
+        field(fmt): text formatted with the fields, E.g.:
+            "CAB ID: {cab_id}\\n"
+        command(func): commands generated by func(printer, fields)
+        section(name, templates, key): a template printed for every
+            element in fields[name]
+
+    Rendering concatenates the static commands with the slots output, the
+    text modes are only tracked inside the static parts, they are unknown
+    after a command or a section.
+
+    Usage:
+        receipt = Template()
+        receipt.set(align='left', type='b')
+        receipt.field('DRIVER NAME: {driver_name}\\n')
+        receipt.cut()
+
+        printer.template(receipt, {'driver_name': 'Jon Smith'})
+    """
+
+    def __init__(self):
+        self.device = True
+        self._segments = []
+
+    def field(self, fmt):
+        self._segments.append(_Field(fmt, self.encoding))
+
+    def command(self, func):
+        self._segments.append(_Command(func, self.encoding, self._state))
+        self._reset_state()
+
+    def section(self, name, templates, key=None):
+        self._segments.append(_Section(name, templates, key))
+        self._reset_state()
+
+    def render(self, fields):
+        """
+        Return the commands printing the template with "fields"
+        """
+        output = []
+        self._render(fields, output)
+        return ''.join(output)
+
+    def stream(self, fields, write):
+        """
+        Render the template calling write(commands) with every piece as
+        soon as it is rendered
+        """
+        self._render(fields, _Stream(write))
+
+    def _render(self, fields, output):
+        for segment in self._segments:
+            if isinstance(segment, str):
+                output.append(segment)
+            else:
+                segment.render(fields, output)
+
+    def _write(self, msg):
+        # consecutive static commands are merged in one segment
+        if self._segments and isinstance(self._segments[-1], str):
+            self._segments[-1] += msg
+        else:
+            self._segments.append(msg)
+
+    def __del__(self):
+        self.device = None
@@ -0,0 +1,290 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import os
+import json
+import mmap
+import time
+import zlib
+import bisect
+import struct
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__file__)
+
+# record header: magic, flags, id, time, keys size, data size, data crc32
+HEADER = struct.Struct('<2sBQdHIi')
+MAGIC = 'RJ'
+COMPRESSED = 0x01
+
+SUFFIX = '.journal'
+
+Record = collections.namedtuple('Record', 'id time keys segment offset size')
+
+
+class _Segment(object):
+    """
+    Journal file mapped in memory, the records are appended at "end"
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.number = int(os.path.basename(path)[:-len(SUFFIX)])
+        self.file = open(path, 'r+b' if size is None else 'w+b')
+        if size is not None:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.end = 0
+
+    def records(self):
+        """
+        Yield the records found in the segment, "end" is left after the
+        last one, a record with a wrong checksum ends the segment
+        """
+        while self.end + HEADER.size <= len(self.map):
+            magic, _, record_id, stamp, keys_size, size, crc = \
+                HEADER.unpack_from(self.map, self.end)
+            start = self.end + HEADER.size
+            offset = start + keys_size
+            if magic != MAGIC or offset + size > len(self.map) or \
+                    zlib.crc32(self.map[offset:offset + size]) != crc:
+                return
+
+            keys = json.loads(self.map[start:offset])
+            yield Record(record_id, stamp, keys, self, offset, size)
+            self.end = offset + size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Journal(object):
+    """
+    Append only journal of documents, E.g.: the printer commands of every
+    receipt printed, kept in "directory" in segment files of
+    "segment_size" bytes mapped in memory. When a segment is full the
+    next one is created, only the last "segments" are kept.
+
+    Every document gets a sequential id and is indexed by id, by time and
+    by the value of the keys in "indexes" given when it is appended. The
+    documents are compressed with zlib and the records are written data
+    first and header last, with a checksum of the data, so a crash never
+    leaves a partial record readable. The indexes are rebuilt scanning
+    the segments when the journal is opened.
+
+    latest() is constant time: it only looks at the newest entries of
+    the index.
+
+    Usage:
+        journal = Journal('/var/lib/io_server/journal', indexes=('cab_id',))
+        record = journal.append(commands, cab_id='AH0001234')
+        journal.read(journal.latest(cab_id='AH0001234')[0])
+    """
+
+    def __init__(self, directory, indexes=(), segment_size=4 * 1024 * 1024,
+                 segments=8, level=1):
+        self.directory = directory
+        self.indexes = tuple(indexes)
+        self.segment_size = segment_size
+        self.max_segments = segments
+        self.level = level
+
+        self._segments = collections.deque()
+        self._records = {}
+        self._ids = []
+        self._times = []
+        self._keys = dict((name, {}) for name in self.indexes)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+        names = sorted(name for name in os.listdir(directory)
+                       if name.endswith(SUFFIX))
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.getsize(path) < HEADER.size:
+                # a crash while the segment was created leaves it empty,
+                # it can not be mapped and has no records
+                logger.warning('Journal segment removed, it is empty: '
+                               '{0}'.format(path))
+                os.remove(path)
+                continue
+            segment = _Segment(path)
+            self._segments.append(segment)
+            for record in segment.records():
+                self._index(record)
+        while len(self._segments) > self.max_segments:
+            self._drop()
+
+        logger.info('Journal {0}: {1} records in {2} segments'.format(
+            directory, len(self._records), len(self._segments)
+        ))
+
+    def append(self, data, **keys):
+        """
+        Append the document "data" indexed by "keys", return its Record
+        """
+        stored = zlib.compress(data, self.level)
+        keys = dict((name, value) for name, value in keys.iteritems()
+                    if value is not None)
+        encoded = json.dumps(keys)
+
+        with self._lock:
+            # the time index must be sorted, even if the clock goes back
+            stamp = max(time.time(), self._times[-1] if self._times else 0)
+            size = HEADER.size + len(encoded) + len(stored)
+            segment = self._segment(size)
+
+            offset = segment.end
+            start = offset + HEADER.size
+            segment.map[start:start + len(encoded)] = encoded
+            segment.map[start + len(encoded):offset + size] = stored
+            segment.map[offset:start] = HEADER.pack(
+                MAGIC, COMPRESSED, self._next_id, stamp, len(encoded),
+                len(stored), zlib.crc32(stored)
+            )
+            self._flush(segment, offset, size)
+            segment.end = offset + size
+
+            record = Record(self._next_id, stamp, keys, segment,
+                            start + len(encoded), len(stored))
+            self._index(record)
+            return record
+
+    def get(self, record_id):
+        """
+        Return the Record with "record_id", None if it is not kept
+        """
+        return self._records.get(record_id)
+
+    def read(self, record):
+        """
+        Return the document of a Record
+        """
+        with self._lock:
+            data = record.segment.map[record.offset:record.offset + record.size]
+        return zlib.decompress(data)
+
+    def latest(self, count=1, **key):
+        """
+        Return the newest "count" records, newest first, only the ones with
+        the value of one of the indexes if given, E.g.: cab_id='AH0001234'
+        """
+        with self._lock:
+            if key:
+                (name, value), = key.items()
+                ids = self._keys[name].get(value, ())
+            else:
+                ids = self._ids
+            return [self._records[record_id]
+                    for record_id in ids[-1:-count - 1:-1]]
+
+    def between(self, since=None, until=None, count=None, **key):
+        """
+        Return the records appended between the times "since" and "until",
+        oldest first, at most the "count" newest ones, only the ones with
+        the value of one of the indexes if given, E.g.: cab_id='AH0001234'
+        """
+        with self._lock:
+            start = 0 if since is None else bisect.bisect_left(self._times, since)
+            end = len(self._times) if until is None else \
+                bisect.bisect_right(self._times, until)
+
+            # the ids grow with the time, so the id of the first record of
+            # the range bounds the ids of the index too
+            ids = self._ids
+            if key:
+                (name, value), = key.items()
+                ids = self._keys[name].get(value, [])
+                start, end = [
+                    bisect.bisect_left(ids, self._ids[position])
+                    if position < len(self._ids) else len(ids)
+                    for position in (start, end)
+                ]
+
+            if count is not None:
+                start = max(start, end - count)
+            return [self._records[record_id] for record_id in ids[start:end]]
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.map.flush()
+                segment.close()
+            self._segments.clear()
+
+    def _index(self, record):
+        self._records[record.id] = record
+        self._ids.append(record.id)
+        self._times.append(record.time)
+        for name in self.indexes:
+            value = record.keys.get(name)
+            if value is not None:
+                self._keys[name].setdefault(value, []).append(record.id)
+        self._next_id = record.id + 1
+
+    def _segment(self, size):
+        """
+        Return the segment where a record of "size" bytes is appended, a
+        new one when the last one is full
+        """
+        if self._segments:
+            segment = self._segments[-1]
+            if segment.end + size <= len(segment.map):
+                return segment
+            segment.map.flush()
+
+        number = self._segments[-1].number + 1 if self._segments else 1
+        path = os.path.join(self.directory,
+                            '{0:010d}{1}'.format(number, SUFFIX))
+        self._segments.append(_Segment(path, max(self.segment_size, size)))
+        while len(self._segments) > self.max_segments:
+            self._drop()
+        return self._segments[-1]
+
+    def _drop(self):
+        """
+        Delete the oldest segment and its records from the indexes
+        """
+        segment = self._segments.popleft()
+        first = self._segments[0] if self._segments else None
+        kept = bisect.bisect_left(
+            self._ids, self._first_id(first) if first else self._next_id
+        )
+        for record_id in self._ids[:kept]:
+            del self._records[record_id]
+        self._ids, self._times = self._ids[kept:], self._times[kept:]
+
+        oldest = self._ids[0] if self._ids else self._next_id
+        for values in self._keys.itervalues():
+            for value, ids in values.items():
+                ids[:] = ids[bisect.bisect_left(ids, oldest):]
+                if not ids:
+                    del values[value]
+
+        segment.close()
+        os.remove(segment.path)
+        logger.info('Journal segment dropped: {0}'.format(segment.path))
+
+    def _first_id(self, segment):
+        """
+        Id of the first record of a segment, the next id if it is empty
+        """
+        if segment.end:
+            return HEADER.unpack_from(segment.map, 0)[2]
+        return self._next_id
+
+    def _flush(self, segment, offset, size):
+        """
+        Write the pages of a record to the disk
+        """
+        start = offset - offset % mmap.PAGESIZE
+        segment.map.flush(start, offset + size - start)
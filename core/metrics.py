@@ -0,0 +1,249 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import BaseHTTPServer
+
+logger = logging.getLogger(__file__)
+
+# histogram buckets in seconds
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+# metric names
+COMMANDS = 'commands_total'
+ERRORS = 'errors_total'
+QUEUE_WAIT = 'queue_wait_seconds'
+HANDLER = 'handler_seconds'
+DEVICE_IO = 'device_io_seconds'
+SPOOL_DEPTH = 'spool_depth'
+SPOOL_OLDEST = 'spool_oldest_seconds'
+SPOOL_RETRIES = 'spool_retries_total'
+JOB_AGE = 'job_age_seconds'
+DROPPED = 'dropped_total'
+
+
+class Histogram(object):
+    """
+    Fixed buckets histogram, observe() is a binary search and an increment
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the "q" quantile, never bigger
+        than the maximum observed value.
+        """
+        if not self.count:
+            return 0.0
+
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                return self.max
+        return self.max
+
+
+class Registry(object):
+    """
+    Counters, gauges and latency histograms labeled by channel and command
+    """
+
+    def __init__(self, prefix='io_server'):
+        self.prefix = prefix
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, channel, command, value=1):
+        key = (name, channel, command)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, channel, command, value):
+        key = (name, channel, command)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, channel, command, seconds):
+        key = (name, channel, command)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, channel, command):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, channel, command, time.time() - start)
+
+    def snapshot(self):
+        """
+        Return a flat dict with all the metrics, histograms are summarized
+        by their count, sum, max and approximated p50 and p99.
+        """
+        result = {}
+        with self._lock:
+            for values in (self._counters, self._gauges):
+                for (name, channel, command), value in values.iteritems():
+                    result[self._field(name, channel, command)] = value
+
+            for key, histogram in self._histograms.iteritems():
+                field = self._field(*key)
+                result[field + ':count'] = histogram.count
+                result[field + ':sum'] = round(histogram.sum, 6)
+                result[field + ':max'] = round(histogram.max, 6)
+                result[field + ':p50'] = histogram.quantile(0.5)
+                result[field + ':p99'] = histogram.quantile(0.99)
+        return result
+
+    def prometheus(self):
+        """
+        Return all the metrics in the prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters),
+                                 ('gauge', self._gauges)):
+                for name in sorted(set(key[0] for key in values)):
+                    metric = '{0}_{1}'.format(self.prefix, name)
+                    lines.append('# TYPE {0} {1}'.format(metric, kind))
+                    for key, value in sorted(values.iteritems()):
+                        if key[0] == name:
+                            lines.append('{0}{{{1}}} {2}'.format(
+                                metric, self._labels(*key[1:]), value
+                            ))
+
+            for name in sorted(set(key[0] for key in self._histograms)):
+                metric = '{0}_{1}'.format(self.prefix, name)
+                lines.append('# TYPE {0} histogram'.format(metric))
+                for key, histogram in sorted(self._histograms.iteritems()):
+                    if key[0] != name:
+                        continue
+
+                    labels, cumulative = self._labels(*key[1:]), 0
+                    bounds = [repr(b) for b in histogram.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                            metric, labels, bound, cumulative
+                        ))
+                    lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                        metric, labels, histogram.sum
+                    ))
+                    lines.append('{0}_count{{{1}}} {2}'.format(
+                        metric, labels, histogram.count
+                    ))
+
+        return '\n'.join(lines) + '\n'
+
+    def _field(self, name, channel, command):
+        return '{0}{{{1},{2}}}'.format(name, channel, command)
+
+    def _labels(self, channel, command):
+        return 'channel="{0}",command="{1}"'.format(
+            _escape(channel), _escape(command)
+        )
+
+
+def _escape(value):
+    """
+    Escape a label value of the prometheus text format, the commands come
+    from the clients and can hold any character
+    """
+    return '{0}'.format(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+# process wide registry
+registry = Registry()
+inc = registry.inc
+gauge = registry.gauge
+observe = registry.observe
+timer = registry.timer
+
+
+def start_exporters(name, interval=10.0, port=None, host='localhost',
+                    redis_port=6379, db=0, password=None):
+    """
+    Export the process metrics every "interval" seconds as a redis hash
+    called "io_server.metrics.<name>" and, if "port" is given, serve them
+    in the prometheus text format at http://127.0.0.1:<port>/metrics
+    """
+    # avoid a circular import, the publisher is not needed by the registry
+    from core.publisher import get_publisher
+
+    publisher = get_publisher(host, redis_port, db, password)
+    key = '{0}.metrics.{1}'.format(registry.prefix, name)
+
+    def export():
+        while True:
+            time.sleep(interval)
+            snapshot = registry.snapshot()
+            for field, value in publisher.stats().iteritems():
+                snapshot['publisher:{0}'.format(field)] = value
+            snapshot['updated'] = time.time()
+
+            try:
+                publisher.client.hmset(key, snapshot)
+            except Exception as e:
+                logger.error('Error exporting metrics: {0}'.format(e))
+
+    thread = threading.Thread(target=export, name='metrics-exporter')
+    thread.daemon = True
+    thread.start()
+
+    if port:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='metrics-server')
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving metrics in: http://127.0.0.1:{0}/metrics'.format(
+            port
+        ))
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,266 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import logging
+import itertools
+import threading
+import collections
+
+# redis imports
+import redis
+
+# io_server imports
+from core import codec
+from core.connection import Backoff, get_breaker
+
+logger = logging.getLogger(__file__)
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(host='localhost', port=6379, db=0, password=None):
+    """
+    Return the process wide publisher for the given redis server, it is
+    created the first time it is requested.
+    """
+    key = (host, port, db)
+    with _publishers_lock:
+        publisher = _publishers.get(key)
+        if publisher is None:
+            publisher = Publisher(host, port, db, password)
+            _publishers[key] = publisher
+        return publisher
+
+
+class Publisher(object):
+    """
+    Publish messages in redis channels using one connection pool for
+    the whole process, they are encoded with the codec configured for
+    every channel, see core.codec.
+
+    Messages published with coalesce=True are not sent right away, they
+    are queued and sent together in a single pipeline once no other
+    message has been queued for "idle" seconds, when "max_batch" messages
+    are waiting or when the first of them has waited "max_delay" seconds.
+    Messages published without coalescing flush the queued ones in the
+    same round trip, so the order between both kinds is preserved.
+
+    When redis can not be reached the messages are kept in an outbound
+    buffer of at most "max_buffer" messages (the oldest are dropped when
+    it is full) and a background thread sends them, in order, once redis
+    is back. New messages go to the buffer while it is not empty or the
+    circuit breaker of the server is open. The messages are sent by one
+    flush at a time, so the ones buffered after a failed send never go
+    behind the messages published meanwhile.
+
+    stats() returns the number of published, buffered and dropped
+    messages, batches and errors and the publish latency: the time since
+    publish() is called until redis acknowledges the message.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 idle=0.005, max_delay=0.05, max_batch=100, max_buffer=1000):
+        self.pool = redis.ConnectionPool(
+            host=host, port=port, db=db, password=password
+        )
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+        self.breaker = get_breaker(host, port, db)
+        self.idle = idle
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+        self._outbox = collections.deque()
+        self._replay_wakeup = threading.Event()
+        self._replayer = None
+        self._dropped = 0
+
+        self._stats_lock = threading.Lock()
+        self._messages = 0
+        self._batches = 0
+        self._errors = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def publish(self, channel, msg, coalesce=False):
+        """
+        Publish the dict "msg" in "channel", messages that can not be
+        sent now are buffered and sent later. Return True if the message
+        was sent, False if it was buffered and None if it was queued to
+        be coalesced with the next ones.
+        """
+        item = (channel, codec.encode(msg, codec.channel_codec(channel)),
+                time.time())
+
+        if coalesce:
+            with self._lock:
+                self._pending.append(item)
+                full = len(self._pending) >= self.max_batch
+                self._start_flusher()
+
+            if not full:
+                self._wakeup.set()
+                return None
+            return self.flush()
+
+        return self.flush([item])
+
+    def add(self, stream, msg, maxlen=1000):
+        """
+        Add the dict "msg" to the redis stream "stream", keeping about
+        "maxlen" messages in it, return False if it could not be added.
+        """
+        try:
+            data = codec.encode(msg, codec.channel_codec(stream))
+            self.client.xadd(stream, {'data': data},
+                             maxlen=maxlen, approximate=True)
+            return True
+        except Exception as e:
+            logger.error('Error adding message to {0}: {1}'.format(stream, e))
+            return False
+
+    def flush(self, items=None):
+        """
+        Send the queued messages followed by "items" in one round trip,
+        return False if they had to be buffered.
+        """
+        with self._flush_lock:
+            with self._lock:
+                items = self._pending + (items or [])
+                self._pending = []
+
+                if not items:
+                    return True
+
+                # keep the order behind the buffered messages
+                if self._outbox or not self.breaker.allow():
+                    self._buffer(items)
+                    return False
+
+            if self._send(items):
+                return True
+
+            # no other flush buffered messages meanwhile, they are the
+            # first ones of the buffer
+            with self._lock:
+                self._buffer(items)
+            return False
+
+    def stats(self):
+        with self._stats_lock:
+            count = self._messages
+            return {
+                'messages': count,
+                'batches': self._batches,
+                'errors': self._errors,
+                'pending': len(self._pending),
+                'buffered': len(self._outbox),
+                'dropped': self._dropped,
+                'latency_avg': self._latency_total / count if count else 0.0,
+                'latency_max': self._latency_max,
+            }
+
+    def _send(self, items):
+        try:
+            if len(items) == 1:
+                channel, data, _ = items[0]
+                self.client.publish(channel, data)
+            else:
+                pipeline = self.client.pipeline(transaction=False)
+                for channel, data, _ in items:
+                    pipeline.publish(channel, data)
+                pipeline.execute()
+        except Exception as e:
+            logger.error('Error publishing {0} messages: {1}'.format(
+                len(items), e
+            ))
+            if isinstance(e, redis.ConnectionError):
+                self.breaker.failure()
+            with self._stats_lock:
+                self._errors += len(items)
+            return False
+
+        self.breaker.success()
+        now = time.time()
+        with self._stats_lock:
+            self._batches += 1
+            self._messages += len(items)
+            for _, _, queued in items:
+                latency = now - queued
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+        return True
+
+    def _buffer(self, items):
+        """
+        Keep "items" to send them later, must be called holding the lock
+        """
+        self._outbox.extend(items)
+
+        while len(self._outbox) > self.max_buffer:
+            self._outbox.popleft()
+            self._dropped += 1
+            logger.warning('Outbound buffer full, dropping oldest message')
+
+        self._replay_wakeup.set()
+        if self._replayer is None:
+            self._replayer = threading.Thread(target=self._replay,
+                                              name='publisher-replayer')
+            self._replayer.daemon = True
+            self._replayer.start()
+
+    def _replay(self):
+        backoff = Backoff()
+        while True:
+            with self._lock:
+                batch = list(itertools.islice(self._outbox, self.max_batch))
+                if not batch:
+                    self._replay_wakeup.clear()
+
+            if not batch:
+                self._replay_wakeup.wait()
+                continue
+
+            time.sleep(backoff.next())
+            if not self.breaker.allow() or not self._send(batch):
+                continue
+
+            backoff.reset()
+            with self._lock:
+                # some of them could have been dropped in the meantime
+                for item in batch:
+                    if self._outbox and self._outbox[0] is item:
+                        self._outbox.popleft()
+
+            logger.info('Sent {0} buffered messages'.format(len(batch)))
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+
+        self._flusher = threading.Thread(target=self._flush_on_idle,
+                                         name='publisher-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_on_idle(self):
+        while True:
+            self._wakeup.wait()
+
+            # wait until the burst is over
+            deadline = time.time() + self.max_delay
+            while True:
+                self._wakeup.clear()
+                timeout = min(self.idle, deadline - time.time())
+                if timeout <= 0 or not self._wakeup.wait(timeout):
+                    break
+
+            self.flush()
@@ -0,0 +1,317 @@
+__author__ = 'jmrbcu'
+
+# python imports
+import time
+import json
+import logging
+import threading
+import collections
+
+# redis imports
+import redis
+
+# io_server imports
+from core import metrics
+from core.connection import Backoff, get_breaker
+
+logger = logging.getLogger(__file__)
+
+Job = collections.namedtuple('Job', 'id lane payload key attempts created')
+
+# states of a job submitted with an idempotency key, see Spooler.state()
+PENDING, DONE = 'pending', 'done'
+
+
+class Spooler(object):
+    """
+    Durable job queue kept in redis, the jobs are run one at a time by
+    handler(job) in a background thread, in the order they were
+    submitted, the ones in the first "lanes" before the ones in the next,
+    E.g.: a cash drawer kick before a long receipt queued earlier.
+
+    A job succeeds when the handler returns True, when it returns False
+    or raises it is run again after a backoff of "backoff" seconds
+    doubled on every attempt, up to "max_backoff", at most "retries"
+    times. on_done(job, success) is called once the job succeeded or ran
+    out of retries. A job raising one of the "fatal" exceptions fails
+    right away, E.g.: a malformed payload that fails on every attempt.
+
+    Jobs submitted with a "key" are idempotent: while the key is known,
+    for "dedup_ttl" seconds, submitting it again returns the first job
+    instead of queuing a new one. The key is forgotten when its job
+    fails, so the client can submit it again, see state().
+
+    The jobs survive process restarts: the ones running when the process
+    died are run again when it starts, so a job can run more than once.
+
+    Redis keys, all prefixed by "name":
+        <name>:job:<id>: hash with the job
+        <name>:lane:<lane>: list of the queued job ids
+        <name>:running: list of the job ids being run
+        <name>:delayed: sorted set of the job ids waiting to be retried,
+            scored by the time they are due
+        <name>:dedup:<key>: job id of an idempotency key
+
+    The depth and the age of the oldest job of every lane are exported
+    as the SPOOL_DEPTH and SPOOL_OLDEST metrics, the time from submit to
+    completion as JOB_AGE, see core.metrics.
+
+    Usage:
+        spooler = Spooler('receipts', print_job, lanes=('high', 'normal'))
+        spooler.start()
+        spooler.submit({'text': 'Hello'}, 'normal', key='receipt-1')
+        spooler.stop()
+    """
+
+    def __init__(self, name, handler, lanes=('high', 'normal', 'low'),
+                 retries=3, backoff=1.0, max_backoff=60.0, dedup_ttl=3600,
+                 on_done=None, poll=1.0, fatal=(), host='localhost', port=6379,
+                 db=0, password=None):
+        self.name = name
+        self.handler = handler
+        self.lanes = tuple(lanes)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dedup_ttl = dedup_ttl
+        self.on_done = on_done
+        self.poll = poll
+        self.fatal = tuple(fatal)
+        self.client = redis.StrictRedis(host, port, db, password)
+        self.breaker = get_breaker(host, port, db)
+
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._thread = None
+
+    def submit(self, payload, lane='normal', key=None):
+        """
+        Queue a job with the dict "payload" in "lane", return its id and
+        False, or the id of the job of "key" and True if it is known.
+        """
+        if lane not in self.lanes:
+            raise ValueError('Invalid lane: {0}'.format(lane))
+
+        job_id = str(self.client.incr(self._key('next_id')))
+        if key is not None:
+            dedup = self._key('dedup', key)
+            while not self.client.set(dedup, job_id, nx=True,
+                                      ex=self.dedup_ttl):
+                # it could expire between both calls
+                existing = self.client.get(dedup)
+                if existing is not None:
+                    return existing, True
+
+        pipeline = self.client.pipeline()
+        pipeline.hmset(self._key('job', job_id), {
+            'lane': lane,
+            'payload': json.dumps(payload),
+            'key': '' if key is None else key,
+            'attempts': 0,
+            'created': repr(time.time())
+        })
+        pipeline.lpush(self._key('lane', lane), job_id)
+        pipeline.execute()
+
+        self._wakeup.set()
+        return job_id, False
+
+    def state(self, job_id, key):
+        """
+        Return PENDING while the job of the idempotency key "key" is queued,
+        running or waiting to be retried, DONE once it succeeded and None
+        if it failed or the key was forgotten
+        """
+        pipeline = self.client.pipeline()
+        pipeline.exists(self._key('job', job_id))
+        pipeline.get(self._key('dedup', key))
+        exists, known = pipeline.execute()
+        if known != job_id:
+            return None
+        return PENDING if exists else DONE
+
+    def stats(self):
+        """
+        Return the depth and the age in seconds of the oldest job of every
+        lane and the number of jobs delayed and running
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        for lane in self.lanes:
+            pipeline.llen(self._key('lane', lane))
+            pipeline.lindex(self._key('lane', lane), -1)
+        pipeline.zcard(self._key('delayed'))
+        pipeline.llen(self._key('running'))
+        results = pipeline.execute()
+
+        oldest = [job_id for job_id in results[1:-2:2] if job_id is not None]
+        pipeline = self.client.pipeline(transaction=False)
+        for job_id in oldest:
+            pipeline.hget(self._key('job', job_id), 'created')
+        created = dict(zip(oldest, pipeline.execute()))
+
+        now, stats = time.time(), {}
+        for i, lane in enumerate(self.lanes):
+            depth, job_id = results[2 * i:2 * i + 2]
+            age = now - float(created[job_id]) if created.get(job_id) else 0.0
+            stats[lane] = {'depth': depth, 'oldest': age}
+        stats['delayed'], stats['running'] = results[-2:]
+        return stats
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work,
+                                        name='spooler-{0}'.format(self.name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _work(self):
+        backoff, recovered = Backoff(), False
+        while not self._stop:
+            try:
+                if not recovered:
+                    self._recover()
+                    recovered = True
+
+                self._promote()
+                job = self._next()
+                if job is not None:
+                    self._run(job)
+                self._export()
+
+                if job is None:
+                    self._wakeup.wait(self._idle())
+                    self._wakeup.clear()
+
+                backoff.reset()
+                self.breaker.success()
+            except redis.ConnectionError as e:
+                self.breaker.failure()
+                delay = backoff.next()
+                logger.error(('Spooler {0} can not reach redis, retrying in '
+                              '{1:.2f} seconds: {2}').format(self.name, delay, e))
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+            except Exception as e:
+                logger.error('Spooler {0}: {1}'.format(self.name, e))
+                self._wakeup.wait(backoff.next())
+                self._wakeup.clear()
+
+    def _recover(self):
+        """
+        Queue again, first in their lanes, the jobs that were running
+        when the process died
+        """
+        running = self._key('running')
+        while True:
+            job_id = self.client.lindex(running, -1)
+            if job_id is None:
+                return
+
+            lane = self.client.hget(self._key('job', job_id), 'lane')
+            pipeline = self.client.pipeline()
+            pipeline.rpop(running)
+            if lane in self.lanes:
+                pipeline.rpush(self._key('lane', lane), job_id)
+            pipeline.execute()
+            logger.warning('Job {0} interrupted, queued again'.format(job_id))
+
+    def _promote(self):
+        """
+        Queue the delayed jobs that are due, first in their lanes
+        """
+        delayed = self._key('delayed')
+        for job_id in self.client.zrangebyscore(delayed, '-inf', time.time()):
+            lane = self.client.hget(self._key('job', job_id), 'lane')
+            if self.client.zrem(delayed, job_id) and lane in self.lanes:
+                self.client.rpush(self._key('lane', lane), job_id)
+
+    def _idle(self):
+        """
+        Seconds to wait for new jobs: the poll interval or until the next
+        delayed job is due
+        """
+        due = self.client.zrange(self._key('delayed'), 0, 0, withscores=True)
+        if due:
+            return max(0.0, min(self.poll, due[0][1] - time.time()))
+        return self.poll
+
+    def _next(self):
+        """
+        Move the next job to the running list and return it, None if
+        there are no jobs
+        """
+        running = self._key('running')
+        for lane in self.lanes:
+            while True:
+                job_id = self.client.rpoplpush(self._key('lane', lane), running)
+                if job_id is None:
+                    break
+
+                fields = self.client.hgetall(self._key('job', job_id))
+                if fields:
+                    return Job(
+                        job_id, lane, json.loads(fields['payload']),
+                        fields['key'] or None, int(fields['attempts']),
+                        float(fields['created'])
+                    )
+
+                logger.error('Job {0} lost, discarded'.format(job_id))
+                self.client.lrem(running, 1, job_id)
+        return None
+
+    def _run(self, job):
+        retry = True
+        try:
+            success = bool(self.handler(job))
+        except self.fatal as e:
+            logger.error('Job {0} failed, not retried: {1!r}'.format(job.id, e))
+            success = retry = False
+        except Exception as e:
+            logger.error('Job {0} failed: {1}'.format(job.id, e))
+            success = False
+
+        attempts = job.attempts + 1
+        if not success and retry and attempts <= self.retries:
+            delay = min(self.max_backoff, self.backoff * 2 ** job.attempts)
+            pipeline = self.client.pipeline()
+            pipeline.hincrby(self._key('job', job.id), 'attempts', 1)
+            pipeline.zadd(self._key('delayed'), {job.id: time.time() + delay})
+            pipeline.lrem(self._key('running'), 1, job.id)
+            pipeline.execute()
+            metrics.inc(metrics.SPOOL_RETRIES, self.name, job.lane)
+            logger.warning('Job {0} retried in {1:.1f} seconds'.format(
+                job.id, delay
+            ))
+            return
+
+        pipeline = self.client.pipeline()
+        pipeline.delete(self._key('job', job.id))
+        pipeline.lrem(self._key('running'), 1, job.id)
+        if not success and job.key is not None:
+            pipeline.delete(self._key('dedup', job.key))
+        pipeline.execute()
+        metrics.observe(metrics.JOB_AGE, self.name, job.lane,
+                        time.time() - job.created)
+
+        if self.on_done is not None:
+            try:
+                self.on_done(job, success)
+            except Exception as e:
+                logger.error('Job {0} callback: {1}'.format(job.id, e))
+
+    def _export(self):
+        for lane, values in self.stats().iteritems():
+            if lane in self.lanes:
+                metrics.gauge(metrics.SPOOL_DEPTH, self.name, lane,
+                              values['depth'])
+                metrics.gauge(metrics.SPOOL_OLDEST, self.name, lane,
+                              round(values['oldest'], 3))
+
+    def _key(self, *parts):
+        return ':'.join((self.name,) + parts)
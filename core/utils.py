@@ -5,8 +5,14 @@ import threading
 import Queue
 import redis
 import time
+import socket
 import logging
-import json
+
+# io_server imports
+from core import codec
+from core import metrics
+from core.dispatch import Dispatcher, command_key
+from core.connection import Backoff, get_breaker
 
 logger = logging.getLogger(__file__)
 
@@ -19,11 +25,87 @@ def lr_justify(left, right, width):
     if len(left) + len(right) > width - 1:
         left = left[:width - len(right) - 1]
 
-    return '{}{}{}'.format(left, ' '*(width-len(left+right)), right)
+    return u'{}{}{}'.format(left, ' '*(width-len(left+right)), right)
+
+
+def message_id(msg):
+    """
+    Return the optional "id" of a command message, handlers echo it back
+    in the response so the client can match both.
+    """
+    try:
+        return msg.get('id')
+    except AttributeError:
+        return None
+
+
+def _handle(msg, handler, channel, received, args, kwargs):
+    """
+    Call the handler of a message recording how long the message waited
+    to be handled, how long the handler took and if it failed.
+    """
+    command = command_key(msg)
+    start = time.time()
+    metrics.observe(metrics.QUEUE_WAIT, channel, command, start - received)
+
+    try:
+        handler(msg, *args, **kwargs)
+    except Exception as e:
+        metrics.inc(metrics.ERRORS, channel, command)
+        logger.error(e)
+    finally:
+        metrics.observe(metrics.HANDLER, channel, command, time.time() - start)
+        metrics.inc(metrics.COMMANDS, channel, command)
 
 
 def subscribe(channel, handler, host='localhost', port=6379,
-              db=0, password=None):
+              db=0, password=None, blocking=True, timeout=1.0,
+              dispatcher=None, transport='pubsub', **kwargs):
+    """
+    Start a daemon thread that calls "handler" with every message
+    published in "channel" and return it, call stop() on it to finish.
+    "channel" can also be a list of channels read through the same
+    connection, "handler" is then a dict with the handler of each one
+    and "dispatcher" can be a dict with the dispatcher of each one.
+
+    When "blocking" is True the thread sleeps on the pubsub socket and
+    wakes up only when a message arrives or after "timeout" seconds,
+    just to check if it was asked to stop. When False it falls back to
+    the old behaviour of polling the socket every 10 ms.
+
+    When the connection fails the thread reconnects after a jittered
+    exponential backoff and reports the failure to the circuit breaker
+    of the server, see core.connection.
+
+    By default the handler runs in the subscriber thread, pass a
+    core.dispatch.Dispatcher as "dispatcher" to run it in a worker pool.
+
+    The number of messages and errors and the time every message waits
+    to be handled and spends in the handler are recorded per channel and
+    command in core.metrics.
+
+    Use transport='stream' to receive the messages from a redis stream
+    instead of a pubsub channel, see subscribe_stream() for the extra
+    arguments it accepts.
+    """
+    if transport == 'stream':
+        return subscribe_stream(
+            channel, handler, host=host, port=port, db=db,
+            password=password, timeout=timeout, dispatcher=dispatcher,
+            **kwargs
+        )
+    elif transport != 'pubsub':
+        raise ValueError('Invalid transport: {0}'.format(transport))
+
+    if isinstance(channel, basestring):
+        channels, handlers = [channel], {channel: handler}
+    else:
+        channels, handlers = list(channel), handler
+
+    if isinstance(dispatcher, dict):
+        dispatchers = dispatcher
+    else:
+        dispatchers = {channel: dispatcher for channel in channels}
 
     class WorkerThread(threading.Thread):
         def __init__(self, *args, **kwargs):
@@ -31,38 +113,249 @@ def subscribe(channel, handler, host='localhost', port=6379,
             self.args = args
             self.kwargs = kwargs
             self.daemon = True
+            self.dispatcher = dispatcher
+            self.subscribed = threading.Event()
             self._stop = False
+            self._stopped = threading.Event()
 
         def run(self):
             client = redis.StrictRedis(host, port, db, password)
             pubsub = client.pubsub(ignore_subscribe_messages=True)
+            breaker, backoff = get_breaker(host, port, db), Backoff()
 
-            logger.info('Starting to wait for commands in: {0}'.format(channel))
+            logger.info('Starting to wait for commands in: {0}'.format(
+                ', '.join(channels)
+            ))
             while not self._stop:
                 try:
                     if not pubsub.subscribed:
-                        pubsub.subscribe(channel)
+                        pubsub.subscribe(*channels)
+                        self.subscribed.set()
 
-                    msg = pubsub.get_message(ignore_subscribe_messages=True)
-                    if msg is not None:
-                        handler(json.loads(msg['data']), *self.args, **self.kwargs)
+                    if blocking:
+                        msg = pubsub.get_message(
+                            ignore_subscribe_messages=True, timeout=timeout
+                        )
                     else:
-                        time.sleep(0.01)
+                        msg = pubsub.get_message(ignore_subscribe_messages=True)
+                        if msg is None:
+                            time.sleep(0.01)
+
+                    if msg is not None:
+                        self.handle(msg)
+
+                    backoff.reset()
+                    breaker.success()
                 except redis.ConnectionError:
-                    error = 'Error while connecting to redis, reconnecting...'
+                    breaker.failure()
+                    delay = backoff.next()
+                    error = ('Error while connecting to redis, reconnecting '
+                             'in {0:.2f} seconds...').format(delay)
                     logger.error(error)
-                    time.sleep(1)
+
+                    # drop the broken connection, the next loop subscribes
+                    # again using a new one
+                    pubsub.reset()
+                    self._stopped.wait(delay)
                 except Exception as e:
                     logger.error(e)
+                    self._stopped.wait(backoff.next())
+
+        def handle(self, msg):
+            received, channel = time.time(), msg['channel']
+            try:
+                msg = codec.decode(msg['data'])
+            except ValueError as e:
+                logger.error('Invalid message: {0}, {1}'.format(msg, e))
+                return
+
+            args = (handlers[channel], channel, received, self.args,
+                    self.kwargs)
+            if dispatchers[channel] is None:
+                _handle(msg, *args)
+            else:
+                dispatchers[channel].dispatch(_handle, msg, *args)
 
         def stop(self):
             self._stop = True
+            self._stopped.set()
             self.join()
 
     worker = WorkerThread()
     worker.start()
     return worker
 
+
+def subscribe_stream(stream, handler, group='io_server', consumer=None,
+                     host='localhost', port=6379, db=0, password=None,
+                     timeout=1.0, dispatcher=None, maxlen=1000,
+                     claim_idle=60.0, max_age=None):
+    """
+    Same as subscribe() but the messages are read from the redis stream
+    "stream" using the consumer group "group", so messages added while
+    the plugin is not running are handled as soon as it starts. Clients
+    add the messages with: XADD stream MAXLEN ~ 1000 * data <json>
+
+    Every message is acknowledged once the handler returns (or raises),
+    messages delivered to this consumer but never acknowledged, because
+    the process died, are handled again when it starts. Messages pending
+    for more than "claim_idle" seconds in other consumers of the group
+    are claimed and handled by this one.
+
+    "maxlen" bounds the stream length, older messages are trimmed.
+    Messages older than "max_age" seconds are acknowledged and discarded
+    without calling the handler.
+
+    "consumer" defaults to the host name, so a restarted process gets
+    back its own pending messages.
+
+    The "dispatcher" must block when it is full: a message it dropped
+    would never be acknowledged and would stay pending in the group
+    until the process is restarted, the messages wait in the stream
+    instead.
+    """
+    if dispatcher is not None and dispatcher.overflow != Dispatcher.BLOCK:
+        raise ValueError('Invalid overflow policy for a stream: {0}'.format(
+            dispatcher.overflow
+        ))
+    consumer = consumer or socket.gethostname()
+
+    class StreamWorkerThread(threading.Thread):
+        def __init__(self, *args, **kwargs):
+            super(StreamWorkerThread, self).__init__(*args, **kwargs)
+            self.args = args
+            self.kwargs = kwargs
+            self.daemon = True
+            self.dispatcher = dispatcher
+            self._stop = False
+            self._stopped = threading.Event()
+
+        def run(self):
+            client = redis.StrictRedis(host, port, db, password)
+            breaker, backoff = get_breaker(host, port, db), Backoff()
+            group_ready = False
+            last_pending, last_claim = '0', 0
+
+            logger.info('Starting to wait for commands in stream: {0}'.format(
+                stream
+            ))
+            while not self._stop:
+                try:
+                    if not group_ready:
+                        self.create_group(client)
+                        group_ready, last_pending = True, '0'
+
+                    # first handle the messages delivered to us that were
+                    # never acknowledged, then wait for new ones
+                    if last_pending is not None:
+                        entries = self.read(client, last_pending, None)
+                        last_pending = entries[-1][0] if entries else None
+                    else:
+                        entries = self.read(client, '>', timeout)
+
+                    for entry_id, fields in entries:
+                        self.process(client, entry_id, fields)
+
+                    if time.time() - last_claim > claim_idle / 2:
+                        self.reclaim(client)
+                        last_claim = time.time()
+
+                    backoff.reset()
+                    breaker.success()
+                except redis.ConnectionError:
+                    breaker.failure()
+                    delay = backoff.next()
+                    error = ('Error while connecting to redis, reconnecting '
+                             'in {0:.2f} seconds...').format(delay)
+                    logger.error(error)
+                    self._stopped.wait(delay)
+                except redis.ResponseError as e:
+                    # the group is gone if redis lost its data
+                    if 'NOGROUP' in str(e):
+                        group_ready = False
+                    logger.error(e)
+                    self._stopped.wait(backoff.next())
+                except Exception as e:
+                    logger.error(e)
+                    self._stopped.wait(backoff.next())
+
+        def create_group(self, client):
+            try:
+                client.xgroup_create(stream, group, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+        def read(self, client, last_id, timeout):
+            block = int(timeout * 1000) if timeout else None
+            result = client.xreadgroup(
+                group, consumer, {stream: last_id}, count=100, block=block
+            )
+            return result[0][1] if result else []
+
+        def reclaim(self, client):
+            min_idle = int(claim_idle * 1000)
+            pending = client.xpending_range(stream, group, '-', '+', 100)
+            ids = [
+                entry['message_id'] for entry in pending
+                if entry['consumer'] != consumer
+                and entry['time_since_delivered'] >= min_idle
+            ]
+
+            if ids:
+                logger.info('Claiming {0} pending messages in: {1}'.format(
+                    len(ids), stream
+                ))
+                for entry_id, fields in client.xclaim(
+                        stream, group, consumer, min_idle, ids):
+                    self.process(client, entry_id, fields)
+
+            client.xtrim(stream, maxlen, approximate=True)
+
+        def process(self, client, entry_id, fields):
+            # claimed entries already trimmed from the stream are empty
+            if not fields:
+                client.xack(stream, group, entry_id)
+                return
+
+            if max_age is not None:
+                added = int(entry_id.split('-')[0]) / 1000.0
+                if time.time() - added > max_age:
+                    logger.info('Discarding stale message: {0}'.format(
+                        entry_id
+                    ))
+                    client.xack(stream, group, entry_id)
+                    return
+
+            try:
+                msg = codec.decode(fields['data'])
+            except (KeyError, ValueError) as e:
+                logger.error('Invalid message: {0}, {1}'.format(entry_id, e))
+                client.xack(stream, group, entry_id)
+                return
+
+            if dispatcher is None:
+                self.handle(msg, client, entry_id, time.time())
+            else:
+                dispatcher.dispatch(self.handle, msg, client, entry_id,
+                                    time.time())
+
+        def handle(self, msg, client, entry_id, received):
+            try:
+                _handle(msg, handler, stream, received, self.args,
+                        self.kwargs)
+            finally:
+                client.xack(stream, group, entry_id)
+
+        def stop(self):
+            self._stop = True
+            self._stopped.set()
+            self.join()
+
+    worker = StreamWorkerThread()
+    worker.start()
+    return worker
+
 if __name__ == '__main__':
     def test_handler(results, msg):
         worker = threading.current_thread()
@@ -4,6 +4,10 @@ import logging
 # foundation imports
 from foundation.application import application as core_app
 
+# io_server imports
+from core import codec
+from core import metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -12,19 +16,41 @@ class ApplicationRunner(object):
         self.applications = applications
 
     def start(self):
-        app = None
         options = core_app.options
-        appid = options.application
+        for channel, name in core_app.settings['codecs'].iteritems():
+            codec.set_channel_codec(channel, name)
+
+        appids = (options.application or '').split(',')
+        appids = [appid.strip() for appid in appids]
 
-        logger.info('Looking for application: {0}'.format(appid))
-        for application in self.applications:
-            if application.appid == appid:
-                app = application
+        logger.info('Looking for application: {0}'.format(', '.join(appids)))
+        apps = [
+            application for application in self.applications
+            if application.appid in appids or 'all' in appids
+        ]
 
-        if app is None:
+        if not apps:
             logger.info('No application found')
             return
 
+        name = apps[0].appid if len(apps) == 1 else 'runtime'
+        settings = core_app.settings['metrics']
+        metrics.start_exporters(name, settings['interval'],
+                                settings['ports'].get(name))
+
+        if len(apps) > 1:
+            # several applications share the same process
+            from .runtime import Runtime
+
+            logger.info('Starting applications: {0}'.format(
+                ', '.join(app.appid for app in apps)
+            ))
+            Runtime(apps).run()
+            logger.info('Stopping applications')
+            return
+
+        app = apps[0]
+
         logger.info('Starting application: {0}'.format(app.appid))
         app.run()
         logger.info('Stopping application: {0}'.format(app.appid))
@@ -4,6 +4,11 @@ __author__ = 'jmrbcu'
 # python imports
 import logging
 import signal
+import threading
+
+# io_server imports
+from core.utils import subscribe
+from core.connection import get_breaker
 
 
 logger = logging.getLogger(__file__)
@@ -16,15 +21,87 @@ signals = (
     signal.SIGPROF, signal.SIGALRM, signal.SIGUSR2, signal.SIGINT
 )
 
+def _exit(signum, frame):
+    raise SystemExit()
+
+
 class PluginApplication(object):
+    """
+    Base class of the applications run by the application runner.
+
+    Subclasses expose their command handlers through handlers() and open
+    or close their devices in setup() and teardown(). Standalone, run()
+    subscribes the handlers and sleeps until a signal arrives, the
+    application runner can also host several applications in one process
+    sharing the same redis connection, see runtime.Runtime.
+    """
 
-    def __init__(self, appid):
+    def __init__(self, appid, transport='pubsub'):
         self.appid = appid
+        # how commands are received: "pubsub" or "stream", see subscribe()
+        self.transport = transport
         self._stop = False
+        self._stopped = threading.Event()
 
-    def run(self):
+    def handlers(self):
+        """
+        Return a dict with the command channels as keys and the handler
+        of each one as values.
+        """
+        return {}
+
+    def setup(self):
+        """
+        Open the devices used by the application, return False if the
+        application can not run.
+        """
+        return True
+
+    def teardown(self):
+        """
+        Close the devices opened in setup()
+        """
         pass
 
+    def redis_state(self):
+        """
+        State of the connection to redis: "closed" when it works, "open"
+        when it is failing and "half_open" while it is being retried,
+        see core.connection.CircuitBreaker.
+        """
+        return get_breaker().state
+
+    def run(self):
+        if not self.setup():
+            return
+
+        workers = [
+            subscribe(channel, handler, transport=self.transport)
+            for channel, handler in self.handlers().iteritems()
+        ]
+
+        try:
+            self.wait()
+        except (SystemExit, KeyboardInterrupt):
+            pass
+        finally:
+            for worker in workers:
+                worker.stop()
+            self.teardown()
+
+    def wait(self):
+        """
+        Sleep until stop() is called or a signal arrives, SIGINT and
+        SIGTERM finish the wait raising KeyboardInterrupt and SystemExit
+        respectively. The sleep has a timeout only because python 2 does
+        not deliver the signals to a thread waiting for an event without
+        one.
+        """
+        signal.signal(signal.SIGTERM, _exit)
+        while not self._stop:
+            self._stopped.wait(1.0)
+
     def stop(self):
         logger.info('Stop plugin application: {0} requested'.format(self.appid))
         self._stop = True
+        self._stopped.set()
@@ -28,7 +28,9 @@ class ApplicationRunnerPlugin(Plugin):
         return (
             Argument(
                 '-a', '--application',
-                help='Id of the desired plugin application to run'
+                help=('Id of the desired plugin application to run, several '
+                      'ids separated by commas or "all" run them in the '
+                      'same process')
             ),
         )
 
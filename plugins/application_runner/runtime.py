@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+__author__ = 'jmrbcu'
+
+# python imports
+import logging
+
+# io_server imports
+from core import metrics
+from core.utils import subscribe
+from core.dispatch import Dispatcher, command_key
+
+# application runner plugin imports
+from .plugin_application import PluginApplication
+
+logger = logging.getLogger(__file__)
+
+
+class Runtime(PluginApplication):
+    """
+    Host several plugin applications in one process instead of one
+    process per application.
+
+    The command channels of all the applications using the pubsub
+    transport are read by one thread through a single redis connection,
+    the ones using streams get a reader each. The handlers of every
+    application run in its own executor thread, so blocking serial or
+    USB I/O in one device never delays the commands of another one,
+    while the commands of the same device keep their order.
+
+    The executors of the pubsub applications never block the shared
+    reader: when one holds "max_queue" commands its oldest command is
+    dropped, logged and counted in the DROPPED metric. The stream readers
+    are not shared, their executors block them instead, the commands
+    wait in the stream.
+    """
+
+    def __init__(self, applications, max_queue=100):
+        super(Runtime, self).__init__('runtime')
+        self.applications = applications
+        self.max_queue = max_queue
+
+    @staticmethod
+    def _dropped(app):
+        def on_drop(msg):
+            metrics.inc(metrics.DROPPED, app.appid, command_key(msg))
+        return on_drop
+
+    def run(self):
+        applications = []
+        for app in self.applications:
+            logger.info('Setting up application: {0}'.format(app.appid))
+            try:
+                if app.setup():
+                    applications.append(app)
+                    continue
+            except Exception as e:
+                logger.error(e)
+            logger.error('Application: {0} could not be started'.format(
+                app.appid
+            ))
+
+        if not applications:
+            return
+
+        executors, workers, handlers, dispatchers = [], [], {}, {}
+        for app in applications:
+            overflow = Dispatcher.DROP_OLDEST if app.transport == 'pubsub' \
+                else Dispatcher.BLOCK
+            executor = Dispatcher(workers=1, max_queue=self.max_queue,
+                                  overflow=overflow,
+                                  on_drop=self._dropped(app), name=app.appid)
+            executors.append(executor)
+
+            for channel, handler in app.handlers().iteritems():
+                if app.transport == 'pubsub':
+                    handlers[channel] = handler
+                    dispatchers[channel] = executor
+                else:
+                    workers.append(subscribe(
+                        channel, handler, transport=app.transport,
+                        dispatcher=executor
+                    ))
+
+        if handlers:
+            workers.append(subscribe(list(handlers), handlers,
+                                     dispatcher=dispatchers))
+
+        try:
+            self.wait()
+        except (SystemExit, KeyboardInterrupt):
+            pass
+        finally:
+            for worker in workers:
+                worker.stop()
+
+            for executor in executors:
+                executor.stop()
+
+            for app in applications:
+                logger.info('Stopping application: {0}'.format(app.appid))
+                app.teardown()
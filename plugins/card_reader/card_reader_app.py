@@ -3,15 +3,13 @@ __author__ = 'jmrbcu'
 
 # python imports
 import re
-import json
-import time
 import logging
 
-# redis imports
-import redis
-
 # io_server imports
-from core.utils import subscribe
+from core import metrics
+from core.utils import message_id
+from core.dispatch import command_key
+from core.publisher import get_publisher
 
 # application runner plugin imports
 from application_runner.plugin_application import PluginApplication
@@ -38,6 +36,7 @@ class CardReaderApp(PluginApplication):
 
         read: Read the information contained in a card
         format: {
+            "id": "optional request id",
             "command": "read",
             "params": {
                 "timeout": 30
@@ -51,9 +50,11 @@ class CardReaderApp(PluginApplication):
         card_info: Notify when the card has been read or
         an error happened while reading it. Take into
         account that if a track is empty, it will not be
-        included in the content field.
+        included in the content field. The "id" of the
+        read command, if any, is sent back in the response.
 
         format: {
+            "id": "request id",
             "command": "card_info",
             "params": {
                 "error": true or false,
@@ -75,8 +76,8 @@ class CardReaderApp(PluginApplication):
     # error codes
     (OK, EMPTY_TRACKS, TIMEOUT, FORMAT_ERROR, INVALID_COMMAND, UNKNOWN_ERROR) = range(6)
 
-    def __init__(self, appid):
-        super(CardReaderApp, self).__init__(appid)
+    def __init__(self, appid, transport='pubsub'):
+        super(CardReaderApp, self).__init__(appid, transport)
 
         # reader
         self.reader = None
@@ -84,27 +85,27 @@ class CardReaderApp(PluginApplication):
         # monitor stop flag
         self._stop = False
 
-    def run(self):
-        # message handler
-        handler = subscribe(CardReaderApp.COMMAND_CHANNEL, self.on_message)
+    def handlers(self):
+        return {CardReaderApp.COMMAND_CHANNEL: self.on_message}
 
+    def setup(self):
         # detect where the magnetic reader is connected
         device = MSReader.detect_reader()
         if device is None:
-            return
+            return False
+
         self.reader = MSReader(device)
+        return True
 
-        # main loop
-        try:
-            while True:
-                time.sleep(0.1)
-        except (SystemExit, KeyboardInterrupt):
-            handler.stop()
+    def teardown(self):
+        if self.reader is not None:
             self.reader.close()
 
     def on_message(self, msg):
         logger.info('New command received: {0}'.format(msg))
+        msg_id = message_id(msg)
         tracks = None
+        command = command_key(msg)
 
         try:
             command = msg['command']
@@ -112,7 +113,9 @@ class CardReaderApp(PluginApplication):
 
             if command == 'read':
                 timeout = params['timeout']
-                tracks = self.reader.read(timeout)
+                with metrics.timer(metrics.DEVICE_IO,
+                                   CardReaderApp.COMMAND_CHANNEL, command):
+                    tracks = self.reader.read(timeout)
                 if tracks:
                     success, error_code, status, tracks = (
                         True, CardReaderApp.OK, 'OK', tracks
@@ -144,22 +147,23 @@ class CardReaderApp(PluginApplication):
             logger.info(status)
         else:
             logger.error(status)
-        self.send_response(success, error_code, status, tracks)
+            metrics.inc(metrics.ERRORS, CardReaderApp.COMMAND_CHANNEL,
+                        command)
+        self.send_response(success, error_code, status, tracks, msg_id)
 
-    def send_response(self,  success, error_code, status, tracks=None):
-        try:
-            pub = redis.StrictRedis()
-            msg = self._build_message(success, error_code, status, tracks)
-            pub.publish(CardReaderApp.RESPONSE_CHANNEL, msg)
-        except Exception as e:
-            logger.error(e)
+    def send_response(self,  success, error_code, status, tracks=None,
+                      msg_id=None):
+        msg = self._build_message(success, error_code, status, tracks)
+        if msg_id is not None:
+            msg['id'] = msg_id
+        get_publisher().publish(CardReaderApp.RESPONSE_CHANNEL, msg)
 
     def _build_message(self, success, error_code, status, tracks=None):
         content = {
             'track{0}'.format(k): v for k, v in enumerate(tracks)
         } if tracks else {}
 
-        return json.dumps({
+        return {
             "command": "card_info",
             "params": {
                 "error": not success,
@@ -167,4 +171,4 @@ class CardReaderApp(PluginApplication):
                 "status": status,
                 "content": content
             }
-        })
\ No newline at end of file
+        }
\ No newline at end of file
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 # foundation imports
+from foundation.application import application
 from foundation.plugin_manager import Plugin, contributes_to
 
 
@@ -17,4 +18,14 @@ class CardReaderPlugin(Plugin):
     @contributes_to('application_runner.applications')
     def _create(self):
         from .card_reader_app import CardReaderApp
-        return CardReaderApp(self.id),
+
+        settings = application.settings
+        settings = settings['CardReader']
+        transport = settings['transport']
+
+        return CardReaderApp(self.id, transport),
+
+    def configure(self):
+        settings = application.settings
+        settings = settings.setdefault('CardReader', {})
+        settings.setdefault('transport', 'pubsub')
@@ -19,4 +19,15 @@ class DefaultSettingsPlugin(Plugin):
         settings = application.settings
         settings.setdefault('redis_server', 'localhost')
 
+        # codec used to send the messages of a channel, E.g.:
+        # {"card_reader.responses": "msgpack"}, json by default
+        settings.setdefault('codecs', {})
+
+        # metrics exported to the redis hash "io_server.metrics.<app id>"
+        # every "interval" seconds and, for the application ids in "ports",
+        # served in the prometheus text format in http://127.0.0.1:<port>
+        metrics = settings.setdefault('metrics', {})
+        metrics.setdefault('interval', 10.0)
+        metrics.setdefault('ports', {})
+
 
@@ -3,24 +3,18 @@ __author__ = 'jmrbcu'
 
 # python imports
 import re
-import json
-import time
 import threading
 import logging
+import collections
 
 # pyserial imports
 from serial import Serial
 from serial.tools import list_ports
 
-# redis imports
-import redis
-
-# foundation imports
-from foundation.paths import path
-from foundation.application import application
-
 # io_server imports
-from core.utils import subscribe
+from core import metrics
+from core.utils import message_id
+from core.publisher import get_publisher
 
 # application runner plugin imports
 from application_runner.plugin_application import PluginApplication
@@ -55,6 +49,9 @@ class DeviceCharger(PluginApplication):
         device_status: Get the device status using the response channel
         format: {"command": "device_status"}
 
+        All the commands accept an optional "id" field, the "id" of a
+        "device_status" command is sent back in its response.
+
     Responses/Events:
         The responses commands are in json format conform
         to the following standard:
@@ -67,6 +64,7 @@ class DeviceCharger(PluginApplication):
 
         device_status: Get the connected device status
         format: {
+            "id": "request id, only if the command had one",
             "command": "device_status",
             "params": {
                 "status": "status string"
@@ -84,10 +82,14 @@ class DeviceCharger(PluginApplication):
     STATUS = 'S'
     IDENTIFICATION = 'I'
 
-    def __init__(self, appid):
-        super(DeviceCharger, self).__init__(appid)
+    def __init__(self, appid, transport='pubsub'):
+        super(DeviceCharger, self).__init__(appid, transport)
         # USB Switchable Charger interface
         self.charger = None
+        self.charger_watcher = None
+
+        # ids of the device_status commands waiting for the status line
+        self.status_requests = collections.deque(maxlen=100)
 
         # monitor stop flag
         self._stop = False
@@ -110,59 +112,62 @@ class DeviceCharger(PluginApplication):
         else:
             self.charger.write(DeviceCharger.DISABLE_CHARGING)
 
-    def send_status(self):
+    def send_status(self, msg_id=None):
         if self.charger is None:
             return
+        self.status_requests.append(msg_id)
         self.charger.write(DeviceCharger.STATUS)
 
-    def run(self):
+    def handlers(self):
+        return {DeviceCharger.COMMAND_CHANNEL: self.on_command}
+
+    def setup(self):
         # detect USB Switchable charger port
         port = DeviceCharger.detect_charger_port()
         if port is None:
             msg = 'None of the ports contains a USB Switchable charger, exiting'
             logger.error(msg)
-            return
+            return False
 
         # connect to the charger device using its serial interface
         try:
             self.charger = Serial(port, 9600, 8, 'N', 1, timeout=0.5)
         except (OSError, IOError) as e:
             logger.error(e)
-            return
+            return False
 
         # start charger status watcher
-        charger_watcher = self.start_watcher(self.charger)
+        self.charger_watcher = self.start_watcher(self.charger)
+        return True
 
-        # command handler
-        command_handler = subscribe(DeviceCharger.COMMAND_CHANNEL,
-                                    self.on_command)
-        try:
-            while True:
-                time.sleep(0.1)
-        except (SystemExit, KeyboardInterrupt):
-            command_handler.stop()
-            charger_watcher.stop()
-            self.enable_charging(False)
+    def teardown(self):
+        self.charger_watcher.stop()
+        self.enable_charging(False)
 
     def on_command(self, command):
         try:
             logger.info('New command received: {0}'.format(command))
+            msg_id = message_id(command)
             command = command.get('command')
         except Exception as e:
             msg = 'Message format not valid: {0}'.format(command)
             logger.error(msg)
 
         try:
-            if command == 'enable_charging':
-                self.enable_charging(True)
-            elif command == 'disable_charging':
-                self.enable_charging(False)
-            elif command == 'device_status':
-                self.send_status()
+            with metrics.timer(metrics.DEVICE_IO,
+                               DeviceCharger.COMMAND_CHANNEL, command):
+                if command == 'enable_charging':
+                    self.enable_charging(True)
+                elif command == 'disable_charging':
+                    self.enable_charging(False)
+                elif command == 'device_status':
+                    self.send_status(msg_id)
         except Exception as e:
+            metrics.inc(metrics.ERRORS, DeviceCharger.COMMAND_CHANNEL, command)
             logger.error(e)
 
     def start_watcher(self, charger):
+        status_requests = self.status_requests
 
         class ChargerWatcher(threading.Thread):
             def __init__(self, *args, **kwargs):
@@ -172,7 +177,7 @@ class DeviceCharger(PluginApplication):
 
             def run(self):
                 status_re = '\w+:\w+'
-                publisher = redis.StrictRedis()
+                publisher = get_publisher()
 
                 while not self._stop:
                     line = charger.readline().strip()
@@ -180,24 +185,33 @@ class DeviceCharger(PluginApplication):
                         continue
 
                     logger.info('New charger event: {0}'.format(line))
-                    msg = None
+                    msg, coalesce = None, False
                     if line == 'connected':
                         msg = {'command': 'device_connected'}
                     elif line == 'disconnected':
                         msg = {'command': 'device_disconnected'}
                     elif re.match(status_re, line):
-                        msg = {
+                        # status lines come in bursts, send them together
+                        msg, coalesce = {
                             'command': 'device_status',
                             'params': {
                                 'status': line
                             }
-                        }
+                        }, True
+
+                        # match the line with the oldest status request
+                        try:
+                            msg_id = status_requests.popleft()
+                            if msg_id is not None:
+                                msg['id'] = msg_id
+                        except IndexError:
+                            pass
                     else:
                         logger.error('Unknown command: {0}'.format(line))
                         continue
 
-                    publisher.publish(DeviceCharger.RESPONSE_CHANNEL,
-                                      json.dumps(msg))
+                    publisher.publish(DeviceCharger.RESPONSE_CHANNEL, msg,
+                                      coalesce=coalesce)
 
             def stop(self):
                 self._stop = True
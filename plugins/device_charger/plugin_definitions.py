@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 # foundation imports
+from foundation.application import application
 from foundation.plugin_manager import Plugin, contributes_to
 
 
@@ -17,4 +18,14 @@ class DeviceChargerPlugin(Plugin):
     @contributes_to('application_runner.applications')
     def _create(self):
         from .device_charger import DeviceCharger
-        return DeviceCharger(self.id),
+
+        settings = application.settings
+        settings = settings['DeviceCharger']
+        transport = settings['transport']
+
+        return DeviceCharger(self.id, transport),
+
+    def configure(self):
+        settings = application.settings
+        settings = settings.setdefault('DeviceCharger', {})
+        settings.setdefault('transport', 'pubsub')
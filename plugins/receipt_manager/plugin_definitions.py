@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+# python imports
+import os
+
 # foundation imports
 from foundation.paths import path
 from foundation.application import application
@@ -22,6 +25,7 @@ class ReceiptManagerPlugin(Plugin):
 
         settings = application.settings
         settings = settings['ReceiptManager']
+        transport = settings['transport']
 
         printer = settings['printer']
         id_vendor = printer['id_vendor']
@@ -31,9 +35,35 @@ class ReceiptManagerPlugin(Plugin):
         out_ep = printer['out_ep']
         header = printer['header']
         footer = printer['footer']
+        dither = printer['dither']
+        image_width = printer['image_width']
+        raster_cache = printer['raster_cache']
+        buffered = printer['buffered']
+        receive_buffer = printer['receive_buffer']
+        nv_graphics = printer['nv_graphics']
+        throughput = printer['throughput']
+        status_interval = printer['status_interval']
+        pipeline = printer['pipeline']
+        compact_images = printer['compact_images']
+
+        spool = settings['spool']
+        spool_retries = spool['retries']
+        spool_backoff = spool['backoff']
+        dedup_ttl = spool['dedup_ttl']
+
+        journal = settings['journal']
+        journal_directory = journal['directory']
+        journal_segment_size = journal['segment_size']
+        journal_segments = journal['segments']
 
         return ReceiptManagerApp(self.id, id_vendor, id_product, interface,
-                                 in_ep, out_ep, header, footer),
+                                 in_ep, out_ep, header, footer, transport,
+                                 dither, image_width, raster_cache, buffered,
+                                 receive_buffer, nv_graphics, throughput,
+                                 status_interval, pipeline, spool_retries,
+                                 spool_backoff, dedup_ttl, journal_directory,
+                                 journal_segment_size, journal_segments,
+                                 compact_images),
 
     def configure(self):
         default_header = path(__file__).dirname().join('res').join('logo.jpg')
@@ -41,6 +71,7 @@ class ReceiptManagerPlugin(Plugin):
 
         settings = application.settings
         settings = settings.setdefault('ReceiptManager', {})
+        settings.setdefault('transport', 'pubsub')
         printer = settings.setdefault('printer', {})
         printer.setdefault('id_vendor', '')
         printer.setdefault('id_product', '')
@@ -50,6 +81,57 @@ class ReceiptManagerPlugin(Plugin):
         printer.setdefault('header', default_header)
         printer.setdefault('footer', default_footer)
 
+        # header and footer dithering mode: "pattern", "threshold",
+        # "ordered" or "floyd-steinberg", and width in dots, 0 keeps the
+        # image width. Converted images are cached in "raster_cache".
+        printer.setdefault('dither', 'pattern')
+        printer.setdefault('image_width', 0)
+        printer.setdefault('raster_cache', os.path.expanduser(
+            '~/.io_server/raster_cache'
+        ))
+
+        # feed the blank rows of the images instead of sending them, only
+        # for printers with a vertical motion unit of one dot, the images
+        # are distorted on the others
+        printer.setdefault('compact_images', False)
+
+        # send the commands in bulk, in pieces that fit in the printer
+        # receive buffer (bytes) instead of one USB transfer per command
+        printer.setdefault('buffered', True)
+        printer.setdefault('receive_buffer', 4096)
+
+        # bytes per second the printer prints, the writes are paced so they
+        # never overrun its receive buffer, 0 sends as fast as USB allows
+        printer.setdefault('throughput', 0)
+
+        # store the header and footer in the printer NV memory and print
+        # them by key code, they are stored again only when they change.
+        # The printer must support the "GS ( L" graphics commands.
+        printer.setdefault('nv_graphics', False)
+
+        # seconds between printer status polls, the receipts are rejected
+        # right away while the printer can not print, 0 disables it
+        printer.setdefault('status_interval', 1.0)
 
+        # pieces of the receipt queued for the thread writing them to the
+        # printer while the rest is rendered, 0 writes them as rendered
+        printer.setdefault('pipeline', 4)
 
+        # the commands are queued in redis and the failed ones retried
+        # "retries" times, waiting "backoff" seconds doubled every time.
+        # Commands with an idempotency key already seen in the last
+        # "dedup_ttl" seconds are not run again.
+        spool = settings.setdefault('spool', {})
+        spool.setdefault('retries', 3)
+        spool.setdefault('backoff', 1.0)
+        spool.setdefault('dedup_ttl', 3600)
 
+        # the commands of the receipts printed are kept to reprint them, in
+        # "segments" files of "segment_size" bytes, the oldest file is
+        # deleted when they are full. An empty directory disables it.
+        journal = settings.setdefault('journal', {})
+        journal.setdefault('directory', os.path.expanduser(
+            '~/.io_server/journal'
+        ))
+        journal.setdefault('segment_size', 4 * 1024 * 1024)
+        journal.setdefault('segments', 8)
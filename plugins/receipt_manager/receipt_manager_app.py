@@ -2,17 +2,25 @@
 __author__ = 'jmrbcu'
 
 # python imports
+import os
 import logging
-import json
-import time
 import datetime
-
-# redis imports
-import redis
+import threading
+import contextlib
 
 # io_server imports
-from core.utils import subscribe, lr_justify
-from core.escpos.printer import Usb
+from core import metrics
+from core.utils import lr_justify, message_id
+from core.dispatch import command_key
+from core.publisher import get_publisher
+from core.journal import Journal
+from core.spooler import Spooler, PENDING, DONE
+from core.escpos.printer import UsbSession
+from core.escpos.constants import TXT_ALIGN_CT
+from core.escpos.cache import RasterCache
+from core.escpos.graphics import NvGraphics
+from core.escpos.status import StatusMonitor
+from core.escpos.template import Template
 
 # application runner plugin imports
 from application_runner.plugin_application import PluginApplication
@@ -36,6 +44,7 @@ class ReceiptManagerApp(PluginApplication):
         to the following standard:
 
         format: {
+            "id": "optional request id",
             "command": "command type",
             "params": {
                 "param0": value,
@@ -44,6 +53,20 @@ class ReceiptManagerApp(PluginApplication):
             }
         }
 
+        The "id" is optional, when present it is sent back in the
+        response so the client can tell which response is its own.
+
+        The printer commands are queued in a spooler kept in redis and
+        answered once they are done, the ones that fail are retried a few
+        times, see core.spooler.Spooler. Their optional parameters are:
+            key: idempotency key, a command sent again with the same key
+                is not run twice: it gets the response of the first one
+                when it is done, or right away if it was already done.
+                The key is forgotten when the command fails.
+            priority: lane of the job, "high", "normal" or "low", the
+                jobs in the first lanes are run first. Receipts go to the
+                "normal" lane and the cash drawer kicks to the "high" one.
+
         Commands:
             send_receipt:
                 Send a receipt to a destination. The destination
@@ -94,12 +117,92 @@ class ReceiptManagerApp(PluginApplication):
                 }
             }
 
+            send_receipts:
+                Send several receipts to a destination in one job, E.g.: the
+                end of shift summaries or several copies of a receipt. They
+                are printed back to back, a receipt with a format error is
+                skipped and the rest are printed.
+
+            Parameters:
+                destination: The same as in "send_receipt".
+
+                receipts: A list of receipts, dictionaries with the
+                "send_receipt" parameters: driver_name, cab_id, items and
+                promotions.
+
+            E.g.: {
+                "command": "send_receipts",
+                "params": {
+                    "destination": ["printer"],
+                    "receipts": [
+                        {
+                            "driver_name": "Jon Smith",
+                            "cab_id": "AH0001234",
+                            "items": {"Trip Fare": [15.00, "item"]},
+                            "promotions": {}
+                        },
+                        ...
+                    ]
+                }
+            }
+
+            reprint:
+                Print again a receipt kept in the journal, the same
+                commands sent the first time, without rendering it again.
+
+            Parameters:
+                receipt_id: The receipt_id answered when it was printed.
+
+                cab_id: Reprint the last receipt of this cab instead.
+
+            E.g.: {
+                "command": "reprint",
+                "params": {
+                    "cab_id": "AH0001234"
+                }
+            }
+
+            find_receipts:
+                Find receipts in the journal, newest first, it does not use
+                the printer and is answered right away.
+
+            Parameters:
+                count: The maximum number of receipts found, 10 by default.
+
+                cab_id: Only the receipts of this cab, optional.
+
+                since, until: Only the receipts printed between these unix
+                times, optional.
+
+            E.g.: {
+                "command": "find_receipts",
+                "params": {
+                    "cab_id": "AH0001234",
+                    "count": 5
+                }
+            }
+
+            open_drawer:
+                Send a pulse to the cash drawer connected to the printer.
+
+            Parameters:
+                pin: The drawer connector pin, 2 (the default) or 5.
+
+            E.g.: {
+                "command": "open_drawer",
+                "params": {
+                    "pin": 2,
+                    "key": "drawer-AH0001234-1021"
+                }
+            }
+
     Responses/Events Message Format:
         The response for a given command or an event type.
         The responses/events commands are in json format conform
         to the following standard:
 
         format: {
+            "id": "request id, only if the command had one",
             "command": "command type",
             "params": {
                 "param0": value,
@@ -112,7 +215,9 @@ class ReceiptManagerApp(PluginApplication):
         Responses/Events:
             send_receipt:
                 Response to the command "send_receipt", it describe if the
-                command was executed successfully or not.
+                command was executed successfully or not. The responses to
+                "reprint" and "open_drawer" are the same with those command
+                names.
 
             Parameters:
                 error: True if an error happened, False otherwise.
@@ -120,6 +225,22 @@ class ReceiptManagerApp(PluginApplication):
 
                 error_code: The error code if an error happened, 0 otherwise.
                 E.g.: "error_code": 0
+                    0: OK
+                    1: message format error
+                    2: invalid command
+                    3: printer error while printing
+                    4: unknown error
+                    5: printer not connected
+                    6: printer offline
+                    7: printer cover open
+                    8: printer out of paper
+                    9: receipt not found in the journal
+                The errors 5 to 8 are answered without trying to print,
+                from the last printer status.
+
+                receipt_id: The id of the receipt in the journal, only if
+                it was printed and the journal is enabled.
+                E.g.: "receipt_id": 1021
 
                 status: Status string representing some informative message
                 about the response. Will contain the error string in case
@@ -131,7 +252,8 @@ class ReceiptManagerApp(PluginApplication):
                 "params": {
                     "error": false,
                     "error_code": 0,
-                    "status": ""
+                    "status": "",
+                    "receipt_id": 1021
                 }
             }
 
@@ -143,18 +265,114 @@ class ReceiptManagerApp(PluginApplication):
                     "status": "printer not connected"
                 }
             }
+
+            send_receipts:
+                Response to the command "send_receipts", the same as the
+                "send_receipt" one with the status of every receipt, in
+                the order they were sent. It is an error if any receipt
+                was not printed.
+
+            Parameters:
+                receipts: A list with the error, error_code, status and
+                receipt_id of every receipt.
+
+            E.g.: {
+                "command": "send_receipts",
+                "params": {
+                    "error": true,
+                    "error_code": 1,
+                    "status": "1 of 2 receipts printed",
+                    "receipts": [
+                        {
+                            "error": false,
+                            "error_code": 0,
+                            "status": "OK",
+                            "receipt_id": 1022
+                        },
+                        {
+                            "error": true,
+                            "error_code": 1,
+                            "status": "Receipt format error: KeyError('cab_id',)",
+                            "receipt_id": null
+                        }
+                    ]
+                }
+            }
+
+            find_receipts:
+                Response to the command "find_receipts", the same as the
+                "send_receipt" one with the receipts found.
+
+            Parameters:
+                receipts: A list with the receipt_id, cab_id and unix time
+                printed of every receipt found, newest first.
+
+            E.g.: {
+                "command": "find_receipts",
+                "params": {
+                    "error": false,
+                    "error_code": 0,
+                    "status": "OK",
+                    "receipts": [
+                        {
+                            "receipt_id": 1021,
+                            "cab_id": "AH0001234",
+                            "time": 1476712345.21
+                        }
+                    ]
+                }
+            }
+
+            printer_status:
+                Event sent every time the printer status changes, the
+                fields are null while the printer does not answer.
+
+            Parameters:
+                connected, online, cover_open, paper_near_end, paper_out,
+                error: booleans describing the printer status.
+
+            E.g.: {
+                "command": "printer_status",
+                "params": {
+                    "connected": true,
+                    "online": false,
+                    "cover_open": false,
+                    "paper_near_end": true,
+                    "paper_out": true,
+                    "error": false
+                }
+            }
     """
 
     # communication channels
     COMMAND_CHANNEL = 'receipt_manager.commands'
     RESPONSE_CHANNEL = 'receipt_manager.responses'
 
+    # spooled jobs, the first lanes are run first
+    SPOOL = 'receipt_manager.spool'
+    LANES = ('high', 'normal', 'low')
+
+    COMMANDS = ('send_receipt', 'send_receipts', 'reprint', 'find_receipts',
+                'open_drawer')
+    RECEIPT_FIELDS = ('driver_name', 'cab_id', 'items', 'promotions')
+    # errors of malformed commands, they are not retried
+    FORMAT_ERRORS = (KeyError, ValueError, TypeError, AttributeError)
+
     # error codes
-    (OK, FORMAT_ERROR, INVALID_COMMAND, PRINTER_ERROR, UNKNOWN_ERROR) = range(5)
+    (OK, FORMAT_ERROR, INVALID_COMMAND, PRINTER_ERROR, UNKNOWN_ERROR,
+     PRINTER_NOT_FOUND, PRINTER_OFFLINE, COVER_OPEN, PAPER_OUT,
+     RECEIPT_NOT_FOUND) = range(10)
 
     def __init__(self, appid, id_vendor, id_product, interface=0,
-                 in_ep=0x82, out_ep=0x01, header=None, footer=None):
-        super(ReceiptManagerApp, self).__init__(appid)
+                 in_ep=0x82, out_ep=0x01, header=None, footer=None,
+                 transport='pubsub', dither='pattern', image_width=None,
+                 raster_cache=None, buffered=True, receive_buffer=4096,
+                 nv_graphics=False, throughput=0, status_interval=1.0,
+                 pipeline=4, spool_retries=3, spool_backoff=1.0,
+                 dedup_ttl=3600, journal=None,
+                 journal_segment_size=4 * 1024 * 1024, journal_segments=8,
+                 compact_images=False):
+        super(ReceiptManagerApp, self).__init__(appid, transport)
         self.id_vendor = id_vendor
         self.id_product = id_product
         self.interface = interface
@@ -163,194 +381,724 @@ class ReceiptManagerApp(PluginApplication):
         self.header = header.strip()
         self.footer = footer.strip()
 
-    def run(self):
-        try:
-            # message handler
-            handler = subscribe(
-                ReceiptManagerApp.COMMAND_CHANNEL, self.on_message
+        # send the receipt in a few bulk transfers instead of one per command
+        self.buffered = buffered
+        self.receive_buffer = receive_buffer
+        self.throughput = throughput
+
+        # the commands are written by a writer thread while the rest of the
+        # receipt is rendered, at most "pipeline" pieces are queued
+        self.pipeline = pipeline
+
+        # the commands are run from a queue kept in redis, the failed
+        # ones are retried, see Spooler
+        self.spooler = None
+        self._results = {}
+        self._errors = {}
+        # the duplicates of a pending job get its response, see queue_job()
+        self._duplicates = {}
+        self._lock = threading.Lock()
+        self.spool_retries = spool_retries
+        self.spool_backoff = spool_backoff
+        self.dedup_ttl = dedup_ttl
+
+        # the commands of every receipt printed are kept in a journal in
+        # the "journal" directory to reprint them, see Journal
+        self.journal = None
+        self.journal_directory = journal
+        self.journal_segment_size = journal_segment_size
+        self.journal_segments = journal_segments
+
+        # the printer is kept open between receipts, see open_printer(),
+        # and its status is polled every status_interval seconds
+        self.session = None
+        self.status_interval = status_interval
+        self.monitor = None
+
+        # header and footer images are converted once, see RasterCache
+        self.dither = dither
+        self.image_width = image_width or None
+        self.raster_cache = RasterCache(raster_cache)
+        # feed their blank rows instead of sending them, the printer
+        # vertical motion unit must be one dot, see Escpos.compact_images
+        self.compact_images = compact_images
+        self.template = None
+
+        # with nv_graphics they are stored in the printer NV memory and
+        # printed by key code, see NvGraphics
+        self.graphics = None
+        if nv_graphics:
+            self.graphics = NvGraphics(
+                raster_cache and os.path.join(raster_cache, 'nv_graphics.json'),
+                self.image_width, dither
+            )
+
+    def handlers(self):
+        return {ReceiptManagerApp.COMMAND_CHANNEL: self.on_message}
+
+    def setup(self):
+        images = [image for image in (self.header, self.footer) if image]
+        if self.graphics is None:
+            self.raster_cache.warm(images, self.image_width, self.dither,
+                                   self.compact_images, TXT_ALIGN_CT)
+        self.template = self.receipt_template()
+
+        if self.journal_directory:
+            try:
+                self.journal = Journal(
+                    self.journal_directory, ('cab_id',),
+                    self.journal_segment_size, self.journal_segments
+                )
+            except (EnvironmentError, ValueError) as e:
+                logger.error('Receipt journal disabled: {0}'.format(e))
+
+        if self.status_interval:
+            self.monitor = StatusMonitor(
+                self.printer_session(), self.status_interval, self.send_status
             )
+            self.monitor.start()
 
-            # main loop
-            while True:
-                time.sleep(0.1)
-        except (SystemExit, KeyboardInterrupt):
-            handler.stop()
+        self.spooler = Spooler(
+            ReceiptManagerApp.SPOOL, self.run_job, ReceiptManagerApp.LANES,
+            retries=self.spool_retries, backoff=self.spool_backoff,
+            dedup_ttl=self.dedup_ttl, on_done=self.job_done,
+            fatal=ReceiptManagerApp.FORMAT_ERRORS
+        )
+        self.spooler.start()
+        return True
 
     def on_message(self, msg):
         logger.info('New command received: {0}'.format(msg))
+        msg_id = message_id(msg)
 
         try:
             command = msg['command']
             params = msg['params']
 
+            # the commands are checked before queuing them, the response
+            # is sent when they are done, see job_done()
+            error = self.printer_error()
             if command == 'send_receipt':
                 destination = params['destination']
-                driver_name = params['driver_name']
-                cab_id = params['cab_id']
-                items = params['items']
-                promotions = params['promotions']
+                for name in ReceiptManagerApp.RECEIPT_FIELDS:
+                    if name not in params:
+                        raise KeyError(name)
 
-                if destination[0] == 'printer':
-                    success = self.print_receipt(
-                        driver_name, cab_id, items, promotions
+                if destination[0] != 'printer':
+                    result = (
+                        False, ReceiptManagerApp.INVALID_COMMAND,
+                        ('Invalid destination: {0}, for now, we only support'
+                         'printer as destination').format(destination)
                     )
-                    if success:
-                        success, error_code, status = (
-                            True, ReceiptManagerApp.OK, 'OK'
-                        )
-                    else:
-                        msg = 'Failed to print receipt'
-                        success, error_code, status = (
-                            False, ReceiptManagerApp.PRINTER_ERROR, msg
-                        )
+                elif error is not None:
+                    # do not queue while the printer can not print
+                    result = (False,) + error
                 else:
-                    success, error_code, status = (
+                    result = self.receipt_error(params) or \
+                        self.queue_job(msg, 'normal')
+            elif command == 'send_receipts':
+                destination = params['destination']
+                receipts = params['receipts']
+                if destination[0] != 'printer':
+                    result = (
                         False, ReceiptManagerApp.INVALID_COMMAND,
                         ('Invalid destination: {0}, for now, we only support'
                          'printer as destination').format(destination)
                     )
+                elif not isinstance(receipts, list) or not receipts:
+                    result = (
+                        False, ReceiptManagerApp.FORMAT_ERROR,
+                        'Message format error, "receipts" must be a non empty list'
+                    )
+                elif error is not None:
+                    result = (False,) + error
+                else:
+                    result = self.queue_job(msg, 'normal')
+            elif command in ('reprint', 'find_receipts') and \
+                    self.journal is None:
+                result = (
+                    False, ReceiptManagerApp.INVALID_COMMAND,
+                    'The receipt journal is disabled'
+                )
+            elif command == 'reprint':
+                record = self.find_receipt(params)
+                if record is None:
+                    result = (
+                        False, ReceiptManagerApp.RECEIPT_NOT_FOUND,
+                        'Receipt not found in the journal'
+                    )
+                elif error is not None:
+                    result = (False,) + error
+                else:
+                    params['receipt_id'] = record.id
+                    result = self.queue_job(msg, 'normal')
+            elif command == 'find_receipts':
+                # answered right away, it does not use the printer
+                try:
+                    receipts = self.find_receipts(params)
+                except ReceiptManagerApp.FORMAT_ERRORS as e:
+                    result = (
+                        False, ReceiptManagerApp.FORMAT_ERROR,
+                        'Message format error: {0!r}'.format(e)
+                    )
+                else:
+                    self.send_response(True, ReceiptManagerApp.OK, 'OK',
+                                       msg_id, command, receipts=receipts)
+                    return
+            elif command == 'open_drawer':
+                if params.get('pin', 2) not in (2, 5):
+                    result = (
+                        False, ReceiptManagerApp.INVALID_COMMAND,
+                        'Invalid cash drawer pin: {0}'.format(params['pin'])
+                    )
+                elif error is not None:
+                    result = (False,) + error
+                else:
+                    result = self.queue_job(msg, 'high')
             else:
-                success, error_code, status = (
+                result = (
                     False, ReceiptManagerApp.INVALID_COMMAND,
                     'Invalid command: {0}'.format(command)
                 )
         except (KeyError, IndexError) as e:
-            success, error_code, status = (
+            result = (
                 False, ReceiptManagerApp.FORMAT_ERROR,
                 'Message format error, could not find key: {0}'.format(e)
             )
         except Exception as e:
-            success, error_code, status = (
-                False, ReceiptManagerApp.UNKNOWN_ERROR, str(e)
-            )
+            result = (False, ReceiptManagerApp.UNKNOWN_ERROR, str(e))
+
+        if result is None:
+            return
 
+        success, error_code, status = result
         if success:
             logger.info(status)
         else:
             logger.error(status)
+            metrics.inc(metrics.ERRORS, ReceiptManagerApp.COMMAND_CHANNEL,
+                        command_key(msg))
 
-        self.send_response(success, error_code, status)
+        # the responses of the other commands are "send_receipt" ones
+        command = command_key(msg)
+        if command not in ReceiptManagerApp.COMMANDS:
+            command = 'send_receipt'
+        self.send_response(success, error_code, status, msg_id, command)
 
-    def print_receipt(self, driver_name, cab_id, items, promotions):
-        printer = Usb(
-            int(self.id_vendor, 16), int(self.id_product, 16),
-            int(self.interface, 16), int(self.in_ep, 16),
-            int(self.out_ep, 16)
-        )
+    def queue_job(self, msg, lane):
+        """
+        Queue a command in the spooler, its "priority" parameter overrides
+        the lane. Return the response if it was not queued, None otherwise.
+        """
+        params = msg['params']
+        lane = params.get('priority', lane)
+        if lane not in ReceiptManagerApp.LANES:
+            return (False, ReceiptManagerApp.INVALID_COMMAND,
+                    'Invalid priority: {0}'.format(lane))
 
-        try:
-            # print header if we have one
-            if self.header:
-                printer.set(align='center')
-                printer.image(self.header)
-                printer.line(initial_break=False)
-
-            # print date and time
-            now = datetime.datetime.now()
-            date = datetime.datetime.strftime(now, '%m/%d/%Y')
-            time = datetime.datetime.strftime(now, '%I:%M %p')
-
-            printer.set(align='left')
-            printer.text('DATE: {0} {1}\n'.format(date, time))
-
-            # print driver name and cab id
-            printer.set(align='left')
-            printer.text('DRIVER NAME: {0}\n'.format(driver_name))
-            printer.text('CAB ID: {0}\n'.format(cab_id))
-            printer.line()
-
-            # print items
-            extras = {}
-            subtotal = 0.0
-            for name, (price, itype) in items.iteritems():
-                price = float(price)
-                left = '{0}:'.format(name)
-                right = '{0:.2f}'.format(price)
-                to_print = lr_justify(left, right, 32)
-                if itype in ('barcode', 'qrcode'):
-                    printer.set(align='left', type='u2')
-                    printer.text(to_print)
-                    extras[name] = itype
+        job = {'id': message_id(msg), 'command': msg['command'],
+               'params': params}
+        key = params.get('key')
+        while True:
+            job_id, duplicate = self.spooler.submit(job, lane, key)
+            if not duplicate:
+                logger.info('Job {0} queued in lane {1}'.format(job_id, lane))
+                return None
+
+            # the job of the key is answered when it is done, it failed if
+            # the key was forgotten meanwhile, then it is queued again
+            with self._lock:
+                state = self.spooler.state(job_id, key)
+                if state == PENDING:
+                    logger.info('Duplicate of job {0} waiting for it'.format(
+                        job_id
+                    ))
+                    self._duplicates.setdefault(job_id, []).append(job['id'])
+                    return None
+            if state == DONE:
+                return (True, ReceiptManagerApp.OK,
+                        'Duplicate of job {0}, already done'.format(job_id))
+
+    def run_job(self, job):
+        """
+        Run a command taken from the spooler, return False to retry it
+        """
+        command, params = job.payload['command'], job.payload['params']
+        if self.printer_error() is None:
+            with metrics.timer(metrics.DEVICE_IO,
+                               ReceiptManagerApp.COMMAND_CHANNEL, command), \
+                    self._format_errors(job):
+                if command == 'open_drawer':
+                    success = self.open_drawer(params.get('pin', 2))
+                elif command == 'reprint':
+                    success = self.reprint(params['receipt_id'])
+                elif command == 'send_receipts':
+                    results = self.print_receipts(params['receipts'])
+                    success = results is not None
+                    if success:
+                        self._results[job.id] = results
                 else:
-                    printer.set(align='left', type='normal')
-                    printer.text(to_print)
-                printer.text('\n')
-                subtotal += price
-            tax = 0.0825 * subtotal
-
-            # print subtotals, taxes and totals
-            printer.text('\n')
-            printer.set(align='left', type='b')
-            printer.text('SUBTOTAL:\t{0:.2f}\n'.format(subtotal))
-            printer.text('TAXES:\t{0:.2f}\n'.format(tax))
-
-            total = subtotal + tax
-            printer.line(initial_break=False)
-            printer.set(align='left', type='b')
-            printer.text('TOTAL:\t{0:.2f}\n'.format(total))
-
-            # print promotions and extras
-            if promotions:
-                printer.text('\n')
-                printer.set(align='left', type='bu2')
-                printer.text('PROMOTIONS:\n\n')
-
-                printer.set(align='left', type='bu')
-                for name, ptype in promotions.iteritems():
-                    if ptype == 'barcode':
-                        printer.text('{0}\n'.format(name))
-                        printer.barcode(name,'UPC-A', 128, 2, 'OFF', 'B')
-                    elif ptype == 'qrcode':
-                        printer.text('{0}\n'.format(name))
-                        printer.qr(name, True, qr_escpos_size=4)
-                    else:
-                        msg = 'Invalid promotion type: {0}'
-                        logger.error(msg.format(ptype))
-                printer.line()
-
-            if extras:
-                printer.text('\n')
-                printer.set(align='left', type='bu2')
-                printer.text('EXTRAS\n\n')
-
-                printer.set(align='left', type='bu')
-                for name, etype in extras.iteritems():
-                    if etype == 'barcode':
-                        printer.text('{0}\n'.format(name))
-                        printer.barcode(name,'UPC-A', 128, 2, 'OFF', 'B')
-                    elif etype == 'qrcode':
-                        printer.text('{0}\n'.format(name))
-                        printer.qr(name, True, qr_escpos_size=4)
-                    else:
-                        msg = 'Invalid extra type: {0}'
-                        logger.error(msg.format(etype))
-                printer.line()
-
-            # print footer if we have one
-            if self.footer:
-                printer.line(initial_break=True)
-                printer.set(align='center')
-                printer.image(self.footer)
-
-            printer.cut()
-            return True
+                    receipt = self._results[job.id] = {}
+                    success = self.print_receipt(
+                        params['driver_name'], params['cab_id'],
+                        params['items'], params['promotions'], receipt
+                    )
+            if success:
+                return True
+
+        if self.monitor is not None:
+            self.monitor.wake()
+        return False
+
+    @contextlib.contextmanager
+    def _format_errors(self, job):
+        """
+        Keep the FORMAT_ERROR response of a malformed job, the spooler does
+        not retry it, see job_done()
+        """
+        try:
+            yield
+        except ReceiptManagerApp.FORMAT_ERRORS as e:
+            self._errors[job.id] = (
+                ReceiptManagerApp.FORMAT_ERROR,
+                'Message format error: {0!r}'.format(e)
+            )
+            raise
+
+    def job_done(self, job, success):
+        """
+        Answer a command once its job succeeded, ran out of retries or
+        failed with a format error
+        """
+        command = job.payload['command']
+        results = self._results.pop(job.id, None)
+        error = self._errors.pop(job.id, None)
+        if success:
+            error_code, status = ReceiptManagerApp.OK, 'OK'
+            logger.info('Job {0} done'.format(job.id))
+        else:
+            failed = ('Failed to open the cash drawer' if command == 'open_drawer'
+                      else 'Failed to print receipt')
+            error_code, status = error or self.printer_error() or (
+                ReceiptManagerApp.PRINTER_ERROR, failed
+            )
+            logger.error('Job {0} failed: {1}'.format(job.id, status))
+            metrics.inc(metrics.ERRORS, ReceiptManagerApp.COMMAND_CHANNEL,
+                        command)
+
+        # send_receipts answers the status of every receipt too, all of
+        # them failed if the printer failed
+        extra = {}
+        if command == 'send_receipts':
+            count = len(job.payload['params']['receipts'])
+            results = results or [(error_code, status, None)] * count
+            errors = [code for code, _, _ in results
+                      if code != ReceiptManagerApp.OK]
+            if success and errors:
+                success, error_code = False, errors[0]
+                status = '{0} of {1} receipts printed'.format(
+                    count - len(errors), count
+                )
+            extra['receipts'] = [
+                {'error': code != ReceiptManagerApp.OK, 'error_code': code,
+                 'status': text, 'receipt_id': receipt_id}
+                for code, text, receipt_id in results
+            ]
+        elif command == 'send_receipt' and results:
+            extra.update(results)
+
+        with self._lock:
+            duplicates = self._duplicates.pop(job.id, [])
+        for msg_id in [job.payload['id']] + duplicates:
+            self.send_response(success, error_code, status, msg_id, command,
+                               **extra)
+
+    def teardown(self):
+        if self.spooler is not None:
+            self.spooler.stop()
+            self.spooler = None
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def printer_session(self):
+        if self.session is None:
+            self.session = UsbSession(
+                int(self.id_vendor, 16), int(self.id_product, 16),
+                int(self.interface, 16), int(self.in_ep, 16),
+                int(self.out_ep, 16), self.buffered, self.receive_buffer,
+                self.throughput, pipeline=self.pipeline
+            )
+        return self.session
+
+    def open_printer(self):
+        """
+        Return the printer used to print a receipt, it is closed after
+        every receipt. The USB device is kept open between receipts and
+        found again if it was unplugged, see UsbSession.
+        """
+        return self.printer_session().open()
+
+    def printer_error(self):
+        """
+        Return the error code and message if the last printer status says
+        a receipt can not be printed, None otherwise
+        """
+        if self.monitor is None:
+            return None
+
+        status = self.monitor.status
+        if not status.connected:
+            return ReceiptManagerApp.PRINTER_NOT_FOUND, 'Printer not connected'
+        if status.cover_open:
+            return ReceiptManagerApp.COVER_OPEN, 'Printer cover open'
+        if status.paper_out:
+            return ReceiptManagerApp.PAPER_OUT, 'Printer out of paper'
+        if status.online is False:
+            return ReceiptManagerApp.PRINTER_OFFLINE, 'Printer offline'
+        return None
+
+    def receipt_template(self):
+        """
+        Return the receipt layout compiled in a Template, the fields are
+        built by print_receipt().
+        """
+        receipt = Template()
+
+        # print header if we have one
+        if self.header:
+            receipt.set(align='center')
+            self._image_template(receipt, self.header)
+            receipt.line(initial_break=False)
+
+        # print date and time
+        receipt.set(align='left')
+        receipt.field('DATE: {date} {time}\n')
+
+        # print driver name and cab id
+        receipt.set(align='left')
+        receipt.field('DRIVER NAME: {driver_name}\n')
+        receipt.field('CAB ID: {cab_id}\n')
+        receipt.line()
+
+        # print items, the ones with a barcode or qrcode are underlined
+        item, extra = Template(), Template()
+        item.set(align='left', type='normal')
+        extra.set(align='left', type='u2')
+        for template in (item, extra):
+            template.field('{row}')
+            template.text('\n')
+        receipt.section('items', {'item': item, 'extra': extra},
+                        key=lambda element: element['type'])
+
+        # print subtotals, taxes and totals
+        receipt.text('\n')
+        receipt.set(align='left', type='b')
+        receipt.field('SUBTOTAL:\t{subtotal:.2f}\n')
+        receipt.field('TAXES:\t{tax:.2f}\n')
+        receipt.line(initial_break=False)
+        receipt.set(align='left', type='b')
+        receipt.field('TOTAL:\t{total:.2f}\n')
+
+        # print promotions and extras, sections printed once if present
+        receipt.section('promotions', self._codes_template('PROMOTIONS:'))
+        receipt.section('extras', self._codes_template('EXTRAS'))
+
+        # print footer if we have one
+        if self.footer:
+            receipt.line(initial_break=True)
+            receipt.set(align='center')
+            self._image_template(receipt, self.footer)
+
+        receipt.cut()
+        return receipt
+
+    def _image_template(self, template, image):
+        if self.graphics is not None:
+            template.nv_image(self.graphics.add(image))
+        else:
+            template.command(lambda printer, fields: printer.image(
+                image, mode=self.dither, width=self.image_width,
+                cache=self.raster_cache, compact=self.compact_images
+            ))
+
+    def _codes_template(self, title):
+        barcode, qrcode = Template(), Template()
+        for template in (barcode, qrcode):
+            template.field('{name}\n')
+        barcode.command(lambda printer, fields: printer.barcode(
+            fields['name'], 'UPC-A', 128, 2, 'OFF', 'B'
+        ))
+        qrcode.command(lambda printer, fields: printer.qr(
+            fields['name'], True, qr_escpos_size=4
+        ))
+
+        codes = Template()
+        codes.text('\n')
+        codes.set(align='left', type='bu2')
+        codes.text('{0}\n\n'.format(title))
+        codes.set(align='left', type='bu')
+        codes.section('codes', {'barcode': barcode, 'qrcode': qrcode},
+                      key=lambda element: element['type'])
+        codes.line()
+        return codes
+
+    def _codes(self, codes, kind):
+        result = []
+        for name, ctype in codes.iteritems():
+            if ctype in ('barcode', 'qrcode'):
+                result.append({'name': name, 'type': ctype})
+            else:
+                logger.error('Invalid {0} type: {1}'.format(kind, ctype))
+        return [{'codes': result}] if codes else []
+
+    def receipt_fields(self, driver_name, cab_id, items, promotions):
+        """
+        Return the fields of the receipt template, see receipt_template()
+        """
+        now = datetime.datetime.now()
+        fields = {
+            'date': datetime.datetime.strftime(now, '%m/%d/%Y'),
+            'time': datetime.datetime.strftime(now, '%I:%M %p'),
+            'driver_name': driver_name,
+            'cab_id': cab_id,
+            'items': []
+        }
+
+        extras = {}
+        subtotal = 0.0
+        for name, (price, itype) in items.iteritems():
+            price = float(price)
+            left = u'{0}:'.format(name)
+            right = '{0:.2f}'.format(price)
+            if itype in ('barcode', 'qrcode'):
+                extras[name] = itype
+            fields['items'].append({
+                'row': lr_justify(left, right, 32),
+                'type': 'extra' if itype in ('barcode', 'qrcode') else 'item'
+            })
+            subtotal += price
+
+        tax = 0.0825 * subtotal
+        fields.update(subtotal=subtotal, tax=tax, total=subtotal + tax)
+        fields['promotions'] = self._codes(promotions, 'promotion')
+        fields['extras'] = self._codes(extras, 'extra')
+        return fields
+
+    def receipt_error(self, receipt):
+        """
+        Return the FORMAT_ERROR response if the fields of a receipt can not
+        be built, None otherwise. A malformed receipt would fail on every
+        attempt, so it is not queued.
+        """
+        try:
+            self.receipt_fields(*[receipt[name] for name in
+                                  ReceiptManagerApp.RECEIPT_FIELDS])
+        except ReceiptManagerApp.FORMAT_ERRORS as e:
+            return (False, ReceiptManagerApp.FORMAT_ERROR,
+                    'Receipt format error: {0!r}'.format(e))
+        return None
+
+    def print_receipt(self, driver_name, cab_id, items, promotions,
+                      receipt=None):
+        """
+        Print a receipt, return False if it could not be printed. The
+        "receipt_id" given by the journal is set in the "receipt" dict.
+        """
+        if self.template is None:
+            self.template = self.receipt_template()
+        fields = self.receipt_fields(driver_name, cab_id, items, promotions)
+        commands = []
+
+        def job(printer):
+            commands.append(printer.template(self.template, fields))
+
+        printer = self._print(job)
+        if printer is None:
+            return False
+
+        if printer.first_byte is not None:
+            logger.debug('Receipt first byte after {0:.1f} ms'.format(
+                printer.first_byte * 1000
+            ))
+
+        record = self.journal_receipt(commands[0], cab_id)
+        if record is not None and receipt is not None:
+            receipt['receipt_id'] = record.id
+        return True
+
+    def print_receipts(self, receipts):
+        """
+        Print a list of receipts, dicts with the print_receipt() arguments,
+        back to back in one printer job. Return the error code, status and
+        journal receipt_id of every receipt or None if the printer failed.
+        """
+        if self.template is None:
+            self.template = self.receipt_template()
+
+        documents, results = [], []
+        for receipt in receipts:
+            try:
+                documents.append(self.receipt_fields(
+                    receipt['driver_name'], receipt['cab_id'],
+                    receipt['items'], receipt['promotions']
+                ))
+                results.append(None)
+            except Exception as e:
+                results.append((
+                    ReceiptManagerApp.FORMAT_ERROR,
+                    'Receipt format error: {0!r}'.format(e), None
+                ))
+
+        sent = []
+
+        def job(printer):
+            sent.extend(printer.batch(self.template, documents))
+
+        if documents and self._print(job) is None:
+            return None
+
+        sent = iter(sent)
+        for i, result in enumerate(results):
+            if result is not None:
+                continue
+
+            commands = next(sent)
+            if isinstance(commands, Exception):
+                results[i] = (ReceiptManagerApp.FORMAT_ERROR,
+                              'Receipt format error: {0!r}'.format(commands),
+                              None)
+            else:
+                record = self.journal_receipt(commands, receipts[i]['cab_id'])
+                results[i] = (ReceiptManagerApp.OK, 'OK',
+                              record and record.id)
+        return results
+
+    def journal_receipt(self, commands, cab_id):
+        """
+        Keep the commands of a printed receipt in the journal, return its
+        Record or None if the journal is disabled or failed
+        """
+        if self.journal is None:
+            return None
+
+        try:
+            return self.journal.append(commands, cab_id=cab_id)
         except Exception as e:
-            logger.error(e)
+            logger.error('Could not journal the receipt: {0}'.format(e))
+            return None
+
+    def find_receipt(self, params):
+        """
+        Return the journal Record of the receipt "receipt_id" or of the
+        last receipt of "cab_id", None if it is not found
+        """
+        if 'receipt_id' in params:
+            return self.journal.get(params['receipt_id'])
+
+        records = self.journal.latest(cab_id=params['cab_id'])
+        return records[0] if records else None
+
+    def find_receipts(self, params):
+        """
+        Return the newest "count" receipts in the journal, of "cab_id" and
+        printed between the times "since" and "until" if given
+        """
+        count = int(params.get('count', 10))
+        if count < 1:
+            raise ValueError('Invalid count: {0}'.format(count))
+        since, until = [None if params.get(name) is None
+                        else float(params[name]) for name in ('since', 'until')]
+
+        key = {'cab_id': params['cab_id']} if 'cab_id' in params else {}
+        if since is None and until is None:
+            records = self.journal.latest(count, **key)
+        else:
+            records = self.journal.between(since, until, count, **key)[::-1]
+
+        return [{'receipt_id': record.id, 'cab_id': record.keys.get('cab_id'),
+                 'time': record.time} for record in records]
+
+    def reprint(self, receipt_id):
+        """
+        Send the commands of a receipt kept in the journal to the printer
+        as they were printed, return False if it could not be reprinted
+        """
+        record = self.journal and self.journal.get(receipt_id)
+        if record is None:
+            logger.error('Receipt {0} not in the journal'.format(receipt_id))
             return False
-        finally:
-            printer.close()
+        commands = self.journal.read(record)
 
-    def send_response(self,  success, error_code, status):
+        def job(printer):
+            printer.raw(commands)
+
+        return self._print(job) is not None
+
+    def open_drawer(self, pin):
+        return self._print(lambda printer: printer.cashdraw(pin),
+                           graphics=False) is not None
+
+    def _print(self, job, graphics=True):
+        """
+        Call job(printer) and close the printer, return it or None if the
+        job failed, the FORMAT_ERRORS are raised. The NV graphics are stored first if "graphics" is
+        True, they are known to be stored only if the job succeeds.
+        """
         try:
-            msg = json.dumps({
-                "command": "send_receipt",
-                "params": {
-                    "error": not success,
-                    "error_code": error_code,
-                    "status": status,
-                }
-            })
-            pub = redis.StrictRedis()
-            pub.publish(ReceiptManagerApp.RESPONSE_CHANNEL, msg)
+            printer = self.open_printer()
+        except Exception as e:
+            logger.error('Could not open the printer: {0}'.format(e))
+            return None
+
+        # with the pipeline the write errors are raised when closing, the
+        # rest of a failed job is discarded, the whole job is retried
+        stored = None
+        try:
+            try:
+                if graphics and self.graphics is not None:
+                    stored = self.graphics.upload(printer)
+                job(printer)
+            except Exception:
+                printer.close(failed=True)
+                raise
+            printer.close()
+        except ReceiptManagerApp.FORMAT_ERRORS:
+            # a malformed job fails the same way every time, it is not
+            # retried, see _format_errors()
+            raise
         except Exception as e:
             logger.error(e)
+            return None
+
+        if stored:
+            self.graphics.commit(stored)
+        return printer
+
+    def send_status(self, status):
+        msg = {
+            "command": "printer_status",
+            "params": dict(status._asdict())
+        }
+        get_publisher().publish(ReceiptManagerApp.RESPONSE_CHANNEL, msg)
+
+    def send_response(self,  success, error_code, status, msg_id=None,
+                      command='send_receipt', **extra):
+        msg = {
+            "command": command,
+            "params": {
+                "error": not success,
+                "error_code": error_code,
+                "status": status,
+            }
+        }
+        msg['params'].update(extra)
+        if msg_id is not None:
+            msg['id'] = msg_id
+        get_publisher().publish(ReceiptManagerApp.RESPONSE_CHANNEL, msg)
@@ -0,0 +1,293 @@
+__author__ = 'jmrbcu'
+
+# Print the receipt layout with the historical Escpos text mode commands,
+# with state tracking and with the ReceiptManagerApp receipt template,
+# printing the logos as images or stored in the printer NV memory.
+# Compare the byte counts and check that every piece of text and every
+# image is printed in the same text modes, the images are compared dot by
+# dot so the blank rows fed and the blank margins trimmed do not change
+# them. A batch of receipts must be the same receipts back to back,
+# ended once, and a receipt reprinted from the journal the same receipt.
+# No printer or redis server is needed:
+#     python plugins/receipt_manager/tests/test_byte_counts.py
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'plugins')]
+
+from core.escpos import raster
+from core.escpos.constants import *
+from core.journal import Journal
+from core.escpos.escpos import Escpos
+from receipt_manager.receipt_manager_app import ReceiptManagerApp
+from benchmarks.bench_receipt import legacy_receipt
+
+LOGO = os.path.join(ROOT, 'plugins', 'receipt_manager', 'res', 'logo.jpg')
+
+PARAMS = {
+    "driver_name": "Jon Smith",
+    "cab_id": "AH0001234",
+    "items": {
+        "Top up to phone: 713-345-6745": [10.0, 'item'],
+        "T-Shirt on amazon": [3.00, "barcode"],
+        "Phone charge": [2.00, "item"],
+        "Trip Fare": [15.00, "item"]
+    },
+    "promotions": {
+        "Space Center Free Ticket": "qrcode",
+        "Free Coffee": "barcode"
+    }
+}
+
+
+class RecordingPrinter(Escpos):
+    compact_images = True
+
+    def __init__(self):
+        self.data = ''
+        self.device = True
+
+    def _write(self, msg):
+        self.data += msg
+
+    def __del__(self):
+        self.device = None
+
+
+class LegacyPrinter(RecordingPrinter):
+    """ Historical Escpos.set(), every mode is sent every time """
+    compact_images = False
+
+    def _change(self, mode, command):
+        self._raw(command)
+        return True
+
+    def set(self, align='left', font='a', type='normal', width=1, height=1, density=9):
+        if height == 2 and width == 2:
+            self._raw(TXT_NORMAL)
+            self._raw(TXT_4SQUARE)
+        elif height == 2 and width != 2:
+            self._raw(TXT_NORMAL)
+            self._raw(TXT_2HEIGHT)
+        elif width == 2 and height != 2:
+            self._raw(TXT_NORMAL)
+            self._raw(TXT_2WIDTH)
+        else:
+            self._raw(TXT_NORMAL)
+        if type.upper() == "B":
+            self._raw(TXT_BOLD_ON)
+            self._raw(TXT_UNDERL_OFF)
+        elif type.upper() == "U":
+            self._raw(TXT_BOLD_OFF)
+            self._raw(TXT_UNDERL_ON)
+        elif type.upper() == "U2":
+            self._raw(TXT_BOLD_OFF)
+            self._raw(TXT_UNDERL2_ON)
+        elif type.upper() == "BU":
+            self._raw(TXT_BOLD_ON)
+            self._raw(TXT_UNDERL_ON)
+        elif type.upper() == "BU2":
+            self._raw(TXT_BOLD_ON)
+            self._raw(TXT_UNDERL2_ON)
+        if font.upper() == "B":
+            self._raw(TXT_FONT_B)
+        else:
+            self._raw(TXT_FONT_A)
+        if align.upper() == "CENTER":
+            self._raw(TXT_ALIGN_CT)
+        elif align.upper() == "RIGHT":
+            self._raw(TXT_ALIGN_RT)
+        elif align.upper() == "LEFT":
+            self._raw(TXT_ALIGN_LT)
+
+
+def dots(width, height, data, align):
+    """ Return the rows of an image as the positions of its dots bytes """
+    # the position of the byte j relative to the alignment, doubled to
+    # center the odd widths
+    if align == 1:
+        position = lambda j: 2 * j - width
+    elif align == 2:
+        position = lambda j: j - width
+    else:
+        position = lambda j: j
+
+    rows = []
+    for y in range(height):
+        row = data[y * width:(y + 1) * width]
+        rows.append(tuple(
+            (position(j), b) for j, b in enumerate(row) if b != '\x00'
+        ))
+    return rows
+
+
+def interpret(data):
+    """ Return what is printed: a list of (text or image, text modes) """
+    modes = {}
+    printed = []
+    stored = {}
+
+    def emit(item):
+        state = tuple(sorted(modes.items()))
+        if printed and isinstance(item, str) and \
+                isinstance(printed[-1][0], str) and printed[-1][1] == state:
+            printed[-1] = (printed[-1][0] + item, state)
+        else:
+            printed.append((item, state))
+
+    def emit_image(width, height, data):
+        # consecutive images and paper feeds are a single image
+        state = tuple(sorted(modes.items()))
+        rows = dots(width, height, data, modes.get('align'))
+        if printed and printed[-1][0][0] == 'image' and \
+                printed[-1][1] == state:
+            printed[-1][0][1].extend(rows)
+        else:
+            printed.append((('image', rows), state))
+
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if data.startswith('\x1b!', i):
+            n = ord(data[i + 2])
+            modes.update(size=n & 0x30, bold=bool(n & 0x08),
+                         underline=1 if n & 0x80 else 0, font=n & 0x01)
+            i += 3
+        elif data.startswith('\x1bE', i):
+            modes['bold'] = bool(ord(data[i + 2]) & 1)
+            i += 3
+        elif data.startswith('\x1b-', i):
+            modes['underline'] = ord(data[i + 2])
+            i += 3
+        elif data.startswith('\x1bM', i):
+            modes['font'] = ord(data[i + 2])
+            i += 3
+        elif data.startswith('\x1ba', i):
+            modes['align'] = ord(data[i + 2])
+            i += 3
+        elif data.startswith('\x1d|', i):
+            modes['density'] = ord(data[i + 2])
+            i += 3
+        elif data.startswith(HW_INIT, i):
+            modes = dict(size=0, bold=False, underline=0, font=0, align=0)
+            i += len(HW_INIT)
+        elif data.startswith(HW_RESET, i):
+            modes = {}
+            i += len(HW_RESET)
+        elif data.startswith('\x1dv0', i):
+            width = ord(data[i + 4]) + ord(data[i + 5]) * 256
+            height = ord(data[i + 6]) + ord(data[i + 7]) * 256
+            end = i + 8 + width * height
+            emit_image(width, height, data[i + 8:end])
+            i = end
+        elif data.startswith(raster.FEED, i):
+            emit_image(0, ord(data[i + 2]), '')
+            i += 3
+        elif data.startswith(NV_GRAPHICS, i):
+            end = i + 5 + ord(data[i + 3]) + ord(data[i + 4]) * 256
+            params = data[i + 5:end]
+            if params.startswith(NV_STORE):
+                width = ord(params[6]) / 8 + ord(params[7]) * 32
+                height = ord(params[8]) + ord(params[9]) * 256
+                stored[params[3:5]] = width, height, params[11:]
+            elif params.startswith(NV_PRINT):
+                emit_image(*stored[params[2:4]])
+            i = end
+        elif data.startswith('\x1d(k', i):
+            end = i + 5 + ord(data[i + 3]) + ord(data[i + 4]) * 256
+            emit(('qr', modes.get('align'), data[i:end]))
+            i = end
+        elif data.startswith('\x1dk', i):
+            emit(('barcode', modes.get('align')))
+            i += 3
+        elif c in '\x1b\x1d':
+            # commands that do not change the text modes
+            i += 3
+        else:
+            emit(c)
+            i += 1
+    return printed
+
+
+def print_receipt(printer):
+    legacy_receipt(printer, LOGO, LOGO, PARAMS['driver_name'],
+                   PARAMS['cab_id'], PARAMS['items'], PARAMS['promotions'])
+    printer.close()
+    return printer.data
+
+
+def print_template(printer, nv_graphics=False):
+    app = ReceiptManagerApp('test', '0', '0', header=LOGO, footer=LOGO,
+                            nv_graphics=nv_graphics, compact_images=True)
+    app.open_printer = lambda: printer
+    assert app.print_receipt(PARAMS['driver_name'], PARAMS['cab_id'],
+                             PARAMS['items'], PARAMS['promotions'])
+    return printer.data
+
+
+def print_batch(printer, copies):
+    app = ReceiptManagerApp('test', '0', '0', header=LOGO, footer=LOGO,
+                            compact_images=True)
+    app.open_printer = lambda: printer
+    results = app.print_receipts([PARAMS] * copies + [{'cab_id': '1'}])
+    assert [code for code, _, _ in results] == [0] * copies + [1], results
+    return printer.data
+
+
+def print_reprint(printer):
+    directory = tempfile.mkdtemp()
+    try:
+        app = ReceiptManagerApp('test', '0', '0', header=LOGO, footer=LOGO,
+                            compact_images=True)
+        app.journal = Journal(directory, ('cab_id',))
+        app.open_printer = RecordingPrinter
+        receipt = {}
+        assert app.print_receipt(PARAMS['driver_name'], PARAMS['cab_id'],
+                                 PARAMS['items'], PARAMS['promotions'],
+                                 receipt)
+        app.open_printer = lambda: printer
+        assert app.reprint(receipt['receipt_id'])
+        app.journal.close()
+    finally:
+        shutil.rmtree(directory)
+    return printer.data
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+
+    before = print_receipt(LegacyPrinter())
+    results = [
+        ('state tracking', print_receipt(RecordingPrinter())),
+        ('template', print_template(RecordingPrinter())),
+        ('template+nv', print_template(RecordingPrinter(), True)),
+    ]
+
+    # the date line is the same as long as all the receipts are printed
+    # in the same minute
+    print 'bytes before: {0}'.format(len(before))
+    for name, after in results:
+        assert interpret(before) == interpret(after), \
+            'The receipts differ: {0}'.format(name)
+        assert len(after) < len(before)
+
+        print 'bytes with {0}: {1}, saved: {2} bytes ({3:.1f}%)'.format(
+            name, len(after), len(before) - len(after),
+            100.0 * (len(before) - len(after)) / len(before)
+        )
+
+    receipt = results[1][1]
+    assert receipt.endswith(HW_RESET)
+    batch = print_batch(RecordingPrinter(), 3)
+    assert batch == receipt[:-len(HW_RESET)] * 3 + HW_RESET, \
+        'The batch differs from the receipts back to back'
+    print 'bytes with template batch of 3: {0}'.format(len(batch))
+
+    assert print_reprint(RecordingPrinter()) == receipt, \
+        'The reprinted receipt differs'
+    print 'bytes reprinted from the journal: {0}'.format(len(receipt))
@@ -0,0 +1,164 @@
+__author__ = 'jmrbcu'
+
+# Fail print jobs partway, with a write that times out or an error while
+# the commands are generated, printing the commands in the calling thread
+# and from the writer thread, and check that none of the commands of the
+# failed job reach the printer after the error: the job is retried whole,
+# the rest of it would print a partial receipt before the retried one.
+# The printer of a UsbSession, kept between jobs, must start the next job
+# clean. No printer or redis server is needed:
+#     python plugins/receipt_manager/tests/test_failed_jobs.py
+
+import os
+import sys
+import errno
+import logging
+
+import usb.core
+import usb.util
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'plugins')]
+
+from core.escpos import printer as usb_printer
+from core.escpos.escpos import Escpos
+from core.escpos.exceptions import WriteTimeoutError
+
+PIECE = 512
+
+
+class TimeoutPrinter(Escpos):
+    """ Printer whose write number "timeout" times out, None never """
+
+    def __init__(self, pipeline, timeout=None):
+        self.device = True
+        self.timeout = timeout
+        self.writes = 0
+        self.data = ''
+        self.after_error = ''
+        self.failed = False
+        self._set_buffered(True, PIECE)
+        self._set_pipelined(pipeline)
+
+    def _write(self, msg):
+        self.writes += 1
+        if self.failed:
+            self.after_error += msg
+            return len(msg)
+        if self.writes == self.timeout:
+            self.failed = True
+            return 0
+        self.data += msg
+        return len(msg)
+
+    def __del__(self):
+        self.device = None
+
+
+def timed_out_job(pipeline):
+    printer = TimeoutPrinter(pipeline, timeout=3)
+    try:
+        try:
+            for i in range(20):
+                printer.text(chr(ord('a') + i) * PIECE)
+        except Exception:
+            printer.close(failed=True)
+            raise
+        printer.close()
+    except WriteTimeoutError:
+        pass
+    else:
+        raise AssertionError('The write timeout was not raised')
+    return printer
+
+
+def failed_job(pipeline):
+    printer = TimeoutPrinter(pipeline)
+    try:
+        try:
+            printer.text('a' * PIECE * 2 + 'b' * (PIECE / 2))
+            raise ValueError('template error')
+        except Exception:
+            printer.close(failed=True)
+            raise
+    except ValueError:
+        pass
+    return printer
+
+
+class Device(object):
+    """ USB device whose write number "timeout" times out """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.writes = 0
+        self.data = []
+
+    def write(self, endpoint, msg, timeout):
+        self.writes += 1
+        if self.writes == self.timeout:
+            raise usb.core.USBError('timeout', errno=errno.ETIMEDOUT)
+        self.data.append(str(msg))
+        return len(msg)
+
+    def ctrl_transfer(self, *args):
+        pass
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def get_active_configuration(self):
+        raise usb.core.USBError('not configured')
+
+    def set_configuration(self):
+        pass
+
+
+def session_jobs(pipeline):
+    device = Device(timeout=3)
+    usb.core.find = lambda **kwargs: device
+    usb.util.claim_interface = usb.util.release_interface = \
+        lambda device, interface: None
+    usb.util.dispose_resources = lambda device: None
+
+    session = usb_printer.UsbSession(0x04b8, 0x0202, buffered=True,
+                                     receive_buffer=PIECE, pipeline=pipeline)
+    for text in ('a' * PIECE * 8, 'b' * PIECE):
+        printer = session.open()
+        try:
+            try:
+                printer.text(text)
+            except Exception:
+                printer.close(failed=True)
+                raise
+            printer.close()
+        except WriteTimeoutError:
+            pass
+    session.close()
+    return device.data
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+
+    for pipeline in (0, 4):
+        printer = timed_out_job(pipeline)
+        assert printer.failed
+        assert printer.after_error == '', \
+            'pipeline {0}: {1} bytes sent after the timeout'.format(
+                pipeline, len(printer.after_error)
+            )
+        assert len(printer.data) == 2 * PIECE, len(printer.data)
+
+        printer = failed_job(pipeline)
+        # the pieces queued for the writer may be dropped too
+        assert ('a' * PIECE * 2).startswith(printer.data), \
+            'pipeline {0}: the failed job was finished'.format(pipeline)
+        assert printer._writer is None and not printer._buffer
+
+        # the next job of the session gets only its own commands
+        data = session_jobs(pipeline)
+        assert ''.join(data).startswith('a' * PIECE * 2 + 'b' * PIECE), \
+            'pipeline {0}: the failed job was sent with the next'.format(pipeline)
+
+        print 'pipeline {0}: nothing sent after the errors'.format(pipeline)
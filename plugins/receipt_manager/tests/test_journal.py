@@ -0,0 +1,132 @@
+__author__ = 'jmrbcu'
+
+# Keep receipts in the receipt journal: the oldest segments are dropped
+# with their records when the journal is full, the records are found
+# again when the journal is opened after a restart or a crash, by id,
+# by cab and by time, and an empty segment left by a crash does not stop
+# the journal from opening. No printer or redis server is needed:
+#     python plugins/receipt_manager/tests/test_journal.py
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'plugins')]
+
+from core.journal import Journal, HEADER, SUFFIX
+
+SEGMENT_SIZE = 4096
+
+
+def receipt(number):
+    return 'receipt {0} '.format(number) + os.urandom(300)
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith(SUFFIX))
+
+
+def test_rotation(directory):
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=2)
+    for i in range(60):
+        journal.append(receipt(i), cab_id='AH{0}'.format(i % 3))
+
+    assert len(segment_files(directory)) == 2, segment_files(directory)
+    kept = journal.latest(100)
+    assert kept and len(kept) < 60
+    assert [record.id for record in kept] == range(60, 60 - len(kept), -1)
+    assert journal.get(1) is None and journal.get(60) is not None
+
+    # the index of a cab keeps only the records of the kept segments
+    oldest = kept[-1].id
+    for cab in ('AH0', 'AH1', 'AH2'):
+        ids = [record.id for record in journal.latest(100, cab_id=cab)]
+        assert ids and min(ids) >= oldest, (cab, ids)
+    journal.close()
+
+
+def test_reopen(directory):
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=8)
+    documents = [receipt(i) for i in range(20)]
+    for i, document in enumerate(documents):
+        journal.append(document, cab_id='AH{0}'.format(i % 2))
+    last = journal.latest()[0]
+    journal.close()
+
+    # a record torn by a crash after the last one is not found
+    path = os.path.join(directory, segment_files(directory)[-1])
+    with open(path, 'r+b') as segment:
+        segment.seek(last.offset + last.size)
+        segment.write('RJ' + '\xff' * (HEADER.size - 2))
+
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=8)
+    assert [record.id for record in journal.latest(100)] == range(20, 0, -1)
+    assert [journal.read(record) for record in journal.latest(100)] == \
+        documents[::-1]
+    assert [record.id for record in journal.latest(3, cab_id='AH1')] == \
+        [20, 18, 16]
+
+    # the ids go on after the kept ones
+    record = journal.append('after the restart', cab_id='AH0')
+    assert record.id == 21
+    assert journal.read(journal.latest(cab_id='AH0')[0]) == 'after the restart'
+    journal.close()
+
+
+def test_between(directory):
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=8)
+    records = [journal.append(receipt(i), cab_id='AH{0}'.format(i % 2))
+               for i in range(10)]
+    times = [record.time for record in records]
+    assert times == sorted(times)
+
+    def ids(*args, **kwargs):
+        return [record.id for record in journal.between(*args, **kwargs)]
+
+    assert ids() == range(1, 11)
+    assert ids(times[3], times[6]) == [4, 5, 6, 7]
+    assert ids(since=times[7]) == [8, 9, 10]
+    assert ids(until=times[1]) == [1, 2]
+    assert ids(times[2], times[8], count=2) == [8, 9]
+    assert ids(times[2], times[8], cab_id='AH1') == [4, 6, 8]
+    assert ids(times[2], cab_id='AH0', count=2) == [7, 9]
+    assert ids(times[9] + 1) == []
+    assert ids(cab_id='AH9') == []
+    journal.close()
+
+
+def test_empty_segment(directory):
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=8)
+    journal.append('before the crash', cab_id='AH0')
+    journal.close()
+
+    # the crash came after the next segment was created, before its size
+    # was set
+    open(os.path.join(directory, '{0:010d}{1}'.format(2, SUFFIX)), 'wb').close()
+
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=8)
+    assert journal.read(journal.latest(cab_id='AH0')[0]) == 'before the crash'
+    record = journal.append('after the crash', cab_id='AH0')
+    assert record.id == 2
+    journal.close()
+
+    journal = Journal(directory, ('cab_id',), SEGMENT_SIZE, segments=8)
+    assert [journal.read(record) for record in journal.latest(2)] == \
+        ['after the crash', 'before the crash']
+    journal.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+
+    for test in (test_rotation, test_reopen, test_between, test_empty_segment):
+        directory = tempfile.mkdtemp()
+        try:
+            test(directory)
+        finally:
+            shutil.rmtree(directory)
+        print '{0}: OK'.format(test.__name__)
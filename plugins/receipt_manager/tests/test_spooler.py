@@ -0,0 +1,234 @@
+__author__ = 'jmrbcu'
+
+# Check the redis spooler the receipt manager queues its commands in: the
+# jobs of the first lanes run first, a key submitted again while it is
+# known is not queued again, the failed jobs are retried and the fatal
+# ones are not, the jobs left running by a crash are run again. A receipt
+# that fails while its template is rendered fails the same way every
+# time, it must be attempted once and answered with a format error
+# instead of retried and answered with a printer error. No printer is
+# needed, a redis server must be running on localhost:
+#     python plugins/receipt_manager/tests/test_spooler.py
+
+import os
+import sys
+import time
+import logging
+import threading
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'plugins')]
+
+import redis
+
+from core import spooler
+from core.escpos.escpos import Escpos
+from core.escpos.template import Template
+from receipt_manager import receipt_manager_app
+from receipt_manager.receipt_manager_app import ReceiptManagerApp
+
+SPOOL = 'test.spool'
+
+RECEIPT = {
+    "destination": ["printer"],
+    "driver_name": "Jon Smith",
+    "cab_id": "AH0001234",
+    "items": {"Trip Fare": [15.00, "item"]},
+    "promotions": {}
+}
+
+
+class RecordingPrinter(Escpos):
+    def __init__(self):
+        self.data = ''
+        self.device = True
+
+    def _write(self, msg):
+        self.data += msg
+
+    def __del__(self):
+        self.device = None
+
+
+class Publisher(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, channel, msg, coalesce=False):
+        self.messages.append(msg)
+
+
+def clean(client, name):
+    for key in client.keys('{0}:*'.format(name)):
+        client.delete(key)
+
+
+def wait(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_lanes(client):
+    clean(client, SPOOL)
+    gate, ran = threading.Event(), []
+
+    def handler(job):
+        gate.wait()
+        ran.append(job.payload['name'])
+        return True
+
+    jobs = spooler.Spooler(SPOOL, handler, poll=0.05)
+    jobs.start()
+    try:
+        # the first job blocks the worker until all of them are queued
+        jobs.submit({'name': 'first'}, 'low')
+        assert wait(lambda: client.llen(SPOOL + ':running') == 1)
+        for name, lane in (('low', 'low'), ('normal 1', 'normal'),
+                           ('high', 'high'), ('normal 2', 'normal')):
+            jobs.submit({'name': name}, lane)
+        gate.set()
+        assert wait(lambda: len(ran) == 5)
+    finally:
+        jobs.stop()
+        clean(client, SPOOL)
+
+    assert ran == ['first', 'high', 'normal 1', 'normal 2', 'low'], ran
+
+
+def test_dedup(client):
+    clean(client, SPOOL)
+    gate, ran = threading.Event(), []
+
+    def handler(job):
+        gate.wait()
+        ran.append(job.id)
+        return job.payload['ok']
+
+    jobs = spooler.Spooler(SPOOL, handler, retries=0, dedup_ttl=60, poll=0.05)
+    jobs.start()
+    try:
+        first, duplicate = jobs.submit({'ok': True}, key='receipt-1')
+        assert not duplicate
+        assert jobs.submit({'ok': True}, key='receipt-1') == (first, True)
+        assert jobs.state(first, 'receipt-1') == spooler.PENDING
+
+        gate.set()
+        assert wait(lambda: jobs.state(first, 'receipt-1') == spooler.DONE)
+        assert jobs.submit({'ok': True}, key='receipt-1') == (first, True)
+        assert 0 < client.ttl(SPOOL + ':dedup:receipt-1') <= 60
+
+        # the key of a failed job is forgotten, it can be submitted again
+        failed, _ = jobs.submit({'ok': False}, key='receipt-2')
+        assert wait(lambda: jobs.state(failed, 'receipt-2') is None)
+        again, duplicate = jobs.submit({'ok': True}, key='receipt-2')
+        assert not duplicate and again != failed
+        assert wait(lambda: len(ran) == 3)
+    finally:
+        jobs.stop()
+        clean(client, SPOOL)
+
+    assert ran == [first, failed, again], ran
+
+
+def test_retries(client):
+    clean(client, SPOOL)
+    attempts, done = {}, {}
+
+    def handler(job):
+        name = job.payload['name']
+        attempts[name] = attempts.get(name, 0) + 1
+        if name == 'flaky':
+            return attempts[name] > 2
+        if name == 'fatal':
+            raise ValueError('malformed')
+        return False
+
+    def on_done(job, success):
+        done[job.payload['name']] = success
+
+    jobs = spooler.Spooler(SPOOL, handler, retries=3, backoff=0.01,
+                           on_done=on_done, poll=0.05, fatal=(ValueError,))
+    jobs.start()
+    try:
+        for name in ('flaky', 'fatal', 'broken'):
+            jobs.submit({'name': name})
+        assert wait(lambda: len(done) == 3)
+    finally:
+        jobs.stop()
+        clean(client, SPOOL)
+
+    assert done == {'flaky': True, 'fatal': False, 'broken': False}, done
+    assert attempts == {'flaky': 3, 'fatal': 1, 'broken': 4}, attempts
+
+
+def test_recovery(client):
+    clean(client, SPOOL)
+    ran = []
+
+    # a job taken by a worker that died before finishing it
+    jobs = spooler.Spooler(SPOOL, lambda job: ran.append(job.id) or True,
+                           poll=0.05)
+    job_id, _ = jobs.submit({'name': 'interrupted'}, 'normal')
+    queued, _ = jobs.submit({'name': 'queued'}, 'normal')
+    client.rpoplpush(SPOOL + ':lane:normal', SPOOL + ':running')
+
+    jobs.start()
+    try:
+        assert wait(lambda: len(ran) == 2)
+    finally:
+        jobs.stop()
+        running = client.llen(SPOOL + ':running')
+        clean(client, SPOOL)
+
+    assert ran == [job_id, queued], ran
+    assert running == 0
+
+
+def test_render_error_not_retried(client):
+    publisher = Publisher()
+    receipt_manager_app.get_publisher = lambda: publisher
+    clean(client, ReceiptManagerApp.SPOOL)
+
+    def broken(printer, fields):
+        raise KeyError('total')
+
+    class App(ReceiptManagerApp):
+        attempts = 0
+
+        def open_printer(self):
+            App.attempts += 1
+            return RecordingPrinter()
+
+        def receipt_template(self):
+            template = Template()
+            template.text('RECEIPT\n')
+            template.command(broken)
+            return template
+
+    app = App('test', '0', '0', header='', footer='', status_interval=0,
+              spool_backoff=0.01)
+    app.setup()
+    try:
+        app.on_message({'id': 1, 'command': 'send_receipt', 'params': RECEIPT})
+        assert wait(lambda: publisher.messages), 'No response'
+        time.sleep(0.2)
+    finally:
+        app.teardown()
+        clean(client, ReceiptManagerApp.SPOOL)
+
+    response, = publisher.messages
+    assert App.attempts == 1, 'Attempted {0} times'.format(App.attempts)
+    assert response['params']['error_code'] == ReceiptManagerApp.FORMAT_ERROR, \
+        response
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    client = redis.StrictRedis()
+
+    for test in (test_lanes, test_dedup, test_retries, test_recovery,
+                 test_render_error_not_retried):
+        test(client)
+        print '{0}: OK'.format(test.__name__)